@@ -3,9 +3,10 @@ import logging
 from misc.settings import SETTINGS
 from plugins.decorators import get_all_plugins
 from specialized import plugin_telegram, plugin_picamera, plugin_motion_detector, plugin_buffered_recorder, \
-    plugin_still, plugin_media_manager, plugin_status_led, plugin_pwmled
+    plugin_still, plugin_media_manager, plugin_status_led, plugin_pwmled, plugin_adaptive_framerate, plugin_dvr, \
+    plugin_media_archive, plugin_frame_monitor, plugin_preview
 import plugin_ratcam
-from plugins.processes_host import ProcessesHost
+from plugins.processes_host import ProcessesHost, NodeHost
 from misc.logging import ensure_logging_setup
 from misc.signal import GracefulSignal
 
@@ -16,6 +17,10 @@ ensure_logging_setup()
 def main(args):
     if args.token:
         SETTINGS.telegram.token = args.token
+    if args.source is not None:
+        SETTINGS.camera.source = args.source
+    if args.source_motion is not None:
+        SETTINGS.camera.source_motion = args.source_motion
     if args.logfile is not None:
         logging.info('Switching over to logging to %s', args.logfile)
         ensure_logging_setup(logging.DEBUG if args.verbose else logging.INFO, reset=True, filename=args.logfile)
@@ -27,24 +32,49 @@ def main(args):
     assert plugin_picamera.PICAMERA_ROOT_PLUGIN_NAME in plugins
     assert plugin_media_manager.MEDIA_MANAGER_PLUGIN_NAME in plugins
     assert plugin_buffered_recorder.BUFFERED_RECORDER_PLUGIN_NAME in plugins
+    assert plugin_buffered_recorder.SECONDARY_RECORDER_PLUGIN_NAME in plugins
     assert plugin_motion_detector.MOTION_DETECTOR_PLUGIN_NAME in plugins
     assert plugin_still.STILL_PLUGIN_NAME in plugins
     assert plugin_ratcam.RATCAM_PLUGIN_NAME in plugins
     assert plugin_pwmled.PWMLED_PLUGIN_NAME in plugins
     assert plugin_status_led.STATUS_LED_PLUGIN_NAME in plugins
+    assert plugin_adaptive_framerate.ADAPTIVE_FRAMERATE_PLUGIN_NAME in plugins
+    assert plugin_dvr.DVR_PLUGIN_NAME in plugins
+    assert plugin_media_archive.MEDIA_ARCHIVE_PLUGIN_NAME in plugins
+    assert plugin_frame_monitor.FRAME_MONITOR_PLUGIN_NAME in plugins
+    assert plugin_preview.PREVIEW_PLUGIN_NAME in plugins
     if not args.camera:
         del plugins[plugin_picamera.PICAMERA_ROOT_PLUGIN_NAME]
+        del plugins[plugin_adaptive_framerate.ADAPTIVE_FRAMERATE_PLUGIN_NAME]
+        del plugins[plugin_dvr.DVR_PLUGIN_NAME]
+        del plugins[plugin_frame_monitor.FRAME_MONITOR_PLUGIN_NAME]
+        del plugins[plugin_preview.PREVIEW_PLUGIN_NAME]
     if not args.light:
         del plugins[plugin_pwmled.PWMLED_PLUGIN_NAME]
     if not args.status_led:
         del plugins[plugin_status_led.STATUS_LED_PLUGIN_NAME]
     logging.info('Running the following plugins: ' + ', '.join(plugins.keys()))
+    host = SETTINGS.nodes.get('host', cast_to_type=str, allow_none=True, default=None)
+    hmac_key = SETTINGS.nodes.get('hmac_key', cast_to_type=str, allow_none=True, default=None)
+    nodes = dict(SETTINGS.nodes.get('remote', default={}).items())
+    if (args.node or len(nodes) > 0) and hmac_key is None:
+        logging.warning('No nodes.hmac_key set, anyone on the network can control this node.')
+    if args.node:
+        processes_host = NodeHost(plugins, host, SETTINGS.nodes.get('port', cast_to_type=int, default=9090),
+                                  hmac_key=hmac_key)
+    else:
+        processes_host = ProcessesHost(plugins, nodes=nodes, host=host, hmac_key=hmac_key,
+                                       threadpool_size=SETTINGS.nodes.get('threadpool_size', cast_to_type=int,
+                                                                          default=128, ge=1))
     # Ignore KeyboardInterrupt. If we don't do so, it will be raised also in the child processes. We do not have control
     # over the threads running in the child processes, so they will terminate, and here we get some network exception
     # because the socket is closed. We want instead to terminate gracefully.
     with GracefulSignal() as sigint:
-        with ProcessesHost(plugins):
-            logging.info('Ready.')
+        with processes_host:
+            if args.node:
+                logging.info('Ready, waiting for the central host at %s.', processes_host.address)
+            else:
+                logging.info('Ready.')
             sigint.wait()
             logging.info('Turning off...')
 
@@ -54,6 +84,12 @@ if __name__ == '__main__':
     parser.add_argument('--token', '-t', required=False, help='Telegram chat token.')
     parser.add_argument('--no-cam', '--no-camera', '-nc', required=False, dest='camera', default=True,
                         action='store_false', help='Skip initializing camera plugin.')
+    parser.add_argument('--node', required=False, default=False, action='store_true',
+                        help='Run only the camera, for a central host with this node in nodes.remote.')
+    parser.add_argument('--source', required=False, default=None,
+                        help='Stream this raw H264 file in place of the camera.')
+    parser.add_argument('--source-motion', dest='source_motion', required=False, default=None,
+                        help='NumPy file with the motion vectors of the --source file.')
     parser.add_argument('--no-status', '--no-status-led', required=False, dest='status_led', default=True,
                         action='store_false', help='Skip initializing status LED plugin.')
     parser.add_argument('--no-light', '-nl', required=False, dest='light', default=True, action='store_false',
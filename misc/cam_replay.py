@@ -3,12 +3,15 @@ from enum import Enum
 from misc.extended_json_codec import make_custom_serializable
 import numpy as np
 import io
-from threading import Thread, Event
+from threading import Thread, Event, RLock, current_thread
+from time import monotonic
 import json
+import mmap
 import os
 from misc.extended_json_codec import ExtendedJSONCodec
 from safe_picamera import PiMotionAnalysis, PiVideoFrame, PiVideoFrameType
 from specialized.camera_support.mux import MP4StreamMuxer
+from specialized.camera_support.nal import iterate_access_units
 from PIL import Image
 
 
@@ -17,6 +20,18 @@ make_custom_serializable(PiVideoFrame)
 
 DEMO_IMAGE_PATH = os.path.join(os.path.dirname(__file__), 'cam_demo.jpg')
 DEMO_DATA_PATH = os.path.join(os.path.dirname(__file__), 'cam_demo.json')
+# The named resolutions that PiCamera accepts
+_NAMED_RESOLUTIONS = {
+    'VGA': (640, 480),
+    'SVGA': (800, 600),
+    'XGA': (1024, 768),
+    'SXGA': (1280, 1024),
+    'UXGA': (1600, 1200),
+    'HD': (1280, 720),
+    'FHD': (1920, 1080),
+    '1080P': (1920, 1080),
+    '720P': (1280, 720)
+}
 
 
 
@@ -135,14 +150,19 @@ PiMotionAnalysisMockup = PiMotionAnalysis
 
 class PiCameraMockup:  # pragma: no cover
     def __init__(self):
-        self._recording = False
         self._bitrate = 7500
         self._framerate = 10
         self._resolution = (320, 240)
-        self._output = None
-        self._motion_output = None
+        self._outputs = {}
+        self._mjpeg_outputs = {}
+        self._motion_outputs = {}
         self._frame = PiVideoFrame(index=0, frame_type=None, frame_size=0, video_size=0, split_size=0, timestamp=0,
                                    complete=False)
+        self._closed = False
+
+    @property
+    def closed(self):
+        return self._closed
 
     @property
     def resolution(self):
@@ -150,7 +170,11 @@ class PiCameraMockup:  # pragma: no cover
 
     @resolution.setter
     def resolution(self, value):
-        self._resolution = value
+        # Like PiCamera, accept 'WxH' strings and named resolutions, and always return a (width, height) tuple
+        if isinstance(value, str):
+            value = _NAMED_RESOLUTIONS.get(value.upper()) or value.lower().split('x')
+        width, height = map(int, value)
+        self._resolution = (width, height)
 
     @property
     def framerate(self):
@@ -174,24 +198,53 @@ class PiCameraMockup:  # pragma: no cover
 
     @property
     def recording(self):
-        return self._recording
+        return len(self._outputs) > 0 or len(self._mjpeg_outputs) > 0
+
+    @property
+    def analog_gain(self):
+        return 1.
+
+    @property
+    def digital_gain(self):
+        return 1.
+
+    @property
+    def awb_gains(self):
+        return 1.5, 1.5
+
+    @property
+    def exposure_speed(self):
+        return 10000
 
     def mock_event(self, event):
         self._frame = event.frame
-        if event.event_type is CamEventType.WRITE and self._output is not None:
-            self._output.write(event.data)
-        elif event.event_type is CamEventType.FLUSH and self._output is not None:
-            self._output.flush()
-        elif event.event_type is CamEventType.ANALYZE and self._motion_output is not None:
-            self._motion_output.analyze(event.data)
+        # Video data is replayed as is on every splitter port, whatever the resize, motion data on any encoder that
+        # requested it. MJPEG encoders get the demo image for every picture.
+        if event.event_type is CamEventType.WRITE:
+            for output in list(self._outputs.values()):
+                output.write(event.data)
+            is_picture = event.frame is not None and \
+                event.frame.frame_type in (PiVideoFrameType.frame, PiVideoFrameType.key_frame)
+            if is_picture:
+                for output in list(self._mjpeg_outputs.values()):
+                    output.write(load_demo_image_data())
+        elif event.event_type is CamEventType.FLUSH:
+            for output in list(self._outputs.values()) + list(self._mjpeg_outputs.values()):
+                if hasattr(output, 'flush'):
+                    output.flush()
+        elif event.event_type is CamEventType.ANALYZE:
+            for motion_output in list(self._motion_outputs.values()):
+                motion_output.analyze(event.data)
 
     def start_recording(self, output, format='h264', resize=None, splitter_port=1, motion_output=None, **_):
-        assert resize is None, 'Unsupported'
-        assert format == 'h264', 'Unsupported'
-        assert splitter_port == 1, 'Unsupported'
-        self._output = output
-        self._motion_output = motion_output
-        self._recording = True
+        assert format in ('h264', 'mjpeg'), 'Unsupported'
+        assert splitter_port not in self._outputs and splitter_port not in self._mjpeg_outputs, 'Splitter port in use'
+        if format == 'mjpeg':
+            self._mjpeg_outputs[splitter_port] = output
+        else:
+            self._outputs[splitter_port] = output
+        if motion_output is not None:
+            self._motion_outputs[splitter_port] = motion_output
 
     def capture(self, output, format=None, use_video_port=False, resize=None, splitter_port=0, bayer=False, **_):
         assert use_video_port, 'Unsupported'
@@ -201,22 +254,153 @@ class PiCameraMockup:  # pragma: no cover
         if format == 'jpeg' and isinstance(output, str):
             with open(output, 'wb') as fp:
                 fp.write(load_demo_image_data())
+        elif format == 'jpeg' and hasattr(output, 'write'):
+            output.write(load_demo_image_data())
         elif format == 'rgb' and isinstance(output, np.ndarray):
             np.copyto(output, np.asarray(load_demo_image().convert('RGB')))
         else:  # pragma: no cover
             raise RuntimeWarning(
-                'Currently PiCameraMockup can only either write to file paths in JPEG format, or to preallocated numpy'
-                ' arrays in RGB format.')
+                'Currently PiCameraMockup can only either write to file paths or file objects in JPEG format, or to'
+                ' preallocated numpy arrays in RGB format.')
 
     def start_preview(self, *_, **__):
         pass
 
-    def stop_recording(self):
-        self._recording = False
+    def stop_recording(self, splitter_port=1):
+        output = self._outputs.pop(splitter_port, None)
+        if output is None:
+            output = self._mjpeg_outputs.pop(splitter_port, None)
+        self._motion_outputs.pop(splitter_port, None)
+        # Like PiCamera, flush the output when the encoder is closed
+        if output is not None and hasattr(output, 'flush'):
+            output.flush()
 
-    def request_key_frame(self):
+    def request_key_frame(self, splitter_port=1):
         pass
 
+    def close(self):
+        for splitter_port in list(self._outputs.keys()) + list(self._mjpeg_outputs.keys()):
+            self.stop_recording(splitter_port)
+        self._closed = True
+
+
+class H264FileCamera(PiCameraMockup):
+    """
+    Streams a raw H264 Annex-B file, chunked like the encoder of the Raspberry Pi writes it, to every splitter port, at
+    `speed` times the framerate of the camera. The motion vectors, if any, come from a NumPy .npy sidecar holding one
+    `picamera.array.motion_dtype` array per picture. When recording (re)starts, the stream resumes from the next
+    parameter sets, and at the end of the file it starts over if `loop` is set. Instances are independent, so that
+    several virtual cameras can run at once. The resolution set must match the one of the file.
+    """
+    INDEX_BLOCK_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, path, motion_path=None, speed=1., loop=True):
+        super(H264FileCamera, self).__init__()
+        with open(path, 'rb') as fp:
+            self._data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._chunks = list(iterate_access_units(self._data, self.__class__.INDEX_BLOCK_SIZE))
+        if not any(frame_type == PiVideoFrameType.sps_header for frame_type, _, _ in self._chunks):
+            raise ValueError('No H264 parameter sets in %s.' % path)
+        # Motion data is matched to the pictures by their position in the file
+        self._picture_offsets = np.array([begin for frame_type, begin, _ in self._chunks
+                                          if frame_type != PiVideoFrameType.sps_header])
+        self._motion = None if motion_path is None else np.load(motion_path, mmap_mode='r')
+        self._speed = max(0.01, speed)
+        self._loop = loop
+        self._position = 0
+        self._num_pictures = 0
+        self._index = 0
+        self._video_size = 0
+        self._lock = RLock()
+        self._stream_thread = None
+        self._stop_event = None
+
+    @property
+    def speed(self):
+        return self._speed
+
+    @speed.setter
+    def speed(self, value):
+        self._speed = max(0.01, value)
+
+    def _next_chunk(self):
+        if self._position >= len(self._chunks):
+            if not self._loop:
+                return None
+            self._position = 0
+        chunk = self._chunks[self._position]
+        self._position += 1
+        return chunk
+
+    def _make_frame(self, frame_type, frame_size):
+        # Like PiCamera, video and motion data share the frame index
+        if frame_type != PiVideoFrameType.motion_data:
+            self._video_size += frame_size
+        timestamp = None
+        if frame_type in (PiVideoFrameType.frame, PiVideoFrameType.key_frame):
+            timestamp = int(self._num_pictures * 1000000 / self.framerate)
+        frame = PiVideoFrame(index=self._index, frame_type=frame_type, frame_size=frame_size,
+                             video_size=self._video_size, split_size=self._video_size, timestamp=timestamp,
+                             complete=True)
+        self._index += 1
+        return frame
+
+    def _stream(self, stop_event):
+        is_resuming = True
+        next_time = monotonic()
+        while not stop_event.is_set():
+            chunk = self._next_chunk()
+            if chunk is None:
+                break
+            frame_type, begin, end = chunk
+            if is_resuming:
+                if frame_type != PiVideoFrameType.sps_header:
+                    continue
+                is_resuming = False
+            motion = None
+            if frame_type != PiVideoFrameType.sps_header:
+                # Real time is paced by pictures only
+                next_time += 1. / (self.framerate * self._speed)
+                if stop_event.wait(max(0., next_time - monotonic())):
+                    break
+                if self._motion is not None and len(self._motion) > 0:
+                    picture_in_file = self._picture_offsets.searchsorted(begin)
+                    motion = np.array(self._motion[picture_in_file % len(self._motion)])
+            data = self._data[begin:end]
+            with self._lock:
+                if stop_event.is_set():
+                    break
+                self.mock_event(CamEvent(None, CamEventType.WRITE, self._make_frame(frame_type, len(data)), data))
+                if frame_type != PiVideoFrameType.sps_header:
+                    self._num_pictures += 1
+                if motion is not None:
+                    self.mock_event(CamEvent(None, CamEventType.ANALYZE,
+                                             self._make_frame(PiVideoFrameType.motion_data, motion.nbytes), motion))
+
+    def start_recording(self, output, *args, **kwargs):
+        with self._lock:
+            super(H264FileCamera, self).start_recording(output, *args, **kwargs)
+            if self._stream_thread is None:
+                self._stop_event = Event()
+                self._stream_thread = Thread(target=self._stream, args=(self._stop_event,),
+                                             name='H264 file stream thread')
+                self._stream_thread.start()
+
+    def stop_recording(self, splitter_port=1):
+        with self._lock:
+            super(H264FileCamera, self).stop_recording(splitter_port)
+            if self.recording or self._stream_thread is None:
+                return
+            self._stop_event.set()
+            stream_thread, self._stream_thread = self._stream_thread, None
+        # The outputs may stop the recording from within a write
+        if stream_thread is not current_thread():
+            stream_thread.join()
+
+    def close(self):
+        super(H264FileCamera, self).close()
+        self._data.close()
+
 
 class PiCameraReplay:
     DEFAULT_TIME_FACTOR = 1.
@@ -1,15 +1,17 @@
-from plugins.base import Process, PluginProcessBase
+from plugins.base import Process, PluginProcessBase, node_plugin_name, split_node_plugin_name
 from plugins.decorators import make_plugin
-from plugins.processes_host import find_plugin
-from specialized.plugin_media_manager import MediaReceiver, Media
+from plugins.processes_host import find_plugin, active_plugins
+from specialized.plugin_media_manager import MediaReceiver, MAIN_STREAM
 from specialized.plugin_still import StillPlugin
 from specialized.plugin_picamera import PiCameraRootPlugin
 from specialized.plugin_buffered_recorder import BufferedRecorderPlugin
 from specialized.plugin_motion_detector import MotionDetectorResponder, MotionDetectorCameraPlugin
 from specialized.plugin_telegram import TelegramProcessBase, handle_command, TelegramRootPlugin
 from specialized.plugin_pwmled import PWMLedPlugin
+from specialized.plugin_media_archive import MediaArchivePlugin
 import os
 import logging
+from datetime import datetime
 from misc.logging import camel_to_snake
 from misc.settings import SETTINGS
 from Pyro4 import expose as pyro_expose
@@ -24,13 +26,57 @@ _KNOWN_PHOTO_KINDS = ['jpg', 'jpeg']
 _KNOWN_VIDEO_KINDS = ['mp4']
 
 _KNOWN_MEDIA_KINDS = _KNOWN_PHOTO_KINDS + _KNOWN_VIDEO_KINDS
+_ARCHIVE_KIND_ALIASES = {
+    'photo': _KNOWN_PHOTO_KINDS,
+    'photos': _KNOWN_PHOTO_KINDS,
+    'video': _KNOWN_VIDEO_KINDS,
+    'videos': _KNOWN_VIDEO_KINDS
+}
+_MAX_ARCHIVE_ENTRIES = 50
+
+
+def _archive_entry_desc(entry):
+    desc = '#%d %s %s' % (entry['id'], datetime.fromtimestamp(entry['timestamp']).strftime('%Y-%m-%d %H:%M:%S'),
+                          entry['kind'])
+    if entry['duration'] is not None:
+        desc += ' %.1fs' % entry['duration']
+    desc += ' %.1fMB, %s' % (entry['size'] / (1024. * 1024.), entry['trigger'])
+    if entry['motion_score'] is not None:
+        desc += ' (motion %.2f%%)' % (100. * entry['motion_score'])
+    return desc
 
 
 def _patch_media_kind(media):
     kind = media.kind.lower()
     if kind not in _KNOWN_MEDIA_KINDS:
         return False, media
-    return True, Media(media.uuid, media.owning_process, kind, media.path, media.info)
+    return True, media._replace(kind=kind)
+
+
+def _media_caption(media):
+    # Tell apart the media of the camera nodes
+    if media.node is None:
+        return media.caption
+    return media.node if media.caption is None else '%s: %s' % (media.node, media.caption)
+
+
+def _find_camera_plugin(node, plugin_type):
+    """
+    :return: The plugin of type plugin_type on the CAMERA process of node, or of this host if node is None.
+    """
+    return find_plugin(node_plugin_name(node, plugin_type.plugin_name()), Process.CAMERA)
+
+
+def _all_motion_detectors():
+    """
+    :return: A dict mapping the camera node, None for the local camera, to its motion detector.
+    """
+    detectors = {}
+    for plugin_name, plugin in active_plugins().items():
+        node, node_plugin = split_node_plugin_name(plugin_name)
+        if node_plugin == MotionDetectorCameraPlugin.plugin_name() and plugin[Process.CAMERA] is not None:
+            detectors[node] = plugin[Process.CAMERA]
+    return detectors
 
 
 class KnownPluginsCache:
@@ -47,7 +93,8 @@ class KnownPluginsCache:
                 PiCameraRootPlugin: find_plugin(PiCameraRootPlugin, Process.CAMERA),
                 StillPlugin: find_plugin(StillPlugin, Process.CAMERA),
                 TelegramRootPlugin: find_plugin(TelegramRootPlugin, Process.TELEGRAM),
-                PWMLedPlugin: find_plugin(PWMLedPlugin, Process.MAIN)
+                PWMLedPlugin: find_plugin(PWMLedPlugin, Process.MAIN),
+                MediaArchivePlugin: find_plugin(MediaArchivePlugin, Process.MAIN)
             }
 
     def _clear_plugins_cache(self):
@@ -83,6 +130,11 @@ class KnownPluginsCache:
         self._ensure_plugins_cache()
         return self._plugins_cache[PiCameraRootPlugin]
 
+    @property
+    def media_archive_plugin(self):
+        self._ensure_plugins_cache()
+        return self._plugins_cache[MediaArchivePlugin]
+
 
 @make_plugin(RATCAM_PLUGIN_NAME, Process.TELEGRAM)
 class RatcamTelegramPlugin(TelegramProcessBase, MediaReceiver, MotionDetectorResponder, KnownPluginsCache):
@@ -95,6 +147,13 @@ class RatcamTelegramPlugin(TelegramProcessBase, MediaReceiver, MotionDetectorRes
             yield from self.root_telegram_plugin.authorized_chat_ids
         elif isinstance(info, telegram.Update):
             yield info.effective_chat.id
+        elif isinstance(info, list):
+            # A clip shared by several recording sessions, send it once per chat
+            chat_ids = []
+            for session_info in info:
+                chat_ids.extend(chat_id for chat_id in self._enum_recipient_chat_ids(session_info)
+                                if chat_id not in chat_ids)
+            yield from chat_ids
 
     @property
     def motion_detection_enabled(self):
@@ -131,7 +190,7 @@ class RatcamTelegramPlugin(TelegramProcessBase, MediaReceiver, MotionDetectorRes
     def cmd_detect(self, upd, args):
         if len(args) not in (0, 1):
             return  # More than one argument is not something we handle
-        if self.motion_detector_plugin is None:
+        if len(_all_motion_detectors()) == 0:
             self.root_telegram_plugin.reply_message(upd, 'Cannot offer motion detection, the %s is not loaded.' %
                                                     MotionDetectorCameraPlugin.plugin_name())
             return
@@ -220,6 +279,62 @@ class RatcamTelegramPlugin(TelegramProcessBase, MediaReceiver, MotionDetectorRes
             self.buffered_recorder_plugin.record(info=upd, stop_after_seconds=SETTINGS.ratcam.get(
                 'video_duration', cast_to_type=float, ge=1., le=60., default=8.))
 
+    @handle_command('archive', pass_args=True)
+    def cmd_archive(self, upd, args):
+        if self.media_archive_plugin is None or self.media_archive_plugin.folder is None:
+            self.root_telegram_plugin.reply_message(upd, 'No media archive is available.')
+            return
+        kinds = None
+        limit = 10
+        for arg in args:
+            arg = arg.strip().lower()
+            if arg.isdigit():
+                limit = min(max(int(arg), 1), _MAX_ARCHIVE_ENTRIES)
+            elif arg in _ARCHIVE_KIND_ALIASES:
+                kinds = _ARCHIVE_KIND_ALIASES[arg]
+            elif arg in _KNOWN_MEDIA_KINDS:
+                kinds = [arg]
+            else:
+                self.root_telegram_plugin.reply_message(upd, 'Please specify \'photo\' or \'video\' and/or the '
+                                                             'number of entries.')
+                return
+        entries = self.media_archive_plugin.query(kinds=kinds, limit=limit)
+        if len(entries) == 0:
+            self.root_telegram_plugin.reply_message(upd, 'The archive is empty.')
+        else:
+            self.root_telegram_plugin.reply_message(upd, '\n'.join(map(_archive_entry_desc, entries)) +
+                                                    '\nUse /resend <number> to get one of them.')
+
+    @handle_command('resend', pass_args=True)
+    def cmd_resend(self, upd, args):
+        if self.media_archive_plugin is None or self.media_archive_plugin.folder is None:
+            self.root_telegram_plugin.reply_message(upd, 'No media archive is available.')
+            return
+        if len(args) != 1 or not args[0].strip().lstrip('#').isdigit():
+            self.root_telegram_plugin.reply_message(upd, 'Please specify the number of an archived media.')
+            return
+        entry = self.media_archive_plugin.get(int(args[0].strip().lstrip('#')))
+        if entry is None or not os.path.isfile(entry['path']):
+            self.root_telegram_plugin.reply_message(upd, 'There is no media #%s in the archive.' % args[0].strip())
+            return
+        _log.info('[%s] requested archived media %d.', user_desc(upd), entry['id'])
+        # noinspection PyBroadException
+        try:
+            with open(entry['path'], 'rb') as fp:
+                if entry['kind'] in _KNOWN_PHOTO_KINDS:
+                    self.root_telegram_plugin.reply_photo(upd, fp, timeout=SETTINGS.telegram.get(
+                        'photo_timeout', cast_to_type=float, ge=5., default=20.))
+                elif entry['kind'] in _KNOWN_VIDEO_KINDS:
+                    self.root_telegram_plugin.reply_video(upd, fp, timeout=SETTINGS.telegram.get(
+                        'video_timeout', cast_to_type=float, ge=5., default=60.),
+                        supports_streaming=SETTINGS.camera.get('fast_start_mp4', cast_to_type=bool, default=True))
+                else:
+                    self.root_telegram_plugin.reply_message(upd, 'Cannot send media of type %s.' % entry['kind'])
+        except OSError:
+            _log.exception('Could not load archived media %d.', entry['id'])
+        except:
+            _log.exception('Error when sending archived media %d.', entry['id'])
+
     def handle_media(self, media):
         if self.root_telegram_plugin is None or not os.path.isfile(media.path):
             return
@@ -227,30 +342,33 @@ class RatcamTelegramPlugin(TelegramProcessBase, MediaReceiver, MotionDetectorRes
         if not known_kind:
             _log.warning('Unrecognized media type %s.', media.kind)
             return
+        if media.stream == MAIN_STREAM:
+            return  # Send the smaller copy from the secondary stream instead
         recipients = self._enum_recipient_chat_ids(media.info)
         # noinspection PyBroadException
         try:
             with open(media.path, 'rb') as fp:
                 if media.kind in _KNOWN_PHOTO_KINDS:
                     self.root_telegram_plugin.broadcast_photo(recipients, fp, timeout=SETTINGS.telegram.get(
-                        'photo_timeout', cast_to_type=float, ge=5., default=20.))
+                        'photo_timeout', cast_to_type=float, ge=5., default=20.), caption=_media_caption(media))
                 elif media.kind in _KNOWN_VIDEO_KINDS:
+                    # Fast-start MP4s can be played while they are still downloading
                     self.root_telegram_plugin.broadcast_video(recipients, fp, timeout=SETTINGS.telegram.get(
-                        'video_timeout', cast_to_type=float, ge=5., default=60.))
+                        'video_timeout', cast_to_type=float, ge=5., default=60.),
+                        supports_streaming=SETTINGS.camera.get('fast_start_mp4', cast_to_type=bool, default=True),
+                        caption=_media_caption(media))
         except OSError:
             _log.exception('Could not load media file %s.', str(media.uuid))
         except:
             _log.exception('Error when sending media %s.', str(media.uuid))
 
-    def _motion_status_changed_internal(self, is_moving):
+    def _motion_status_changed_internal(self, is_moving, node=None):
         if self.root_telegram_plugin is None or not self.motion_detection_enabled:
             return
-        if is_moving:
-            self.root_telegram_plugin.broadcast_message(self.root_telegram_plugin.authorized_chat_ids,
-                                                        'Something is moving...')
-        else:
-            self.root_telegram_plugin.broadcast_message(self.root_telegram_plugin.authorized_chat_ids,
-                                                        'Everything quiet.')
+        message = 'Something is moving...' if is_moving else 'Everything quiet.'
+        if node is not None:
+            message = '%s: %s' % (node, message)
+        self.root_telegram_plugin.broadcast_message(self.root_telegram_plugin.authorized_chat_ids, message)
 
 
 @make_plugin(RATCAM_PLUGIN_NAME, Process.MAIN)
@@ -259,6 +377,8 @@ class RatcamMainPlugin(PluginProcessBase, MotionDetectorResponder, KnownPluginsC
         super(RatcamMainPlugin, self).__init__()
         self._motion_detection_enabled = False
         self._manual_recording = False
+        # Recording session started on motion, by camera node, None for the local camera
+        self._motion_session_ids = {}
 
     def __enter__(self):
         super(RatcamMainPlugin, self).__enter__()
@@ -286,29 +406,49 @@ class RatcamMainPlugin(PluginProcessBase, MotionDetectorResponder, KnownPluginsC
     @pyro_expose
     @motion_detection_enabled.setter
     def motion_detection_enabled(self, enabled):
-        if self.motion_detector_plugin is None:
+        # The local camera and the camera nodes are watched together
+        detectors = _all_motion_detectors()
+        if len(detectors) == 0:
             _log.warning('Attempt to change motion detection with no %s.' % MotionDetectorCameraPlugin.plugin_name())
             return
-        if not self._motion_detection_enabled and enabled and self.motion_detector_plugin.triggered:
+        enabled = bool(enabled)
+        if enabled == self._motion_detection_enabled:
+            return
+        triggered_nodes = [node for node, detector in detectors.items() if detector.triggered]
+        # Responders ignore motion while detection is off: turn it on before notifying, and off after
+        if enabled:
             self._motion_detection_enabled = True
+        for node in triggered_nodes:
             for plugin_instance in find_plugin(self).nonempty_values():
-                plugin_instance.motion_status_changed(True)
-        elif self._motion_detection_enabled and not enabled and self.motion_detector_plugin.triggered:
-            for plugin_instance in find_plugin(self).nonempty_values():
-                plugin_instance.motion_status_changed(False)
-            self._motion_detection_enabled = False
-        else:
-            self._motion_detection_enabled = enabled
+                plugin_instance.motion_status_changed(enabled, node)
+        self._motion_detection_enabled = enabled
+        for node in detectors.keys():
+            root_picamera_plugin = _find_camera_plugin(node, PiCameraRootPlugin)
+            if root_picamera_plugin is None:
+                continue
+            # Motion detection needs the encoder to run, also when nothing is recorded
+            if enabled:
+                root_picamera_plugin.acquire_encoder(MotionDetectorCameraPlugin.plugin_name())
+            else:
+                root_picamera_plugin.release_encoder(MotionDetectorCameraPlugin.plugin_name())
 
-    def _motion_status_changed_internal(self, is_moving):
+    def _motion_status_changed_internal(self, is_moving, node=None):
         if not self.motion_detection_enabled:
             return
-        assert self.motion_detector_plugin is not None
+        motion_detector_plugin = _find_camera_plugin(node, MotionDetectorCameraPlugin)
+        if motion_detector_plugin is None:
+            _log.error('Cannot find the %s of node %s.', MotionDetectorCameraPlugin.plugin_name(), str(node))
+            return
         if is_moving:
-            self.motion_detector_plugin.take_motion_picture()
-        if self.buffered_recorder_plugin is not None:
-            if self.is_recording and not is_moving and not self.is_recording_manually:
-                self.buffered_recorder_plugin.stop_and_finalize()
-            elif not self.is_recording and is_moving:
-                self.set_manual_recording(False)
-                self.buffered_recorder_plugin.record()
+            motion_detector_plugin.take_motion_picture()
+        buffered_recorder_plugin = _find_camera_plugin(node, BufferedRecorderPlugin)
+        if buffered_recorder_plugin is not None:
+            # Motion has its own recording session on every camera, which can overlap with the manual ones
+            session_id = self._motion_session_ids.get(node)
+            if not is_moving and session_id is not None:
+                buffered_recorder_plugin.stop_and_finalize(session_id)
+                del self._motion_session_ids[node]
+            elif is_moving and session_id is None:
+                if node is None and not self.is_recording:
+                    self.set_manual_recording(False)
+                self._motion_session_ids[node] = buffered_recorder_plugin.record()
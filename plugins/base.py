@@ -13,6 +13,29 @@ class Process(Enum):
 
 
 AVAILABLE_PROCESSES = [e.value for e in Process]
+NODE_SEPARATOR = '/'
+
+
+def node_plugin_name(node, plugin_name):
+    """
+    :return: The name under which the central host lists a plugin of the camera node `node`, or plugin_name if node is
+    None, i.e. the plugin is local.
+    """
+    return plugin_name if node is None else node + NODE_SEPARATOR + plugin_name
+
+
+def is_node_plugin_name(plugin_name):
+    return NODE_SEPARATOR in plugin_name
+
+
+def split_node_plugin_name(plugin_name):
+    """
+    :return: The node and the plugin name on the node, the inverse of `node_plugin_name`.
+    """
+    if not is_node_plugin_name(plugin_name):
+        return None, plugin_name
+    node, plugin_name = plugin_name.split(NODE_SEPARATOR, 1)
+    return node, plugin_name
 
 
 class ProcessPack:
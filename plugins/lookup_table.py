@@ -1,4 +1,4 @@
-from plugins.base import Process, AVAILABLE_PROCESSES, PluginProcessBase, ProcessPack
+from plugins.base import Process, AVAILABLE_PROCESSES, PluginProcessBase, ProcessPack, is_node_plugin_name
 from plugins.singleton_host import SingletonHost
 import inspect
 
@@ -56,8 +56,9 @@ class PluginLookupTable:
         return self._plugins.keys()
 
     def _replace_local_instances(self, process):
-        for plugin in self._plugins.values():
-            if plugin[process] is None:
+        for plugin_name, plugin in self._plugins.items():
+            # Plugins of other nodes are never local, and their ids may clash with the local ones
+            if plugin[process] is None or is_node_plugin_name(plugin_name):
                 continue
             # Try to get the id and replace
             plugin_id = plugin[process].get_remote_id()
@@ -26,13 +26,14 @@ class PluginHost:
         """
         return self._plugin_process_instances
 
-    def __init__(self, plugin_process_instance_types, socket, name=None):
+    def __init__(self, plugin_process_instance_types, socket, name=None, **kwargs):
         """
         :param plugin_process_instance_types: a dict object that maps the plugin name to the singleton type to
         instantiate for this plugin.
-        :param socket: socket path for the hosting process.
+        :param socket: socket path for the hosting process, None to bind to TCP.
         :param name: name of the hosting process.
+        :param kwargs: TCP options, see `SingletonHost`.
         """
         self._plugin_process_instance_types = dict(plugin_process_instance_types)
         self._plugin_process_instances = {k: None for k in self._plugin_process_instance_types}
-        self._host = SingletonHost(socket, name=name)
+        self._host = SingletonHost(socket, name=name, **kwargs)
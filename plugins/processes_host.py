@@ -1,14 +1,44 @@
 from tempfile import TemporaryDirectory
-from plugins.base import Process, ProcessPack
+from plugins.base import Process, ProcessPack, node_plugin_name
 from plugins.plugin_host import PluginHost
 from plugins.lookup_table import PluginLookupTable
-from Pyro4 import expose as pyro_expose
+from Pyro4 import expose as pyro_expose, URI as PyroURI
+import Pyro4
 from misc.settings import SETTINGS
+from misc.logging import ensure_logging_setup
+from socket import gethostbyname
+import ipaddress
+import logging
 import os
 
 
+ensure_logging_setup()
+_log = logging.getLogger('processes_host')
+
 _ACTIVE_PROCESS = None
 _ACTIVE_PLUGINS = None
+_ACTIVE_NODE = None
+
+
+def _min_threadpool_size(num_plugins, num_nodes):
+    # Every proxy connected to a Pyro server holds one of its worker threads. The other processes of this host, and
+    # every node, hold at least one proxy to each plugin of a process, and one to its server.
+    return (num_plugins + 1) * (len(Process) - 1 + num_nodes)
+
+
+def _check_bind_address(host):
+    """
+    Raises ValueError if there is no address to bind to, and warns if it is reachable only from this machine.
+    """
+    if host is None:
+        raise ValueError('With nodes, set nodes.host to an address of this machine that the other machines can reach.')
+    try:
+        is_loopback = ipaddress.ip_address(gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        _log.warning('Unable to resolve the bind address %s.', host)
+        return
+    if is_loopback:
+        _log.warning('Binding to %s, which no other machine can reach.', host)
 
 
 def active_process():
@@ -16,6 +46,14 @@ def active_process():
     return _ACTIVE_PROCESS
 
 
+def active_node():
+    """
+    :return: The name of the camera node running this process, None on the central host.
+    """
+    global _ACTIVE_NODE
+    return _ACTIVE_NODE
+
+
 def active_plugins():
     global _ACTIVE_PLUGINS
     return _ACTIVE_PLUGINS
@@ -30,40 +68,59 @@ class ProcessesHost:
 
     class _Housekeeper:
         @pyro_expose
-        def setup(self, process, plugins):
-            global _ACTIVE_PROCESS, _ACTIVE_PLUGINS
+        def setup(self, process, plugins, node=None):
+            global _ACTIVE_PROCESS, _ACTIVE_PLUGINS, _ACTIVE_NODE
             if _ACTIVE_PROCESS is not None or _ACTIVE_PLUGINS is not None:  # pragma: no cover
                 raise RuntimeError('More than one PluginHost are using the same process!')
             assert isinstance(process, Process), 'You should be serializing using pickle on Pyro!'
             _ACTIVE_PROCESS = process
             _ACTIVE_PLUGINS = PluginLookupTable(plugins, process)
+            _ACTIVE_NODE = node
 
         @pyro_expose
         def teardown(self):
-            global _ACTIVE_PROCESS, _ACTIVE_PLUGINS
+            global _ACTIVE_PROCESS, _ACTIVE_PLUGINS, _ACTIVE_NODE
             if _ACTIVE_PROCESS is None or _ACTIVE_PLUGINS is None:  # pragma: no cover
                 raise RuntimeError('More than one PluginHost are using the same process!')
             _ACTIVE_PROCESS = None
             _ACTIVE_PLUGINS = None
+            _ACTIVE_NODE = None
 
     @classmethod
-    def _create_host(cls, socket_dir, plugin_definitions, process):
+    def _create_host(cls, socket_dir, plugin_definitions, process, **kwargs):
         """
         Creates a PluginProcessHost bound to a socket in socket_dir/process.sock, hosting plugin_definitions.
-        :param socket_dir: Path to a folder where to set up a socket for this process.
+        :param socket_dir: Path to a folder where to set up a socket for this process, None to bind to TCP.
         :param plugin_definitions: A dict object that maps the plugin name to the a ProcessPack of PluginProcessInstanceBase
         subclasses. Only the entry corresponding to process will be instantiated.
         :param process: Process to instatiate.
+        :param kwargs: TCP options, see `SingletonHost`.
         :return: An instance of PluginProcessHost that will instantiate such PluginProcessInstanceBase subclasses upon
         context acquisition.
         """
         # Will not be created until host.__enter__
-        socket = os.path.join(socket_dir, process.value + '.sock')
+        socket = None if socket_dir is None else os.path.join(socket_dir, process.value + '.sock')
         # Plugin name -> plugin process instance type map
         plugin_process_instance_types = {plugin_name: plugin_types_pack[process]
                                          for plugin_name, plugin_types_pack in plugin_definitions.items()}
         # Instantiate it and give it the name explicitly
-        return PluginHost(plugin_process_instance_types, socket=socket, name=process.value)
+        return PluginHost(plugin_process_instance_types, socket=socket, name=process.value, **kwargs)
+
+    def _attach_nodes(self):
+        for node, address in self._nodes.items():
+            directory = Pyro4.Proxy('PYRO:%s@%s' % (NodeHost.NodeDirectory.__name__, address))
+            directory._pyroHmacKey = self._hmac_key
+            node_plugin_instances = directory.plugin_instances
+            self._node_housekeepers[node] = directory.housekeeper
+            # The node sees the MAIN and TELEGRAM plugins of this host as its own
+            node_view = {}
+            for plugin_name in self._local_plugin_names + list(node_plugin_instances.keys()):
+                local_plugin_pack = self._plugin_instances.get(plugin_name) or ProcessPack()
+                node_view[plugin_name] = ProcessPack(main=local_plugin_pack.main, telegram=local_plugin_pack.telegram,
+                                                     camera=node_plugin_instances.get(plugin_name))
+            self._node_housekeepers[node].setup(Process.CAMERA, node_view, node)
+            for plugin_name, plugin_instance in node_plugin_instances.items():
+                self._plugin_instances[node_plugin_name(node, plugin_name)] = ProcessPack(camera=plugin_instance)
 
     def _activate_all_plugin_process_instances(self):
         for plugin_instance_pack in self.plugin_instances.values():
@@ -95,6 +152,13 @@ class ProcessesHost:
             self._plugin_instances[plugin_name] = ProcessPack(*[
                 self._plugin_process_host_pack[process].plugin_instances[plugin_name] for process in Process
             ])
+        # List the plugins of the camera nodes under their namespaced name
+        try:
+            self._attach_nodes()
+        except:
+            self._detach_nodes()
+            self._shutdown_hosts(None, None, None)
+            raise
         # Change the running process variable in the remote process and publish a list of plugins
         for process, host in self._plugin_process_host_pack.items():
             self._housekeepers[process] = host.singleton_host(ProcessesHost._Housekeeper)
@@ -110,9 +174,21 @@ class ProcessesHost:
         for process in Process:
             self._housekeepers[process].teardown()
             self._housekeepers[process] = None
+        self._detach_nodes()
         # Destroy all plugins
-        for plugin_name in self._plugin_instances.keys():
+        for plugin_name in self._local_plugin_names:
             self._plugin_instances[plugin_name] = None
+        self._shutdown_hosts(exc_type, exc_val, exc_tb)
+
+    def _detach_nodes(self):
+        # The nodes keep running, and can be attached again
+        for node in list(self._node_housekeepers.keys()):
+            self._node_housekeepers.pop(node).teardown()
+        for plugin_name in list(self._plugin_instances.keys()):
+            if plugin_name not in self._local_plugin_names:
+                del self._plugin_instances[plugin_name]
+
+    def _shutdown_hosts(self, exc_type, exc_val, exc_tb):
         # Deactivate all hosts
         for host in self._plugin_process_host_pack.values():
             host.singleton_host.initiate_shutdown()
@@ -121,17 +197,103 @@ class ProcessesHost:
         # Destroy all dirs
         self._socket_dir.__exit__(exc_type, exc_val, exc_tb)
 
-    def __init__(self, plugins):
+    def __init__(self, plugins, nodes=None, host=None, hmac_key=None, threadpool_size=None):
         """
         :param plugins: dict-like object that maps plugin name in the process instance types. The key type is string,
         and the value type is a ProcessPack containing three types, subclasses of PluginProcessInstanceBase. Is it ok
         for the ProcessPack to contain None entries. For example
             plugins = {'root_plugin': ProcessPack(None, None, MySubclassOfPluginProcessInstanceBase)}
+        :param nodes: dict that maps node names to the 'host:port' addresses of running `NodeHost`s. The plugins of a
+        node are listed as `node_plugin_name(node, plugin_name)`, and the node sees the MAIN and TELEGRAM plugins of this
+        host as its own.
+        :param host: when there are nodes, all processes bind to TCP ports on this address, which the nodes must reach.
+        :param hmac_key: the key shared with the nodes, see `SingletonHost`.
+        :param threadpool_size: when there are nodes, the maximum number of concurrent connections to each process, None
+        for the Pyro default. Raises ValueError if it is too small for the number of nodes.
         """
+        self._nodes = dict(nodes or {})
+        if len(self._nodes) > 0:
+            _check_bind_address(host)
+            if threadpool_size is None:
+                threadpool_size = Pyro4.config.THREADPOOL_SIZE
+            min_threadpool_size = _min_threadpool_size(len(plugins), len(self._nodes))
+            if threadpool_size < min_threadpool_size:
+                raise ValueError('A thread pool of %d is too small for %d nodes, set nodes.threadpool_size to at least '
+                                 '%d.' % (threadpool_size, len(self._nodes), min_threadpool_size))
         self._socket_dir = TemporaryDirectory(dir=SETTINGS.get('temp_folder', cast_to_type=str, allow_none=True))
+        self._local_plugin_names = list(plugins.keys())
         self._plugin_instances = dict({k: None for k in plugins})
+        self._hmac_key = hmac_key
+        self._node_housekeepers = {}
+        socket_dir = self._socket_dir.name
+        tcp_options = {}
+        if len(self._nodes) > 0:
+            socket_dir = None
+            tcp_options = dict(host=host, hmac_key=hmac_key, threadpool_size=threadpool_size)
         self._plugin_process_host_pack = ProcessPack(*[
-            self.__class__._create_host(self._socket_dir.name, plugins, process)
+            self.__class__._create_host(socket_dir, plugins, process, **tcp_options)
             for process in Process
         ])
         self._housekeepers = ProcessPack()
+
+
+class NodeHost:
+    """
+    Hosts the CAMERA process of a camera-only node on a TCP port, for a central `ProcessesHost` to attach to. The node
+    plugins are created right away, but are active only while a central host is attached.
+    """
+    class NodeDirectory:
+        def __init__(self):
+            self._plugin_instances = {}
+            self._housekeeper = None
+
+        @pyro_expose
+        def publish(self, plugin_instances, housekeeper):
+            self._plugin_instances = plugin_instances
+            self._housekeeper = housekeeper
+
+        @pyro_expose
+        @property
+        def plugin_instances(self):
+            return self._plugin_instances
+
+        @pyro_expose
+        @property
+        def housekeeper(self):
+            return self._housekeeper
+
+    @property
+    def address(self):
+        """
+        :return: The 'host:port' address to attach to.
+        """
+        uri = PyroURI(self._host.singleton_host.uri)
+        return '%s:%d' % (uri.host, uri.port)
+
+    @property
+    def plugin_instances(self):
+        return self._host.plugin_instances
+
+    def __enter__(self):
+        self._host.__enter__()
+        directory = self._host.singleton_host(NodeHost.NodeDirectory)
+        directory.publish({plugin_name: plugin_instance
+                           for plugin_name, plugin_instance in self._host.plugin_instances.items()
+                           if plugin_instance is not None},
+                          self._host.singleton_host(ProcessesHost._Housekeeper))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._host.singleton_host.initiate_shutdown()
+        self._host.__exit__(exc_type, exc_val, exc_tb)
+
+    def __init__(self, plugins, host, port=0, hmac_key=None):
+        """
+        :param plugins: same as for `ProcessesHost`, only the CAMERA plugins are instantiated.
+        :param host: the address to bind to, which the central host must reach.
+        :param port: the TCP port, 0 for any free one.
+        :param hmac_key: the key shared with the central host, see `SingletonHost`.
+        """
+        _check_bind_address(host)
+        self._host = ProcessesHost._create_host(None, plugins, Process.CAMERA, host=host, port=port,
+                                                hmac_key=hmac_key)
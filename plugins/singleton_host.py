@@ -66,10 +66,18 @@ class SingletonHost:
             self._hosted_singletons = []
 
         @staticmethod
-        def server_main(socket, transmit_sync, name='SingletonServer'):
-            if os.path.exists(socket):  # pragma: no cover
-                os.remove(socket)
-            daemon = PyroDaemon(unixsocket=socket)
+        def server_main(socket, transmit_sync, name='SingletonServer', host=None, port=0, hmac_key=None,
+                        threadpool_size=None):
+            if threadpool_size is not None:
+                # Every connected proxy holds a worker thread
+                Pyro4.config.THREADPOOL_SIZE = threadpool_size
+            if socket is None:
+                daemon = PyroDaemon(host=host, port=port)
+            else:
+                if os.path.exists(socket):  # pragma: no cover
+                    os.remove(socket)
+                daemon = PyroDaemon(unixsocket=socket)
+            daemon._pyroHmacKey = hmac_key
             uri = daemon.register(SingletonHost._SingletonServer(daemon, name=name), name)
             _log.debug('%s: serving at %s', name, uri)
             transmit_sync.transmit(str(uri))
@@ -84,18 +92,34 @@ class SingletonHost:
     def local_singletons_by_id(cls):
         return cls._LOCAL_SINGLETONS_BY_ID
 
+    def make_proxy(self, uri):
+        """
+        :return: A proxy to the object at uri, with the HMAC key of this host.
+        """
+        proxy = PyroProxy(uri)
+        proxy._pyroHmacKey = self._hmac_key
+        return proxy
+
+    @property
+    def uri(self):
+        """
+        :return: The URI of the server, which tells the address it is bound to.
+        """
+        return self._uri
+
     def __enter__(self):
         receiver, transmitter = create_sync_pair()
         self._process = Process(target=SingletonHost._SingletonServer.server_main,
-                                args=(self._socket, transmitter, self._name + 'Server'),
+                                args=(self._socket, transmitter, self._name + 'Server', self._host, self._port,
+                                      self._hmac_key, self._threadpool_size),
                                 name=self._name)
         self._process.start()
         _log.debug('%s: waiting for server', self._name)
-        uri = receiver.receive()
-        self._instance = PyroProxy(uri)
+        self._uri = receiver.receive()
+        self._instance = self.make_proxy(self._uri)
         # Default serpent serializer does not trasmit a class
         self._instance._pyroSerializer = 'pickle'
-        _log.debug('%s: obtained proxy at %s', self._name, uri)
+        _log.debug('%s: obtained proxy at %s', self._name, self._uri)
         return self
 
     def initiate_shutdown(self):
@@ -115,7 +139,8 @@ class SingletonHost:
         else:
             _log.debug('%s: server joined', self._name)
         self._process = None
-        if os.path.exists(self._socket):
+        self._uri = None
+        if self._socket is not None and os.path.exists(self._socket):
             os.remove(self._socket)
 
     def __call__(self, singleton_cls):
@@ -127,10 +152,23 @@ class SingletonHost:
         if self._instance._pyroSerializer != 'pickle':  # pragma: no cover
             raise RuntimeError('Cannot transmit classes to create through %s. Please use pickle' %
                                str(self._instance._pyroSerializer))
-        return PyroProxy(self._instance.register(singleton_cls))
-
-    def __init__(self, socket, name=None):
+        return self.make_proxy(self._instance.register(singleton_cls))
+
+    def __init__(self, socket, name=None, host=None, port=0, hmac_key=None, threadpool_size=None):
+        """
+        :param socket: path of the Unix socket the server binds to. If None, the server binds to a TCP port instead.
+        :param host: host name or address of the TCP port, when socket is None.
+        :param port: the TCP port, 0 for any free one.
+        :param hmac_key: if set, Pyro signs every message with this key, and rejects the unsigned ones. Pickle is
+        unsafe on a network, set this whenever binding to TCP.
+        :param threadpool_size: maximum number of concurrent connections to the server.
+        """
         self._socket = socket
+        self._host = host
+        self._port = port
+        self._hmac_key = hmac_key
+        self._threadpool_size = threadpool_size
         self._process = None
         self._instance = None
+        self._uri = None
         self._name = self.__class__.__name__ if name is None else name
@@ -1,10 +1,11 @@
 import unittest
 import os
 from Pyro4 import expose as pyro_expose
+from Pyro4.errors import PyroError
 from plugins.singleton_host import SingletonHost
 from tempfile import TemporaryDirectory
-from plugins.base import ProcessPack, Process, PluginProcessBase, AVAILABLE_PROCESSES
-from plugins.processes_host import ProcessesHost, active_process, find_plugin
+from plugins.base import ProcessPack, Process, PluginProcessBase, AVAILABLE_PROCESSES, node_plugin_name
+from plugins.processes_host import ProcessesHost, NodeHost, active_process, active_node, find_plugin
 from plugins.decorators import make_plugin, get_all_plugins
 from plugins.lookup_table import PluginLookupTable
 
@@ -153,6 +154,68 @@ class TestPluginProcess(unittest.TestCase):
                     self.assertEqual(pid_set, pid_sets[0])
 
 
+class TestNodes(unittest.TestCase):
+    class NodeProcess(TestPluginProcess.TestProcess):
+        @pyro_expose
+        def get_active_node(self):
+            return active_node()
+
+    HMAC_KEY = 'test_nodes'
+
+    def test_node_plugin_name(self):
+        self.assertEqual(node_plugin_name(None, 'main'), 'main')
+        self.assertEqual(node_plugin_name('kitchen', 'main'), 'kitchen/main')
+
+    def test_attach_nodes(self):
+        plugins = {
+            'main': ProcessPack(TestNodes.NodeProcess, TestNodes.NodeProcess, TestNodes.NodeProcess)
+        }
+        with NodeHost(plugins, '127.0.0.1', hmac_key=TestNodes.HMAC_KEY) as kitchen, \
+                NodeHost(plugins, '127.0.0.1', hmac_key=TestNodes.HMAC_KEY) as garden:
+            nodes = {'kitchen': kitchen.address, 'garden': garden.address}
+            with ProcessesHost(plugins, nodes=nodes, host='127.0.0.1', hmac_key=TestNodes.HMAC_KEY) as processes:
+                local_pack = processes.plugin_instances['main']
+                self.assertIsNone(local_pack.camera.get_active_node())
+                central_pids = {local_pack.main.get_remote_pid(), local_pack.telegram.get_remote_pid()}
+                node_pids = set()
+                for node in nodes.keys():
+                    node_pack = processes.plugin_instances[node_plugin_name(node, 'main')]
+                    self.assertIsNone(node_pack.main)
+                    self.assertIsNone(node_pack.telegram)
+                    self.assertEqual(node_pack.camera.get_active_node(), node)
+                    node_pid = node_pack.camera.get_remote_pid()
+                    node_pids.add(node_pid)
+                    # The node sees the central MAIN and TELEGRAM processes as its own
+                    self.assertEqual(node_pack.camera.get_sibling_pid_set(), central_pids | {node_pid})
+                self.assertEqual(len(node_pids), 2)
+                self.assertNotIn(local_pack.camera.get_remote_pid(), node_pids)
+            self.assertNotIn(node_plugin_name('kitchen', 'main'), processes.plugin_instances)
+            # The nodes can be attached again
+            with ProcessesHost(plugins, nodes=nodes, host='127.0.0.1', hmac_key=TestNodes.HMAC_KEY) as processes:
+                self.assertEqual(processes.plugin_instances[node_plugin_name('garden', 'main')].camera.get_active_node(),
+                                 'garden')
+
+    def test_requires_bind_address(self):
+        plugins = {'main': ProcessPack(camera=TestNodes.NodeProcess)}
+        with self.assertRaises(ValueError):
+            NodeHost(plugins, None)
+        with self.assertRaises(ValueError):
+            ProcessesHost(plugins, nodes={'kitchen': '127.0.0.1:9090'})
+
+    def test_threadpool_too_small(self):
+        plugins = {'main': ProcessPack(camera=TestNodes.NodeProcess)}
+        nodes = {'kitchen': '127.0.0.1:9090', 'garden': '127.0.0.1:9091'}
+        with self.assertRaises(ValueError):
+            ProcessesHost(plugins, nodes=nodes, host='127.0.0.1', threadpool_size=4)
+
+    def test_wrong_hmac_key(self):
+        plugins = {'main': ProcessPack(camera=TestNodes.NodeProcess)}
+        with NodeHost(plugins, '127.0.0.1', hmac_key=TestNodes.HMAC_KEY) as kitchen:
+            with self.assertRaises(PyroError):
+                with ProcessesHost(plugins, nodes={'kitchen': kitchen.address}, host='127.0.0.1', hmac_key='wrong'):
+                    pass  # pragma: no cover
+
+
 class TestPluginDecorator(unittest.TestCase):
     @make_plugin('TestPluginDecorator', Process.MAIN)
     class DecoratedProcess(PluginProcessBase):
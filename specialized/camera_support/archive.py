@@ -0,0 +1,128 @@
+from array import array
+from bisect import bisect_right
+from threading import Lock
+import logging
+import os
+import re
+
+
+_log = logging.getLogger('archive')
+SEGMENT_EXTENSION = '.mp4'
+PARTIAL_SEGMENT_EXTENSION = '.mp4.part'
+_SEGMENT_NAME_RE = re.compile(r'^segment_(\d+)_(\d+)\.mp4$')
+_PARTIAL_SEGMENT_NAME_RE = re.compile(r'^segment_(\d+)\.mp4\.part$')
+
+
+def segment_name(start_time, end_time=None):
+    """
+    :return: The file name of a segment spanning from start_time to end_time (seconds since the epoch), or of a segment
+    that is still being recorded if end_time is None.
+    """
+    if end_time is None:
+        return 'segment_%d%s' % (int(start_time * 1000), PARTIAL_SEGMENT_EXTENSION)
+    return 'segment_%d_%d%s' % (int(start_time * 1000), int(end_time * 1000), SEGMENT_EXTENSION)
+
+
+class SegmentIndex:
+    """
+    Time index of the video segments in an archive folder. Start times, end times (seconds since the epoch) and sizes
+    are kept in sorted `array` buffers, so that the segments covering any instant are found by bisection.
+    """
+
+    def __init__(self, folder):
+        self._folder = folder
+        self._start_times = array('d')
+        self._end_times = array('d')
+        self._sizes = array('Q')
+        self._names = []
+        self._lock = Lock()
+
+    @property
+    def folder(self):
+        return self._folder
+
+    @property
+    def num_segments(self):
+        return len(self._names)
+
+    @property
+    def total_size(self):
+        return sum(self._sizes)
+
+    @property
+    def start_time(self):
+        return self._start_times[0] if len(self._start_times) > 0 else None
+
+    @property
+    def end_time(self):
+        return max(self._end_times) if len(self._end_times) > 0 else None
+
+    def scan(self):
+        """
+        Rebuilds the index from the content of the folder. Segments that were being recorded when the process stopped
+        are closed using their modification time as end time.
+        """
+        with self._lock:
+            self._start_times = array('d')
+            self._end_times = array('d')
+            self._sizes = array('Q')
+            self._names = []
+        for entry in sorted(os.listdir(self._folder)):
+            path = os.path.join(self._folder, entry)
+            match = _PARTIAL_SEGMENT_NAME_RE.match(entry)
+            if match is not None:
+                start_time = int(match.group(1)) / 1000.
+                end_time = max(start_time, os.path.getmtime(path))
+                entry = segment_name(start_time, end_time)
+                _log.info('Recovering partial segment %s as %s.', path, entry)
+                os.rename(path, os.path.join(self._folder, entry))
+            match = _SEGMENT_NAME_RE.match(entry)
+            if match is None:
+                continue
+            self.add(entry, int(match.group(1)) / 1000., int(match.group(2)) / 1000.,
+                     os.path.getsize(os.path.join(self._folder, entry)))
+
+    def add(self, name, start_time, end_time, size):
+        with self._lock:
+            i = bisect_right(self._start_times, start_time)
+            self._start_times.insert(i, start_time)
+            self._end_times.insert(i, end_time)
+            self._sizes.insert(i, size)
+            self._names.insert(i, name)
+
+    def find(self, start_time, end_time=None):
+        """
+        :return: The paths of the segments that overlap [start_time, end_time], oldest first. If end_time is None,
+        the segment containing start_time.
+        """
+        if end_time is None:
+            end_time = start_time
+        with self._lock:
+            # Segments are contiguous and do not overlap, so only the one right before start_time can still cover it
+            first = max(0, bisect_right(self._start_times, start_time) - 1)
+            last = bisect_right(self._start_times, end_time)
+            return [os.path.join(self._folder, self._names[i]) for i in range(first, last)
+                    if self._end_times[i] >= start_time]
+
+    def evict(self, max_bytes):
+        """
+        Removes the oldest segments until the total size is within max_bytes. The newest segment is never removed.
+        :return: The number of segments removed.
+        """
+        num_evicted = 0
+        while True:
+            with self._lock:
+                if len(self._names) <= 1 or sum(self._sizes) <= max_bytes:
+                    break
+                name = self._names.pop(0)
+                self._start_times.pop(0)
+                self._end_times.pop(0)
+                self._sizes.pop(0)
+            path = os.path.join(self._folder, name)
+            _log.debug('Evicting segment %s.', path)
+            try:
+                os.remove(path)
+            except OSError:  # pragma: no cover
+                _log.exception('Unable to remove %s.', path)
+            num_evicted += 1
+        return num_evicted
@@ -0,0 +1,103 @@
+from threading import Lock
+
+
+class WriteStats:
+    """
+    Counts the writes that reach the underlying files, and the bytes written.
+    """
+
+    def __init__(self):
+        self._num_writes = 0
+        self._num_bytes = 0
+        self._lock = Lock()
+
+    def record(self, num_bytes):
+        with self._lock:
+            self._num_writes += 1
+            self._num_bytes += num_bytes
+
+    def reset(self):
+        with self._lock:
+            self._num_writes = 0
+            self._num_bytes = 0
+
+    @property
+    def num_writes(self):
+        return self._num_writes
+
+    @property
+    def num_bytes(self):
+        return self._num_bytes
+
+    @property
+    def bytes_per_write(self):
+        with self._lock:
+            return 0. if self._num_writes == 0 else self._num_bytes / self._num_writes
+
+    def to_dict(self):
+        return {'num_writes': self.num_writes, 'num_bytes': self.num_bytes, 'bytes_per_write': self.bytes_per_write}
+
+
+WRITE_STATS = WriteStats()
+
+
+class BlockWriter:
+    """
+    Write-combining wrapper around an (unbuffered) binary file. Data is collected in memory and written in multiples of
+    `block_size` bytes, such that every write ends on a block boundary of the file. Pending data is written on `flush`,
+    and before any `seek`, `tell` or `truncate`. A `block_size` of 0 forwards every write as is.
+    """
+
+    def __init__(self, fp, block_size=64 * 1024, stats=None):
+        self._fp = fp
+        self._block_size = block_size
+        self._stats = WRITE_STATS if stats is None else stats
+        self._buffer = bytearray()
+        self._position = fp.tell()
+
+    @property
+    def block_size(self):
+        return self._block_size
+
+    @property
+    def num_pending_bytes(self):
+        return len(self._buffer)
+
+    def _write_to_file(self, data):
+        data = memoryview(data)
+        while len(data) > 0:
+            num_written = self._fp.write(data)
+            self._stats.record(num_written)
+            data = data[num_written:]
+
+    def write(self, data):
+        if self._block_size <= 0:
+            self._write_to_file(data)
+            self._position += len(data)
+            return len(data)
+        self._buffer += data
+        self._position += len(data)
+        # Write everything up to the last block boundary that is covered
+        num_bytes = len(self._buffer) - self._position % self._block_size
+        if num_bytes > 0:
+            self._write_to_file(self._buffer[:num_bytes])
+            del self._buffer[:num_bytes]
+        return len(data)
+
+    def flush(self):
+        if len(self._buffer) > 0:
+            self._write_to_file(self._buffer)
+            self._buffer = bytearray()
+        self._fp.flush()
+
+    def seek(self, offset, *args):
+        self.flush()
+        self._position = self._fp.seek(offset, *args)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def truncate(self, size=None):
+        self.flush()
+        return self._fp.truncate(size)
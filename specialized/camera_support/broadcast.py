@@ -0,0 +1,63 @@
+from threading import Condition
+
+
+class LatestFrameBroadcaster:
+    """
+    Hands the last complete frame of a stream to any number of consumers, each in its own thread. Publishing a frame
+    costs the same whatever the number of consumers. A consumer slower than the stream skips frames: it always gets the
+    latest one, and never holds back the producer or the other consumers.
+    """
+
+    def __init__(self):
+        self._condition = Condition()
+        self._partial_frame = []
+        self._frame = None
+        self._frame_number = 0
+        self._closed = False
+
+    def append(self, data, complete=True):
+        """
+        Appends data to the frame being written, and publishes the frame if complete. Only the producer calls this.
+        """
+        if not complete:
+            self._partial_frame.append(data)
+            return
+        if len(self._partial_frame) > 0:
+            self._partial_frame.append(data)
+            data = b''.join(self._partial_frame)
+            self._partial_frame = []
+        with self._condition:
+            self._frame = data
+            self._frame_number += 1
+            self._condition.notify_all()
+
+    def discard_partial_frame(self):
+        self._partial_frame = []
+
+    def wait_for_frame(self, last_frame_number=0, timeout=None):
+        """
+        :param last_frame_number: the number of the last frame the consumer got, 0 for none.
+        :return: A (frame_number, frame) pair with the latest frame, as soon as it is newer than last_frame_number, or
+        None upon timeout or if the broadcaster is closed. Frame numbers start at 1.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._closed or self._frame_number > last_frame_number, timeout)
+            if self._closed or self._frame_number <= last_frame_number:
+                return None
+            return self._frame_number, self._frame
+
+    @property
+    def frame_number(self):
+        return self._frame_number
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        """
+        Wakes up all the consumers, which get None from now on.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
@@ -0,0 +1,195 @@
+from threading import Lock
+from collections import deque
+from safe_picamera import PiVideoFrameType
+
+
+LATE_FACTOR = 1.5  # an interval longer than this many frame periods means a dropped or late frame
+
+
+class RollingStats:
+    """
+    Mean and maximum of the last `size` values pushed.
+    """
+
+    def __init__(self, size=256):
+        self._values = deque(maxlen=size)
+
+    def push(self, value):
+        self._values.append(value)
+
+    def reset(self):
+        self._values.clear()
+
+    @property
+    def mean(self):
+        return None if len(self._values) == 0 else sum(self._values) / len(self._values)
+
+    @property
+    def max(self):
+        return None if len(self._values) == 0 else max(self._values)
+
+    def to_dict(self):
+        return {'mean': self.mean, 'max': self.max}
+
+
+class FrameStats:
+    """
+    Detects dropped, late and stalled frames from the PiVideoFrame of the writes of an encoder, and from the times of
+    the motion analysis callbacks. The timestamps of the frames (microseconds, from the camera clock) reveal the frames
+    that the camera dropped; arrival times (seconds, monotonic) reveal the frames that reached the CAMERA process late.
+    The frame index counts also SPS headers and motion data, so it is only used to detect a restart of the encoder.
+    """
+
+    def __init__(self, stall_time=2., window=256):
+        self._stall_time = stall_time
+        self._lock = Lock()
+        self._frame_intervals = RollingStats(window)
+        self._arrival_intervals = RollingStats(window)
+        self._key_frame_intervals = RollingStats(window)
+        self._motion_intervals = RollingStats(window)
+        self._num_frames = 0
+        self._num_dropped_frames = 0
+        self._num_drop_events = 0
+        self._num_late_frames = 0
+        self._num_stalls = 0
+        self._num_late_motion_callbacks = 0
+        self._num_restarts = 0
+        self._last_index = None
+        self._last_timestamp = None
+        self._last_arrival_time = None
+        self._last_motion_time = None
+        self._frames_since_key_frame = None
+
+    @property
+    def stall_time(self):
+        return self._stall_time
+
+    @stall_time.setter
+    def stall_time(self, value):
+        self._stall_time = value
+
+    def restart(self):
+        """
+        Forgets the last frame, e.g. because the encoder stopped. The counters are kept.
+        """
+        with self._lock:
+            self._restart()
+
+    def _restart(self):
+        self._last_index = None
+        self._last_timestamp = None
+        self._last_arrival_time = None
+        self._last_motion_time = None
+        self._frames_since_key_frame = None
+
+    def reset(self):
+        with self._lock:
+            self._restart()
+            for rolling_stats in (self._frame_intervals, self._arrival_intervals, self._key_frame_intervals,
+                                  self._motion_intervals):
+                rolling_stats.reset()
+            self._num_frames = 0
+            self._num_dropped_frames = 0
+            self._num_drop_events = 0
+            self._num_late_frames = 0
+            self._num_stalls = 0
+            self._num_late_motion_callbacks = 0
+            self._num_restarts = 0
+
+    def update_frame(self, frame, arrival_time, framerate):
+        """
+        :param frame: the PiVideoFrame of the last write. Only complete video frames are considered.
+        :param arrival_time: monotonic time of the write.
+        :param framerate: the framerate of the camera.
+        :return: True if the frame ends a stall, i.e. no frame arrived for at least `stall_time` seconds.
+        """
+        if not frame.complete or frame.frame_type not in (PiVideoFrameType.frame, PiVideoFrameType.key_frame):
+            return False
+        period = 1. / framerate
+        is_stall = False
+        with self._lock:
+            if self._last_index is not None and frame.index is not None and frame.index <= self._last_index:
+                # The encoder was restarted without a flush
+                self._num_restarts += 1
+                self._restart()
+            self._num_frames += 1
+            has_dropped = False
+            if frame.timestamp is not None and self._last_timestamp is not None and \
+                    frame.timestamp > self._last_timestamp:
+                interval = (frame.timestamp - self._last_timestamp) / 1000000.
+                self._frame_intervals.push(interval)
+                if interval > LATE_FACTOR * period:
+                    has_dropped = True
+                    self._num_dropped_frames += max(1, int(round(interval / period)) - 1)
+                    self._num_drop_events += 1
+            if self._last_arrival_time is not None:
+                arrival_interval = arrival_time - self._last_arrival_time
+                self._arrival_intervals.push(arrival_interval)
+                if arrival_interval >= self._stall_time:
+                    is_stall = True
+                    self._num_stalls += 1
+                elif arrival_interval > LATE_FACTOR * period and not has_dropped:
+                    self._num_late_frames += 1
+            if self._frames_since_key_frame is not None:
+                self._frames_since_key_frame += 1
+            if frame.frame_type == PiVideoFrameType.key_frame:
+                if self._frames_since_key_frame is not None:
+                    self._key_frame_intervals.push(self._frames_since_key_frame)
+                self._frames_since_key_frame = 0
+            self._last_index = frame.index
+            if frame.timestamp is not None:
+                self._last_timestamp = frame.timestamp
+            self._last_arrival_time = arrival_time
+        return is_stall
+
+    def update_motion(self, arrival_time, framerate):
+        """
+        :param arrival_time: monotonic time of the motion analysis callback.
+        :param framerate: the framerate of the camera.
+        """
+        with self._lock:
+            if self._last_motion_time is not None:
+                interval = arrival_time - self._last_motion_time
+                self._motion_intervals.push(interval)
+                if interval > LATE_FACTOR / framerate:
+                    self._num_late_motion_callbacks += 1
+            self._last_motion_time = arrival_time
+
+    def time_since_last_frame(self, now):
+        """
+        :return: Seconds since the last frame arrived, or None if no frame arrived since the last restart.
+        """
+        last_arrival_time = self._last_arrival_time
+        return None if last_arrival_time is None else now - last_arrival_time
+
+    @property
+    def num_frames(self):
+        return self._num_frames
+
+    @property
+    def num_dropped_frames(self):
+        return self._num_dropped_frames
+
+    @property
+    def num_late_frames(self):
+        return self._num_late_frames
+
+    @property
+    def num_stalls(self):
+        return self._num_stalls
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'num_frames': self._num_frames,
+                'num_dropped_frames': self._num_dropped_frames,
+                'num_drop_events': self._num_drop_events,
+                'num_late_frames': self._num_late_frames,
+                'num_stalls': self._num_stalls,
+                'num_late_motion_callbacks': self._num_late_motion_callbacks,
+                'num_restarts': self._num_restarts,
+                'frame_interval': self._frame_intervals.to_dict(),
+                'arrival_interval': self._arrival_intervals.to_dict(),
+                'key_frame_interval': self._key_frame_intervals.to_dict(),
+                'motion_interval': self._motion_intervals.to_dict()
+            }
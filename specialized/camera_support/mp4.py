@@ -0,0 +1,576 @@
+from array import array
+import logging
+import os
+import struct
+import sys
+from specialized.camera_support.nal import index_nal_units, NAL_TYPE_IDR, NAL_TYPE_SPS, NAL_TYPE_PPS
+
+
+_log = logging.getLogger('mp4_muxer')
+
+_HIGH_PROFILES = (100, 110, 122, 144)
+_TIMESCALE = 90000
+_TRACK_ID = 1
+_MDAT_HEADER_SIZE = 16
+_FREE_HEADER_SIZE = 8
+# Fits the movie header of a few minutes of footage at 30 fps
+_FAST_START_RESERVED_SIZE = 16 * 1024
+_CHUNK_OFFSETS_CONTAINERS = (b'moov', b'trak', b'mdia', b'minf', b'stbl')
+_IDENTITY_MATRIX = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+_SAMPLE_FLAGS_SYNC = 0x02000000
+_SAMPLE_FLAGS_NON_SYNC = 0x01010000
+_TRUN_DATA_OFFSET = 0x000001
+_TRUN_FIRST_SAMPLE_FLAGS = 0x000004
+_TRUN_SAMPLE_SIZE = 0x000200
+_TFHD_DEFAULT_BASE_IS_MOOF = 0x020000
+# Below this size, e.g. for most P frames, bytes.find beats the NumPy setup cost
+_VECTORIZED_SPLIT_MIN_SIZE = 32 * 1024
+
+
+def _box(box_type, *payload):
+    payload = b''.join(payload)
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def _full_box(box_type, version, flags, *payload):
+    return _box(box_type, struct.pack('>I', (version << 24) | flags), *payload)
+
+
+def _big_endian_bytes(values):
+    if sys.byteorder == 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def iterate_boxes(fp, start=0, end=None):
+    """
+    Iterates over the boxes of a MP4 file in the range [start, end).
+    :return: Tuples (box type, offset, size).
+    """
+    if end is None:
+        fp.seek(0, os.SEEK_END)
+        end = fp.tell()
+    offset = start
+    while offset + 8 <= end:
+        fp.seek(offset)
+        size, box_type = struct.unpack('>I4s', fp.read(8))
+        if size == 1:
+            size, = struct.unpack('>Q', fp.read(8))
+        elif size == 0:
+            size = end - offset
+        if size < 8:  # pragma: no cover
+            raise ValueError('Invalid MP4 box of size %d at %d.' % (size, offset))
+        yield box_type, offset, size
+        offset += size
+
+
+def _shift_chunk_offsets(box, delta):
+    """
+    Adds delta to all the chunk offsets in the given moov box, in place.
+    """
+    offset = 0
+    while offset + 8 <= len(box):
+        size, box_type = struct.unpack_from('>I4s', box, offset)
+        if box_type in _CHUNK_OFFSETS_CONTAINERS:
+            box[offset + 8:offset + size] = _shift_chunk_offsets(box[offset + 8:offset + size], delta)
+        elif box_type in (b'stco', b'co64'):
+            entry_format = '>I' if box_type == b'stco' else '>Q'
+            num_entries, = struct.unpack_from('>I', box, offset + 12)
+            for i in range(num_entries):
+                entry_offset = offset + 16 + i * struct.calcsize(entry_format)
+                chunk_offset, = struct.unpack_from(entry_format, box, entry_offset)
+                struct.pack_into(entry_format, box, entry_offset, chunk_offset + delta)
+        offset += size
+    return box
+
+
+def move_movie_box_to_front(src, dst, block_size=1024 * 1024):
+    """
+    Copies the MP4 in the binary file `src` to `dst`, moving the moov box right before the mdat box, so that players
+    can start the playback before downloading the whole file. The media data is copied sequentially, once.
+    """
+    boxes = list(iterate_boxes(src))
+    moov = next((box for box in boxes if box[0] == b'moov'), None)
+    mdat = next((box for box in boxes if box[0] == b'mdat'), None)
+    if moov is None or mdat is None:
+        raise ValueError('The MP4 file has no moov or no mdat box.')
+    src.seek(moov[1])
+    moov_data = bytearray(src.read(moov[2]))
+    if moov[1] > mdat[1]:
+        moov_data = _shift_chunk_offsets(moov_data, len(moov_data))
+    for box_type, offset, size in boxes:
+        if box_type == b'moov':
+            continue
+        if box_type == b'mdat':
+            dst.write(moov_data)
+        src.seek(offset)
+        while size > 0:
+            block = src.read(min(size, block_size))
+            if not block:  # pragma: no cover
+                raise ValueError('The MP4 file is truncated.')
+            dst.write(block)
+            size -= len(block)
+
+
+def _iterate_child_boxes(data, start=0, end=None):
+    end = len(data) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, offset)
+        if size < 8:  # pragma: no cover
+            break
+        yield box_type, offset, size
+        offset += size
+
+
+def _find_child_box(data, *path):
+    start, end = 0, len(data)
+    for box_type in path:
+        child = next((box for box in _iterate_child_boxes(data, start, end) if box[0] == box_type), None)
+        if child is None:
+            return None
+        start, end = child[1] + 8, child[1] + child[2]
+    return start, end
+
+
+def read_duration(fp):
+    """
+    Reads the duration of a MP4 file written by `MP4Muxer`, also if fragmented.
+    :return: The duration in seconds, or None if the file has no movie header.
+    """
+    moov = None
+    num_fragment_samples = 0
+    for box_type, offset, size in iterate_boxes(fp):
+        if box_type not in (b'moov', b'moof'):
+            continue
+        fp.seek(offset)
+        data = fp.read(size)
+        if box_type == b'moov':
+            moov = data
+            continue
+        trun = _find_child_box(data, b'moof', b'traf', b'trun')
+        if trun is not None:
+            num_fragment_samples += struct.unpack_from('>I', data, trun[0] + 4)[0]
+    if moov is None:
+        return None
+    mvhd = _find_child_box(moov, b'moov', b'mvhd')
+    if mvhd is None:  # pragma: no cover
+        return None
+    if moov[mvhd[0]] == 1:
+        timescale, duration = struct.unpack_from('>IQ', moov, mvhd[0] + 20)
+    else:
+        timescale, duration = struct.unpack_from('>II', moov, mvhd[0] + 12)
+    trex = _find_child_box(moov, b'moov', b'mvex', b'trex')
+    if trex is not None:
+        # Fragmented, the samples have the default duration
+        duration += num_fragment_samples * struct.unpack_from('>I', moov, trex[0] + 12)[0]
+    return duration / float(timescale) if timescale > 0 else None
+
+
+def _read_parameter_sets(moov):
+    stsd = _find_child_box(moov, b'moov', b'trak', b'mdia', b'minf', b'stbl', b'stsd')
+    if stsd is None:  # pragma: no cover
+        return None, None
+    # Skip the stsd entry count, and then the fixed fields of the visual sample entry
+    avc_1 = next((box for box in _iterate_child_boxes(moov, stsd[0] + 8, stsd[1]) if box[0] == b'avc1'), None)
+    if avc_1 is None:
+        return None, None
+    avc_c = next((box for box in _iterate_child_boxes(moov, avc_1[1] + 86, avc_1[1] + avc_1[2])
+                  if box[0] == b'avcC'), None)
+    if avc_c is None:  # pragma: no cover
+        return None, None
+    offset = avc_c[1] + 14
+    sps_length, = struct.unpack_from('>H', moov, offset)
+    sps = moov[offset + 2:offset + 2 + sps_length]
+    offset += 3 + sps_length
+    pps_length, = struct.unpack_from('>H', moov, offset)
+    return sps, moov[offset + 2:offset + 2 + pps_length]
+
+
+def _read_table_samples(moov):
+    stbl = _find_child_box(moov, b'moov', b'trak', b'mdia', b'minf', b'stbl')
+    if stbl is None:  # pragma: no cover
+        return []
+    tables = {box_type: offset + 12 for box_type, offset, _ in _iterate_child_boxes(moov, *stbl)}
+    if b'stsz' not in tables:  # pragma: no cover
+        return []
+    default_size, num_samples = struct.unpack_from('>II', moov, tables[b'stsz'])
+    if default_size > 0:
+        sizes = [default_size] * num_samples
+    else:
+        sizes = struct.unpack_from('>%dI' % num_samples, moov, tables[b'stsz'] + 8)
+    sync_samples = None
+    if b'stss' in tables:
+        num_sync_samples, = struct.unpack_from('>I', moov, tables[b'stss'])
+        sync_samples = set(struct.unpack_from('>%dI' % num_sync_samples, moov, tables[b'stss'] + 4))
+    if b'stco' in tables:
+        num_chunks, = struct.unpack_from('>I', moov, tables[b'stco'])
+        chunk_offsets = struct.unpack_from('>%dI' % num_chunks, moov, tables[b'stco'] + 4)
+    else:
+        num_chunks, = struct.unpack_from('>I', moov, tables[b'co64'])
+        chunk_offsets = struct.unpack_from('>%dQ' % num_chunks, moov, tables[b'co64'] + 4)
+    num_entries, = struct.unpack_from('>I', moov, tables[b'stsc'])
+    samples_to_chunk = [struct.unpack_from('>II', moov, tables[b'stsc'] + 4 + 12 * i) for i in range(num_entries)]
+    samples = []
+    for i, chunk_offset in enumerate(chunk_offsets):
+        # The last entry whose first chunk (1-based) is not after this one
+        samples_per_chunk = next((count for first_chunk, count in reversed(samples_to_chunk) if first_chunk <= i + 1),
+                                 0)
+        for _ in range(samples_per_chunk):
+            if len(samples) == num_samples:  # pragma: no cover
+                break
+            is_sync = sync_samples is None or len(samples) + 1 in sync_samples
+            samples.append((chunk_offset, sizes[len(samples)], is_sync))
+            chunk_offset += samples[-1][1]
+    return samples
+
+
+def _read_fragment_samples(moof, moof_offset, default_sample_flags):
+    samples = []
+    traf = _find_child_box(moof, b'moof', b'traf')
+    if traf is None:  # pragma: no cover
+        return samples
+    base_offset = moof_offset
+    default_size = 0
+    for box_type, offset, size in _iterate_child_boxes(moof, *traf):
+        flags = struct.unpack_from('>I', moof, offset + 8)[0] & 0xffffff
+        offset += 16  # Header, version and flags, track id
+        if box_type == b'tfhd':
+            if flags & 0x1:
+                base_offset, = struct.unpack_from('>Q', moof, offset)
+                offset += 8
+            offset += 4 * bool(flags & 0x2) + 4 * bool(flags & 0x8)
+            if flags & 0x10:
+                default_size, = struct.unpack_from('>I', moof, offset)
+                offset += 4
+            if flags & 0x20:
+                default_sample_flags, = struct.unpack_from('>I', moof, offset)
+        elif box_type == b'trun':
+            # The sample count takes the place of the track id
+            offset -= 4
+            num_samples, = struct.unpack_from('>I', moof, offset)
+            offset += 4
+            data_offset = base_offset
+            if flags & _TRUN_DATA_OFFSET:
+                data_offset += struct.unpack_from('>i', moof, offset)[0]
+                offset += 4
+            first_sample_flags = None
+            if flags & _TRUN_FIRST_SAMPLE_FLAGS:
+                first_sample_flags, = struct.unpack_from('>I', moof, offset)
+                offset += 4
+            for i in range(num_samples):
+                offset += 4 * bool(flags & 0x100)
+                sample_size = default_size
+                if flags & _TRUN_SAMPLE_SIZE:
+                    sample_size, = struct.unpack_from('>I', moof, offset)
+                    offset += 4
+                sample_flags = default_sample_flags
+                if flags & 0x400:
+                    sample_flags, = struct.unpack_from('>I', moof, offset)
+                    offset += 4
+                if i == 0 and first_sample_flags is not None:
+                    sample_flags = first_sample_flags
+                offset += 4 * bool(flags & 0x800)
+                samples.append((data_offset, sample_size, not sample_flags & 0x10000))
+                data_offset += sample_size
+    return samples
+
+
+def read_samples(fp):
+    """
+    Reads the sample table of a single track H.264 MP4 file, such as those written by `MP4Muxer`, also if fragmented.
+    :return: A tuple (SPS, PPS, samples), where samples is a list of tuples (offset, size, is sync sample), in
+    decoding order. Samples are sequences of NAL units, each prefixed by its size as a 32 bit big endian integer.
+    """
+    moov = None
+    samples = []
+    for box_type, offset, size in iterate_boxes(fp):
+        if box_type == b'moov':
+            fp.seek(offset)
+            moov = fp.read(size)
+            samples = _read_table_samples(moov)
+        elif box_type == b'moof' and moov is not None:
+            fp.seek(offset)
+            trex = _find_child_box(moov, b'moov', b'mvex', b'trex')
+            default_sample_flags = 0 if trex is None else struct.unpack_from('>I', moov, trex[0] + 20)[0]
+            samples += _read_fragment_samples(fp.read(size), offset, default_sample_flags)
+    if moov is None:
+        raise ValueError('The MP4 file has no moov box.')
+    sps, pps = _read_parameter_sets(moov)
+    return sps, pps, samples
+
+
+def sample_to_annex_b(sample):
+    """
+    Converts a sample made of length-prefixed NAL units into a H.264 Annex-B byte stream.
+    """
+    data = bytearray()
+    offset = 0
+    while offset + 4 <= len(sample):
+        nal_length, = struct.unpack_from('>I', sample, offset)
+        data += b'\x00\x00\x00\x01'
+        data += sample[offset + 4:offset + 4 + nal_length]
+        offset += 4 + nal_length
+    return bytes(data)
+
+
+def split_annex_b(data):
+    """
+    Splits a H.264 Annex-B byte stream into NAL units.
+    :return: A list of NAL units, without start codes.
+    """
+    if len(data) >= _VECTORIZED_SPLIT_MIN_SIZE:
+        view = memoryview(data)
+        starts, ends, _ = index_nal_units(view)
+        return [view[start:end].tobytes() for start, end in zip(starts.tolist(), ends.tolist())]
+    data = bytes(data)
+    nal_units = []
+    start = data.find(b'\x00\x00\x01')
+    while start >= 0:
+        start += 3
+        next_start = data.find(b'\x00\x00\x01', start)
+        end = len(data) if next_start < 0 else next_start
+        # Zeros preceding a start code are either the first byte of a 4-byte start code or trailing zeros
+        while end > start and data[end - 1] == 0:
+            end -= 1
+        if end > start:
+            nal_units.append(data[start:end])
+        start = next_start
+    return nal_units
+
+
+class MP4Muxer:
+    """
+    Streaming H.264 MP4 muxer. Subclasses implement `_write(data)` and `_seek(offset)`, where offsets are relative to
+    the position at which `begin` is called. Call `begin`, then `append` every chunk produced by the encoder, and
+    finally `end`.
+
+    Sample data is written as soon as a frame is complete; only the sample sizes and the sync samples are kept, in
+    `array` buffers. Regular MP4s write the movie header at `end`, and then seek back to patch the size of the data.
+    Fragmented MP4s write the movie header as soon as the first SPS header arrives, and then one movie fragment per
+    GOP: the file is playable up to the last fragment written, memory does not grow with the clip length, `_seek` is
+    never called and `end` only writes the last fragment.
+
+    Regular MP4s can be made fast-start by reserving space for the movie header before the media data: if it fits,
+    `end` writes it there, otherwise at the end of the file, and `moov_before_mdat` is False.
+    """
+
+    def __init__(self, fragment_configuration=None, fast_start=False):
+        """
+        :param fragment_configuration: None for a regular MP4. For a fragmented MP4, a callable returning the pair
+        (framerate, resolution), called once when the movie header is written. The arguments of `end` are then
+        ignored.
+        :param fast_start: reserve space for the movie header before the media data. Fragmented MP4s are always
+        fast-start.
+        """
+        self._fragment_configuration = fragment_configuration
+        self._fast_start = fast_start
+        self._reset()
+
+    def _reset(self):
+        self._offset = 0
+        self._frame = bytearray()
+        self._sps = None
+        self._pps = None
+        self._mdat_offset = None
+        self._reserved_offset = None
+        self._moov_before_mdat = self.fragmented
+        self._sample_sizes = array('I')
+        self._sync_samples = array('I')
+        self._num_samples = 0
+        self._fragment_data = bytearray()
+        self._fragment_first_sample_is_sync = False
+        self._fragment_sequence_number = 0
+        self._sample_duration = None
+
+    @property
+    def fragmented(self):
+        return self._fragment_configuration is not None
+
+    @property
+    def fast_start(self):
+        return self._fast_start or self.fragmented
+
+    @property
+    def moov_before_mdat(self):
+        return self._moov_before_mdat
+
+    @property
+    def num_samples(self):
+        return self._num_samples
+
+    def _write(self, data):  # pragma: no cover
+        raise NotImplementedError()
+
+    def _seek(self, offset):  # pragma: no cover
+        raise NotImplementedError()
+
+    def _emit(self, data):
+        self._write(data)
+        self._offset += len(data)
+
+    def begin(self):
+        self._reset()
+        self._emit(_box(b'ftyp', b'isom', struct.pack('>I', 0x200), b'isom', b'iso2', b'iso5', b'avc1', b'mp41'))
+        if not self.fragmented:
+            if self._fast_start:
+                self._reserved_offset = self._offset
+                self._emit(struct.pack('>I4s', _FAST_START_RESERVED_SIZE, b'free'))
+                self._emit(bytes(_FAST_START_RESERVED_SIZE - _FREE_HEADER_SIZE))
+            self._mdat_offset = self._offset
+            # 64 bit size, patched in `end`
+            self._emit(struct.pack('>I4sQ', 1, b'mdat', 0))
+
+    def append(self, data, frame_is_sps_header, frame_is_complete):
+        self._frame += data
+        if not frame_is_complete:
+            return
+        nal_units = split_annex_b(self._frame)
+        self._frame = bytearray()
+        if frame_is_sps_header:
+            self._set_parameter_sets(nal_units)
+        elif self._sps is None:
+            _log.debug('Dropping a frame that precedes the first SPS header.')
+        else:
+            self._append_sample(nal_units)
+
+    def end(self, framerate, resolution):
+        if self.fragmented:
+            self._write_fragment()
+            return
+        mdat_end = self._offset
+        self._sample_duration = self._duration_of_one_frame(framerate)
+        moov = self._movie_box(resolution)
+        free_size = _FAST_START_RESERVED_SIZE - len(moov)
+        if self._fast_start and (free_size == 0 or free_size >= _FREE_HEADER_SIZE):
+            # Replace the reserved space with the moov and a smaller free box
+            self._seek(self._reserved_offset)
+            self._write(moov)
+            if free_size > 0:
+                self._write(struct.pack('>I4s', free_size, b'free'))
+            self._moov_before_mdat = True
+        else:
+            self._emit(moov)
+        self._seek(self._mdat_offset + 8)
+        self._write(struct.pack('>Q', mdat_end - self._mdat_offset))
+        self._seek(self._offset)
+
+    def _set_parameter_sets(self, nal_units):
+        for nal_unit in nal_units:
+            nal_type = nal_unit[0] & 0x1f
+            if nal_type == NAL_TYPE_SPS:
+                if self._sps is not None and self._sps != nal_unit:  # pragma: no cover
+                    _log.warning('The SPS changed midway, the MP4 will keep the first one.')
+                elif self._sps is None:
+                    self._sps = nal_unit
+            elif nal_type == NAL_TYPE_PPS and self._pps is None:
+                self._pps = nal_unit
+        if self.fragmented:
+            if self._fragment_sequence_number == 0 and self._sps is not None and self._pps is not None:
+                framerate, resolution = self._fragment_configuration()
+                self._sample_duration = self._duration_of_one_frame(framerate)
+                self._emit(self._movie_box(resolution))
+                self._fragment_sequence_number = 1
+            else:
+                # A new GOP begins
+                self._write_fragment()
+
+    def _append_sample(self, nal_units):
+        sample = b''.join(struct.pack('>I', len(nal_unit)) + nal_unit for nal_unit in nal_units
+                          if nal_unit[0] & 0x1f not in (NAL_TYPE_SPS, NAL_TYPE_PPS))
+        is_sync = any(nal_unit[0] & 0x1f == NAL_TYPE_IDR for nal_unit in nal_units)
+        if self.fragmented:
+            if len(self._sample_sizes) == 0:
+                self._fragment_first_sample_is_sync = is_sync
+            self._fragment_data += sample
+        else:
+            if is_sync:
+                self._sync_samples.append(self._num_samples + 1)
+            self._emit(sample)
+        self._sample_sizes.append(len(sample))
+        self._num_samples += 1
+
+    @staticmethod
+    def _duration_of_one_frame(framerate):
+        return max(1, int(round(_TIMESCALE / float(framerate))))
+
+    def _write_fragment(self):
+        num_samples = len(self._sample_sizes)
+        if num_samples == 0:
+            return
+        base_decode_time = (self._num_samples - num_samples) * self._sample_duration
+        first_sample_flags = _SAMPLE_FLAGS_SYNC if self._fragment_first_sample_is_sync else _SAMPLE_FLAGS_NON_SYNC
+
+        def make_moof(data_offset):
+            return _box(b'moof',
+                        _full_box(b'mfhd', 0, 0, struct.pack('>I', self._fragment_sequence_number)),
+                        _box(b'traf',
+                             _full_box(b'tfhd', 0, _TFHD_DEFAULT_BASE_IS_MOOF, struct.pack('>I', _TRACK_ID)),
+                             _full_box(b'tfdt', 1, 0, struct.pack('>Q', base_decode_time)),
+                             _full_box(b'trun', 0, _TRUN_DATA_OFFSET | _TRUN_FIRST_SAMPLE_FLAGS | _TRUN_SAMPLE_SIZE,
+                                       struct.pack('>IiI', num_samples, data_offset, first_sample_flags),
+                                       _big_endian_bytes(self._sample_sizes))))
+        # The data offset is relative to the moof start and points past the mdat header
+        moof_size = len(make_moof(0))
+        self._emit(make_moof(moof_size + 8))
+        self._emit(struct.pack('>I4s', 8 + len(self._fragment_data), b'mdat'))
+        self._emit(self._fragment_data)
+        self._fragment_sequence_number += 1
+        self._fragment_data = bytearray()
+        self._sample_sizes = array('I')
+
+    def _sample_entry_box(self, resolution):
+        if self._sps is None or self._pps is None:
+            return b''
+        width, height = resolution
+        avc_config = [struct.pack('>5B', 1, self._sps[1], self._sps[2], self._sps[3], 0xfc | 3),
+                      struct.pack('>BH', 0xe0 | 1, len(self._sps)), self._sps,
+                      struct.pack('>BH', 1, len(self._pps)), self._pps]
+        if self._sps[1] in _HIGH_PROFILES:
+            # The camera encodes 4:2:0 at 8 bits, without SPS extensions
+            avc_config.append(struct.pack('>4B', 0xfc | 1, 0xf8, 0xf8, 0))
+        return _box(b'avc1', bytes(6), struct.pack('>H', 1), bytes(16), struct.pack('>HHII', width, height, 0x480000,
+                                                                                         0x480000),
+                    bytes(4), struct.pack('>H', 1), bytes(32), struct.pack('>Hh', 0x18, -1),
+                    _box(b'avcC', *avc_config))
+
+    def _sample_table_box(self, resolution):
+        sample_entry = self._sample_entry_box(resolution)
+        stsd = _full_box(b'stsd', 0, 0, struct.pack('>I', 1 if sample_entry else 0), sample_entry)
+        if self.fragmented or self._num_samples == 0:
+            # The samples are described in the fragments
+            return _box(b'stbl', stsd,
+                        _full_box(b'stts', 0, 0, struct.pack('>I', 0)),
+                        _full_box(b'stsc', 0, 0, struct.pack('>I', 0)),
+                        _full_box(b'stsz', 0, 0, struct.pack('>II', 0, 0)),
+                        _full_box(b'stco', 0, 0, struct.pack('>I', 0)))
+        # The samples are contiguous in the mdat, so they all belong to a single chunk
+        return _box(b'stbl', stsd,
+                    _full_box(b'stts', 0, 0, struct.pack('>III', 1, self._num_samples, self._sample_duration)),
+                    _full_box(b'stss', 0, 0, struct.pack('>I', len(self._sync_samples)),
+                              _big_endian_bytes(self._sync_samples)),
+                    _full_box(b'stsc', 0, 0, struct.pack('>IIII', 1, 1, self._num_samples, 1)),
+                    _full_box(b'stsz', 0, 0, struct.pack('>II', 0, self._num_samples),
+                              _big_endian_bytes(self._sample_sizes)),
+                    _full_box(b'stco', 0, 0, struct.pack('>II', 1, self._mdat_offset + _MDAT_HEADER_SIZE)))
+
+    def _movie_box(self, resolution):
+        width, height = resolution
+        duration = 0 if self.fragmented else self._num_samples * self._sample_duration
+        mvhd = _full_box(b'mvhd', 0, 0, struct.pack('>IIIIIH10x', 0, 0, _TIMESCALE, duration, 0x10000, 0x100),
+                         _IDENTITY_MATRIX, bytes(24), struct.pack('>I', _TRACK_ID + 1))
+        tkhd = _full_box(b'tkhd', 0, 3, struct.pack('>5I8xhhhxx', 0, 0, _TRACK_ID, 0, duration, 0, 0, 0),
+                         _IDENTITY_MATRIX, struct.pack('>II', width << 16, height << 16))
+        mdhd = _full_box(b'mdhd', 0, 0, struct.pack('>4IHH', 0, 0, _TIMESCALE, duration, 0x55c4, 0))
+        hdlr = _full_box(b'hdlr', 0, 0, struct.pack('>I4s12x', 0, b'vide'), b'VideoHandler\x00')
+        minf = _box(b'minf',
+                    _full_box(b'vmhd', 0, 1, bytes(8)),
+                    _box(b'dinf', _full_box(b'dref', 0, 0, struct.pack('>I', 1), _full_box(b'url ', 0, 1))),
+                    self._sample_table_box(resolution))
+        trak = _box(b'trak', tkhd, _box(b'mdia', mdhd, hdlr, minf))
+        if not self.fragmented:
+            return _box(b'moov', mvhd, trak)
+        mvex = _box(b'mvex', _full_box(b'trex', 0, 0, struct.pack('>5I', _TRACK_ID, 1, self._sample_duration, 0,
+                                                                   _SAMPLE_FLAGS_NON_SYNC)))
+        return _box(b'moov', mvhd, trak, mvex)
@@ -1,9 +1,11 @@
-from tempfile import NamedTemporaryFile
 import os
 import logging
-from safe_picamera import MP4Muxer
+from specialized.camera_support.mp4 import MP4Muxer, move_movie_box_to_front
+from specialized.camera_support.block_writer import BlockWriter
+from specialized.support.temp_storage import named_temporary_file
 from misc.settings import SETTINGS
 from threading import Lock
+from collections import deque
 
 
 _log = logging.getLogger('mp4_muxer')
@@ -14,8 +16,8 @@ class MP4StreamMuxer(MP4Muxer):
     Simple MP4 muxer wrapper that writes and seeks on a stream.
     """
 
-    def __init__(self, stream):
-        super(MP4StreamMuxer, self).__init__()
+    def __init__(self, stream, fragment_configuration=None, fast_start=False):
+        super(MP4StreamMuxer, self).__init__(fragment_configuration=fragment_configuration, fast_start=fast_start)
         self.stream = stream
 
     def _write(self, data):
@@ -25,15 +27,81 @@ class MP4StreamMuxer(MP4Muxer):
         self.stream.seek(offset)
 
 
+class DetachedMP4:
+    """
+    A MP4 that does not receive any more data and is only waiting to be finalized or discarded. It owns the temporary
+    file and the muxer state, so it does not share anything with the recorder it was detached from.
+    """
+
+    def __init__(self, temp_file, muxer, age):
+        self._temp_file = temp_file
+        self._muxer = muxer
+        self._age = age
+
+    @property
+    def age(self):
+        return self._age
+
+    @property
+    def file_name(self):
+        return self._temp_file.name
+
+    def finalize(self, framerate, resolution):
+        """
+        Writes the MP4 trailer, closes the file and returns its name.
+        """
+        stream = self._muxer.stream
+        stream.flush()
+        stream.truncate()
+        self._muxer.end(framerate, resolution)
+        stream.flush()
+        if self._muxer.fast_start and not self._muxer.moov_before_mdat:
+            self._move_movie_box_to_front()
+        self._temp_file.close()
+        _log.debug('Finalized MP4 file %s' % self._temp_file.name)
+        return self._temp_file.name
+
+    def _move_movie_box_to_front(self):
+        # The reserved space was not enough, relocate the moov on a new file
+        self._temp_file.seek(0, os.SEEK_END)
+        fast_start_file = named_temporary_file(expected_size=self._temp_file.tell())
+        _log.debug('Moving the moov of %s to the front in %s', self._temp_file.name, fast_start_file.name)
+        try:
+            move_movie_box_to_front(self._temp_file, fast_start_file)
+        except:  # pragma: no cover
+            fast_start_file.close()
+            os.remove(fast_start_file.name)
+            raise
+        self.discard()
+        self._temp_file = fast_start_file
+
+    def discard(self):
+        self._temp_file.close()
+        if os.path.isfile(self._temp_file.name):
+            _log.debug('Dropping temporary MP4 %s', self._temp_file.name)
+            try:
+                os.remove(self._temp_file.name)
+            except OSError:  # pragma: no cover
+                _log.exception('Unable to remove %s.', self._temp_file.name)
+
+
 class TemporaryMP4Muxer:
     """
-    A MP4 muxer that writes to a temporary file, that can be rewinded at need.
+    A MP4 muxer that writes to a temporary file, that can be rewinded at need. The file is created in RAM if
+    `expected_size` more bytes fit in the temporary storage quota, on disk otherwise. If `fragment_configuration` is
+    not None, the MP4 is fragmented (see MP4Muxer). If `fast_start` is True, the finalized MP4 has the moov box before
+    the media data. Writes are combined in blocks of `camera.write_block_size` bytes, and flushed at every SPS header.
     """
 
-    def __init__(self):
+    def __init__(self, expected_size=0, fragment_configuration=None, fast_start=False):
+        self._expected_size = expected_size
+        self._write_block_size = SETTINGS.camera.get('write_block_size', cast_to_type=int, default=64 * 1024, ge=0)
+        self._fragment_configuration = fragment_configuration
+        self._fast_start = fast_start
         self._temp_file = None
         self._muxer = None
         self._age = None
+        self._size = None
         self._last_frame_is_complete = True
         self._lock = Lock()
 
@@ -43,25 +111,24 @@ class TemporaryMP4Muxer:
 
     def _setup_new_temp(self):
         with self._lock:
-            self._temp_file = NamedTemporaryFile(delete=False, dir=SETTINGS.get('temp_folder', cast_to_type=str,
-                                                                                allow_none=True))
+            # The block writer does the buffering
+            self._temp_file = named_temporary_file(self._expected_size, buffering=0)
             _log.debug('Using new temporary MP4 %s', self._temp_file.name)
-            self._muxer = MP4StreamMuxer(self._temp_file)
+            self._muxer = MP4StreamMuxer(BlockWriter(self._temp_file, self._write_block_size),
+                                         self._fragment_configuration, self._fast_start)
             self._muxer.begin()
             self._age = 0
+            self._size = 0
 
     def _discard_temp(self):
         with self._lock:
-            self._temp_file.close()
-            if os.path.isfile(self._temp_file.name):
-                _log.debug('Dropping temporary MP4 %s', self._temp_file.name)
-                try:
-                    os.remove(self._temp_file.name)
-                except OSError:  # pragma: no cover
-                    _log.exception('Unable to remove %s.', self._temp_file.name)
+            if self._temp_file is None:
+                return
+            DetachedMP4(self._temp_file, self._muxer, self._age).discard()
             self._temp_file = None
             self._muxer = None
             self._age = None
+            self._size = None
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._discard_temp()
@@ -70,6 +137,13 @@ class TemporaryMP4Muxer:
     def age(self):
         return self._age
 
+    @property
+    def size(self):
+        """
+        Number of bytes of encoded data appended since the beginning of the MP4.
+        """
+        return self._size
+
     @property
     def file_name(self):
         return self._temp_file.name
@@ -78,43 +152,56 @@ class TemporaryMP4Muxer:
         with self._lock:
             if not self._last_frame_is_complete:  # pragma: no cover
                 raise RuntimeError('Rewinding before the last frame is complete will corrupt the media.')
-            self._temp_file.seek(0)
+            stream = self._muxer.stream
+            stream.seek(0)
             # Need to create new because it will seek to the mdat offset for finalizing the mp4
-            self._muxer = MP4StreamMuxer(self._temp_file)
+            self._muxer = MP4StreamMuxer(stream, self._fragment_configuration, self._fast_start)
             self._muxer.begin()
             self._age = 0
+            self._size = 0
 
-    def finalize(self, framerate, resolution):
+    def detach(self, keep_recording=True):
         """
-        Finalized the current MP4 and returns the file name.
-        Continues recording on another temporary file
+        Hands off the current MP4 as a DetachedMP4, that can be finalized independently, e.g. on another thread.
+        Continues recording on another temporary file, unless keep_recording is False.
         """
         if not self._last_frame_is_complete:  # pragma: no cover
             raise RuntimeError('Finalizing before the last frame is complete will corrupt the media.')
-        old_temp_file, old_muxer = self._temp_file, self._muxer
-        self._setup_new_temp()
-        # Now we can work safely with the old muxer and temp files
-        old_temp_file.flush()
-        old_temp_file.truncate()
-        old_muxer.end(framerate, resolution)
-        old_temp_file.close()
-        _log.debug('Finalized MP4 file %s' % old_temp_file.name)
-        return old_temp_file.name
+        with self._lock:
+            detached = DetachedMP4(self._temp_file, self._muxer, self._age)
+            self._temp_file = None
+            self._muxer = None
+            self._age = None
+            self._size = None
+        if keep_recording:
+            self._setup_new_temp()
+        return detached
+
+    def finalize(self, framerate, resolution, keep_recording=True):
+        """
+        Finalized the current MP4 and returns the file name.
+        Continues recording on another temporary file, unless keep_recording is False.
+        """
+        return self.detach(keep_recording=keep_recording).finalize(framerate, resolution)
 
     def append(self, data, frame_is_sps_header, frame_is_complete):
         with self._lock:
             if self._muxer is None:
                 return  # Has already exited
             self._muxer.append(data, frame_is_sps_header, frame_is_complete)
+            self._size += len(data)
+            if frame_is_sps_header and frame_is_complete:
+                # Split point, put the previous GOP on file
+                self._muxer.stream.flush()
             if frame_is_complete and not frame_is_sps_header:
                 self._age += 1
             self._last_frame_is_complete = frame_is_complete
 
 
 class DualBufferedMP4:
-    def __init__(self):
-        self._old = TemporaryMP4Muxer()
-        self._new = TemporaryMP4Muxer()
+    def __init__(self, fragment_configuration=None, fast_start=False):
+        self._old = TemporaryMP4Muxer(fragment_configuration=fragment_configuration, fast_start=fast_start)
+        self._new = TemporaryMP4Muxer(fragment_configuration=fragment_configuration, fast_start=fast_start)
         self._is_recording = False
         self._total_age = 0
 
@@ -126,6 +213,10 @@ class DualBufferedMP4:
     def footage_age(self):
         return self._old.age
 
+    @property
+    def footage_size(self):
+        return self._old.size
+
     @property
     def total_age(self):
         return self._total_age
@@ -150,15 +241,34 @@ class DualBufferedMP4:
         if not frame_is_sps_header and frame_is_complete:
             self._total_age += 1
 
-    def stop_and_finalize(self, framerate, resolution):
+    def stop_and_detach(self):
+        """
+        Stops recording and hands off the footage as a DetachedMP4, to be finalized by the caller.
+        """
         self._is_recording = False
         self._old, self._new = self._new, self._old
-        return self._new.finalize(framerate, resolution)
+        return self._new.detach()
+
+    def split_and_detach(self):
+        """
+        Hands off the footage so far as a DetachedMP4, and keeps recording from here on.
+        """
+        return self._old.detach()
+
+    def stop_and_finalize(self, framerate, resolution):
+        return self.stop_and_detach().finalize(framerate, resolution)
 
     def stop_and_discard(self):
         self._is_recording = False
         self.rewind_buffer()
 
+    def reset(self):
+        """
+        Drops all the footage and the buffer, and begins afresh on new temporary files.
+        """
+        self.__exit__(None, None, None)
+        self.__enter__()
+
     def __enter__(self):
         self._old.__enter__()
         self._new.__enter__()
@@ -168,3 +278,249 @@ class DualBufferedMP4:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._new.__exit__(exc_type, exc_val, exc_tb)
         self._old.__exit__(exc_type, exc_val, exc_tb)
+
+
+class BufferedGOP:
+    """
+    A group of pictures, starting at a SPS header, stored in memory as the sequence of chunks written by the encoder.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.age = 0
+        self.size = 0
+
+    @property
+    def is_complete(self):
+        return len(self.chunks) > 0 and self.chunks[-1][2]
+
+    def append(self, data, frame_is_sps_header, frame_is_complete):
+        self.chunks.append((data, frame_is_sps_header, frame_is_complete))
+        self.size += len(data)
+        if frame_is_complete and not frame_is_sps_header:
+            self.age += 1
+
+
+class DetachedGOPs:
+    """
+    The footage handed off by a RingBufferedMP4: the GOPs still in memory, following those already muxed to a temporary
+    MP4, if any. Like DetachedMP4, it is only waiting to be finalized or discarded. The GOPs are muxed only then, so
+    that detaching costs nothing to the encoder callback. The fragment configuration is read upon detaching, the camera
+    may be reconfigured before the GOPs are muxed.
+    """
+
+    def __init__(self, clip, gops, fragment_configuration=None, fast_start=False):
+        self._clip = clip
+        # Chunk lists are copied, the buffer of the recorder may share the GOP objects
+        self._gops = [list(gop.chunks) for gop in gops]
+        self._age = (0 if clip is None else clip.age) + sum(gop.age for gop in gops)
+        self._size = (0 if clip is None else clip.size) + sum(gop.size for gop in gops)
+        self._fragment_configuration = None
+        if fragment_configuration is not None:
+            configuration = fragment_configuration()
+            self._fragment_configuration = lambda: configuration
+        self._fast_start = fast_start
+
+    @property
+    def age(self):
+        return self._age
+
+    @property
+    def size(self):
+        return self._size
+
+    def _mux(self):
+        clip, self._clip = self._clip, None
+        if clip is None:
+            clip = TemporaryMP4Muxer(expected_size=self._size, fragment_configuration=self._fragment_configuration,
+                                     fast_start=self._fast_start)
+            clip.__enter__()
+        for chunks in self._gops:
+            for chunk in chunks:
+                clip.append(*chunk)
+        self._gops = []
+        return clip.detach(keep_recording=False)
+
+    def finalize(self, framerate, resolution):
+        """
+        Muxes the GOPs, writes the MP4 trailer, closes the file and returns its name.
+        """
+        return self._mux().finalize(framerate, resolution)
+
+    def discard(self):
+        self._gops = []
+        clip, self._clip = self._clip, None
+        if clip is not None:
+            clip.__exit__(None, None, None)
+
+
+class RingBufferedMP4:
+    """
+    Drop-in replacement for DualBufferedMP4 that keeps the buffer in memory, as a ring of GOPs. Nothing is written to
+    disk until a recording is finalized, unless a recording exceeds max_size bytes, in which case the oldest GOPs of the
+    recording are muxed to a temporary MP4 in advance. While not recording, the oldest GOPs are dropped to stay within
+    max_size bytes.
+    """
+
+    def __init__(self, max_size=8 * 1024 * 1024, fragment_configuration=None, fast_start=False):
+        self._fragment_configuration = fragment_configuration
+        self._fast_start = fast_start
+        self._max_size = max_size
+        self._gops = deque()
+        self._size = 0
+        # Index in _gops of the first GOP appended after the last rewind
+        self._rewind_index = 0
+        self._clip = None
+        self._is_recording = False
+        self._total_age = 0
+        self._lock = Lock()
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def buffer_age(self):
+        with self._lock:
+            gops = list(self._gops)[self._rewind_index:] if self.is_recording else self._gops
+            return sum(gop.age for gop in gops)
+
+    @property
+    def footage_age(self):
+        with self._lock:
+            age = sum(gop.age for gop in self._gops)
+            if self.is_recording and self._clip is not None:
+                age += self._clip.age
+            return age
+
+    @property
+    def footage_size(self):
+        with self._lock:
+            size = self._size
+            if self.is_recording and self._clip is not None:
+                size += self._clip.size
+            return size
+
+    @property
+    def total_age(self):
+        return self._total_age
+
+    @property
+    def is_recording(self):
+        return self._is_recording
+
+    def record(self):
+        self._is_recording = True
+
+    def _pop_oldest_gop(self):
+        gop = self._gops.popleft()
+        self._size -= gop.size
+        self._rewind_index = max(0, self._rewind_index - 1)
+        return gop
+
+    def _enforce_max_size(self):
+        # Never touch the GOP that is being appended to
+        while self._size > self._max_size and len(self._gops) > 1:
+            gop = self._pop_oldest_gop()
+            if self.is_recording:
+                self._spill(gop)
+
+    def _spill(self, gop):
+        if self._clip is None:
+            # The clip will contain at least the whole buffer
+            self._clip = TemporaryMP4Muxer(expected_size=self._size + gop.size,
+                                           fragment_configuration=self._fragment_configuration,
+                                           fast_start=self._fast_start)
+            self._clip.__enter__()
+        for chunk in gop.chunks:
+            self._clip.append(*chunk)
+
+    def rewind_buffer(self):
+        with self._lock:
+            if not self.is_recording:
+                while self._rewind_index > 0:
+                    self._pop_oldest_gop()
+            self._rewind_index = len(self._gops)
+
+    def append(self, data, frame_is_sps_header, frame_is_complete):
+        with self._lock:
+            if not frame_is_sps_header and frame_is_complete:
+                self._total_age += 1
+            if frame_is_sps_header:
+                self._gops.append(BufferedGOP())
+            elif len(self._gops) == 0:
+                return  # Data preceding the first SPS header cannot be decoded anyway
+            self._gops[-1].append(data, frame_is_sps_header, frame_is_complete)
+            self._size += len(data)
+            if frame_is_sps_header:
+                self._enforce_max_size()
+
+    def _detach(self):
+        clip, self._clip = self._clip, None
+        return DetachedGOPs(clip, self._gops, fragment_configuration=self._fragment_configuration,
+                            fast_start=self._fast_start)
+
+    def stop_and_detach(self):
+        """
+        Stops recording and hands off the footage as a DetachedGOPs, to be finalized by the caller. Nothing is muxed
+        here.
+        """
+        with self._lock:
+            self._is_recording = False
+            # All the GOPs appended so far belong to the clip; the ones after the last rewind are also the new buffer
+            detached = self._detach()
+            while self._rewind_index > 0:
+                self._pop_oldest_gop()
+            self._rewind_index = len(self._gops)
+        return detached
+
+    def split_and_detach(self):
+        """
+        Hands off the footage so far as a DetachedGOPs, and keeps recording from here on, with an empty buffer.
+        """
+        with self._lock:
+            detached = self._detach()
+            self._gops.clear()
+            self._size = 0
+            self._rewind_index = 0
+        return detached
+
+    def stop_and_finalize(self, framerate, resolution):
+        return self.stop_and_detach().finalize(framerate, resolution)
+
+    def stop_and_discard(self):
+        with self._lock:
+            self._is_recording = False
+            clip, self._clip = self._clip, None
+        if clip is not None:
+            clip.__exit__(None, None, None)
+        self.rewind_buffer()
+
+    def reset(self):
+        """
+        Drops all the footage and the buffer.
+        """
+        self.__exit__(None, None, None)
+        self.__enter__()
+
+    def __enter__(self):
+        with self._lock:
+            self._gops.clear()
+            self._size = 0
+            self._rewind_index = 0
+            self._is_recording = False
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self._lock:
+            self._is_recording = False
+            self._gops.clear()
+            self._size = 0
+            self._rewind_index = 0
+            clip, self._clip = self._clip, None
+        if clip is not None:
+            clip.__exit__(exc_type, exc_val, exc_tb)
@@ -0,0 +1,155 @@
+import numpy as np
+from time import perf_counter
+from safe_picamera import PiVideoFrameType
+
+
+NAL_TYPE_NON_IDR = 1
+NAL_TYPE_IDR = 5
+NAL_TYPE_SEI = 6
+NAL_TYPE_SPS = 7
+NAL_TYPE_PPS = 8
+NAL_TYPE_AUD = 9
+
+
+def _as_array(buffer):
+    # NumPy wraps the memory of the buffer, nothing is copied
+    return np.frombuffer(buffer, dtype=np.uint8)
+
+
+def _find_start_codes(data):
+    if len(data) < 3:
+        return np.empty(0, dtype=np.intp)
+    # Ones are rare in compressed data, check the two zeros that precede a start code only there
+    candidates = np.flatnonzero(data[2:] == 1)
+    candidates = candidates[(data[candidates] == 0) & (data[candidates + 1] == 0)]
+    return candidates + 3
+
+
+def find_start_codes(buffer, block_size=None):
+    """
+    :param buffer: any object supporting the buffer protocol, e.g. bytes, bytearray or memoryview.
+    :param block_size: if given, the buffer is scanned this many bytes at a time, which bounds the temporary memory
+    used, e.g. for a memory mapped file.
+    :return: A NumPy array with the offset following every 3-byte start code 00 00 01, in increasing order. A 4-byte
+    start code is a 3-byte one preceded by a zero.
+    """
+    data = _as_array(buffer)
+    if block_size is None or len(data) <= block_size:
+        return _find_start_codes(data)
+    # Blocks overlap by two bytes, so that every start code begins in exactly one block
+    return np.concatenate([_find_start_codes(data[offset:offset + block_size + 2]) + offset
+                           for offset in range(0, len(data), block_size)])
+
+
+def index_nal_units(buffer, block_size=None):
+    """
+    Indexes the NAL units of a H.264 Annex-B byte stream. Empty units are skipped.
+    :param block_size: see `find_start_codes`.
+    :return: Three NumPy arrays, with the offset at which every NAL unit begins, the offset at which it ends (start
+    codes and trailing zeros excluded), and its type.
+    """
+    data = _as_array(buffer)
+    starts = find_start_codes(data, block_size)
+    ends = np.empty_like(starts)
+    ends[:-1] = starts[1:] - 3
+    ends[-1:] = len(data)
+    # Zeros preceding a start code are either the first byte of a 4-byte start code or trailing zeros. Runs of zeros
+    # are short, trim them one byte at a time for all the units at once.
+    while True:
+        has_trailing_zero = ends > starts
+        has_trailing_zero[has_trailing_zero] = data[ends[has_trailing_zero] - 1] == 0
+        if not has_trailing_zero.any():
+            break
+        ends[has_trailing_zero] -= 1
+    non_empty = ends > starts
+    starts = starts[non_empty]
+    ends = ends[non_empty]
+    return starts, ends, data[starts] & 0x1f
+
+
+def iterate_nal_units(buffer):
+    """
+    :return: A generator of (type, memoryview) for every NAL unit of the H.264 Annex-B byte stream in buffer. The views
+    share the memory of buffer.
+    """
+    view = memoryview(buffer)
+    starts, ends, nal_types = index_nal_units(view)
+    for start, end, nal_type in zip(starts.tolist(), ends.tolist(), nal_types.tolist()):
+        yield nal_type, view[start:end]
+
+
+def frame_type_of(buffer):
+    """
+    Classifies an encoder output made of whole NAL units like picamera does.
+    :return: `PiVideoFrameType.sps_header` if it contains a SPS, `PiVideoFrameType.key_frame` if it contains an IDR
+    slice, `PiVideoFrameType.frame` otherwise.
+    """
+    _, _, nal_types = index_nal_units(buffer)
+    if (nal_types == NAL_TYPE_SPS).any():
+        return PiVideoFrameType.sps_header
+    elif (nal_types == NAL_TYPE_IDR).any():
+        return PiVideoFrameType.key_frame
+    return PiVideoFrameType.frame
+
+
+def iterate_access_units(buffer, block_size=None):
+    """
+    Groups the NAL units of a H.264 Annex-B byte stream in the chunks that the encoder of the Raspberry Pi writes: the
+    parameter sets together, then one chunk per picture. A picture begins at its first slice, or at the SEI or AUD units
+    that precede it. Only the first slice of a picture has first_mb_in_slice equal to zero, i.e. the first bit after the
+    NAL unit header set.
+    :param block_size: see `find_start_codes`.
+    :return: A generator of (frame_type, begin, end), where frame_type is a PiVideoFrameType (see `frame_type_of`) and
+    begin, end delimit the chunk in buffer, start codes included.
+    """
+    data = _as_array(buffer)
+    starts, ends, nal_types = index_nal_units(data, block_size)
+    begin = None
+    frame_type = None
+    has_picture = False
+    for start, end, nal_type in zip(starts.tolist(), ends.tolist(), nal_types.tolist()):
+        unit_begin = start - 3
+        if nal_type in (NAL_TYPE_SPS, NAL_TYPE_PPS):
+            if has_picture:
+                yield frame_type, begin, unit_begin
+                begin, frame_type, has_picture = None, None, False
+            frame_type = PiVideoFrameType.sps_header
+        elif nal_type in (NAL_TYPE_IDR, NAL_TYPE_NON_IDR):
+            is_first_slice = end - start < 2 or (data[start + 1] & 0x80) != 0
+            if frame_type == PiVideoFrameType.sps_header or (has_picture and is_first_slice):
+                yield frame_type, begin, unit_begin
+                begin, frame_type, has_picture = None, None, False
+            has_picture = True
+            if nal_type == NAL_TYPE_IDR:
+                frame_type = PiVideoFrameType.key_frame
+            elif frame_type is None:
+                frame_type = PiVideoFrameType.frame
+        elif has_picture:
+            yield frame_type, begin, unit_begin
+            begin, frame_type, has_picture = None, None, False
+        if begin is None:
+            begin = unit_begin
+    if frame_type is not None:
+        yield frame_type, begin, len(data)
+
+
+def benchmark(num_bytes=64 * 1024 * 1024, nal_unit_size=4096, repeat=5):
+    """
+    Times `index_nal_units` on random data with a start code every `nal_unit_size` bytes.
+    :return: The best throughput in bytes per second.
+    """
+    data = np.random.randint(0, 256, size=num_bytes, dtype=np.uint8)
+    for offset in range(0, num_bytes - 5, nal_unit_size):
+        data[offset:offset + 5] = (0, 0, 0, 1, NAL_TYPE_NON_IDR)
+    view = memoryview(data.tobytes())
+    best_time = None
+    for _ in range(repeat):
+        start_time = perf_counter()
+        index_nal_units(view)
+        elapsed = perf_counter() - start_time
+        best_time = elapsed if best_time is None else min(best_time, elapsed)
+    return num_bytes / best_time
+
+
+if __name__ == '__main__':  # pragma: no cover
+    print('index_nal_units: %0.0f MB/s' % (benchmark() / (1024 * 1024)))
@@ -0,0 +1,38 @@
+class SettleDetector:
+    """
+    Detects when a sequence of sensor readings (e.g. gains and exposure speed) has converged, that is, when
+    consecutive readings differ by less than a relative tolerance for a number of times in a row.
+    """
+
+    def __init__(self, tolerance=0.02, num_stable_readings=3):
+        self._tolerance = tolerance
+        self._num_stable_readings = num_stable_readings
+        self._last_reading = None
+        self._stable_count = 0
+
+    @property
+    def settled(self):
+        return self._stable_count >= self._num_stable_readings
+
+    def _is_close(self, lhs, rhs):
+        return abs(lhs - rhs) <= self._tolerance * max(abs(lhs), abs(rhs))
+
+    def update(self, reading):
+        """
+        Feeds a new reading.
+        :param reading: a tuple of numbers. Readings containing non-positive values are considered invalid (the sensor
+        has not produced any frame yet) and reset the detector.
+        :return: True if the readings have settled.
+        """
+        reading = tuple(float(v) for v in reading)
+        if any(v <= 0. for v in reading):
+            self._last_reading = None
+            self._stable_count = 0
+            return False
+        if self._last_reading is not None and len(reading) == len(self._last_reading) and \
+                all(self._is_close(l, r) for l, r in zip(self._last_reading, reading)):
+            self._stable_count += 1
+        else:
+            self._stable_count = 0
+        self._last_reading = reading
+        return self.settled
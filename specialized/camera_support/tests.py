@@ -0,0 +1,565 @@
+import unittest
+import io
+import os
+import struct
+from specialized.camera_support.settle import SettleDetector
+from specialized.camera_support.mux import RingBufferedMP4, MP4StreamMuxer, TemporaryMP4Muxer
+from specialized.camera_support.block_writer import BlockWriter, WriteStats, WRITE_STATS
+from specialized.camera_support.archive import SegmentIndex, segment_name
+from tempfile import TemporaryDirectory
+from specialized.camera_support.mp4 import split_annex_b, move_movie_box_to_front, iterate_boxes, read_duration, \
+    read_samples
+from specialized.camera_support.trim import select_active_gops, trim_to_motion
+from specialized.camera_support.frame_stats import FrameStats
+from specialized.camera_support.broadcast import LatestFrameBroadcaster
+from specialized.camera_support.nal import find_start_codes, index_nal_units, iterate_nal_units, frame_type_of, \
+    iterate_access_units, benchmark, NAL_TYPE_SPS, NAL_TYPE_PPS, NAL_TYPE_IDR
+from misc.cam_replay import load_demo_events
+from safe_picamera import PiVideoFrameType, PiVideoFrame
+from threading import Thread
+
+
+class TestSettleDetector(unittest.TestCase):
+    def test_settles(self):
+        detector = SettleDetector(tolerance=0.1, num_stable_readings=2)
+        self.assertFalse(detector.update((1., 8.)))
+        self.assertFalse(detector.update((2., 4.)))
+        self.assertFalse(detector.update((2.05, 4.)))
+        self.assertTrue(detector.update((2.1, 3.9)))
+        self.assertTrue(detector.settled)
+
+    def test_resets_on_change(self):
+        detector = SettleDetector(tolerance=0.1, num_stable_readings=2)
+        detector.update((1., 1.))
+        detector.update((1., 1.))
+        self.assertFalse(detector.update((1., 2.)))
+        self.assertFalse(detector.update((1., 2.)))
+        self.assertTrue(detector.update((1., 2.)))
+
+    def test_invalid_readings(self):
+        detector = SettleDetector(tolerance=0.1, num_stable_readings=1)
+        self.assertFalse(detector.update((0., 1.)))
+        self.assertFalse(detector.update((0., 1.)))
+        self.assertFalse(detector.update((1., 1.)))
+        self.assertTrue(detector.update((1., 1.)))
+
+
+class TestRingBufferedMP4(unittest.TestCase):
+    @staticmethod
+    def append_gop(ring, num_frames, frame_size=10):
+        ring.append(b'\x00' * frame_size, True, True)
+        for _ in range(num_frames):
+            ring.append(b'\x00' * frame_size, False, True)
+
+    def test_ages(self):
+        with RingBufferedMP4() as ring:
+            # Data before the first SPS header is dropped
+            ring.append(b'\x00', False, True)
+            self.assertEqual(ring.size, 0)
+            self.assertEqual(ring.total_age, 1)
+            self.append_gop(ring, 3)
+            self.append_gop(ring, 4)
+            self.assertEqual(ring.buffer_age, 7)
+            self.assertEqual(ring.footage_age, 7)
+            self.assertEqual(ring.total_age, 8)
+            self.assertEqual(ring.size, 90)
+
+    def test_rewind(self):
+        with RingBufferedMP4() as ring:
+            self.append_gop(ring, 3)
+            ring.rewind_buffer()
+            self.assertEqual(ring.buffer_age, 3)
+            self.append_gop(ring, 4)
+            self.assertEqual(ring.buffer_age, 7)
+            # Keeps the footage since the previous rewind
+            ring.rewind_buffer()
+            self.assertEqual(ring.buffer_age, 4)
+
+    def test_rewind_while_recording(self):
+        with RingBufferedMP4() as ring:
+            self.append_gop(ring, 3)
+            ring.record()
+            self.append_gop(ring, 4)
+            ring.rewind_buffer()
+            self.append_gop(ring, 5)
+            self.assertEqual(ring.buffer_age, 5)
+            self.assertEqual(ring.footage_age, 12)
+            ring.stop_and_discard()
+            self.assertFalse(ring.is_recording)
+            self.assertEqual(ring.buffer_age, 5)
+
+    def test_max_size(self):
+        with RingBufferedMP4(max_size=100) as ring:
+            self.append_gop(ring, 4)
+            self.append_gop(ring, 4)
+            self.assertEqual(ring.buffer_age, 8)
+            self.append_gop(ring, 4)
+            self.assertLessEqual(ring.size, 100)
+            self.assertEqual(ring.buffer_age, 8)
+            # The size is enforced at GOP boundaries, the GOP being appended is never dropped
+            self.append_gop(ring, 20)
+            self.assertEqual(ring.buffer_age, 24)
+            ring.append(b'\x00', True, True)
+            self.assertEqual(ring.buffer_age, 0)
+            self.assertEqual(ring.size, 1)
+
+    def test_detach_does_not_mux(self):
+        demo_data = load_demo_events()
+        writes = [evt for evt in demo_data['events'] if evt.event_type.value == 'write']
+        num_frames = sum(1 for evt in writes if evt.frame.complete and
+                         evt.frame.frame_type != PiVideoFrameType.sps_header)
+        with RingBufferedMP4() as ring:
+            ring.record()
+            for evt in writes:
+                ring.append(evt.data, evt.frame.frame_type == PiVideoFrameType.sps_header, evt.frame.complete)
+            num_writes = WRITE_STATS.num_writes
+            # The encoder callback only hands off the GOPs
+            part = ring.split_and_detach()
+            for evt in writes:
+                ring.append(evt.data, evt.frame.frame_type == PiVideoFrameType.sps_header, evt.frame.complete)
+            last_part = ring.stop_and_detach()
+            self.assertEqual(WRITE_STATS.num_writes, num_writes)
+            self.assertEqual((part.age, last_part.age), (num_frames, num_frames))
+            # The buffer is still there for the next recording
+            self.assertEqual(ring.buffer_age, num_frames)
+        for detached in (part, last_part):
+            file_name = detached.finalize(demo_data['framerate'], demo_data['resolution'])
+            try:
+                with open(file_name, 'rb') as fp:
+                    self.assertAlmostEqual(read_duration(fp), num_frames / demo_data['framerate'], places=3)
+            finally:
+                os.remove(file_name)
+        self.assertGreater(WRITE_STATS.num_writes, num_writes)
+
+    def test_detach_keeps_fragment_configuration(self):
+        demo_data = load_demo_events()
+        writes = [evt for evt in demo_data['events'] if evt.event_type.value == 'write']
+        num_frames = sum(1 for evt in writes if evt.frame.complete and
+                         evt.frame.frame_type != PiVideoFrameType.sps_header)
+        configuration = [(demo_data['framerate'], demo_data['resolution'])]
+        with RingBufferedMP4(fragment_configuration=lambda: configuration[0]) as ring:
+            ring.record()
+            for evt in writes:
+                ring.append(evt.data, evt.frame.frame_type == PiVideoFrameType.sps_header, evt.frame.complete)
+            detached = ring.stop_and_detach()
+        # The camera is reconfigured before the GOPs are muxed
+        configuration[0] = (2 * demo_data['framerate'], demo_data['resolution'])
+        file_name = detached.finalize(None, None)
+        try:
+            with open(file_name, 'rb') as fp:
+                self.assertAlmostEqual(read_duration(fp), num_frames / demo_data['framerate'], places=3)
+        finally:
+            os.remove(file_name)
+
+
+class TestBlockWriter(unittest.TestCase):
+    def test_aligned_writes(self):
+        stats = WriteStats()
+        with io.BytesIO() as stream:
+            writer = BlockWriter(stream, block_size=16, stats=stats)
+            writer.write(b'a' * 10)
+            self.assertEqual(stats.num_writes, 0)
+            writer.write(b'b' * 10)
+            self.assertEqual(stats.num_writes, 1)
+            self.assertEqual(stats.num_bytes, 16)
+            self.assertEqual(writer.num_pending_bytes, 4)
+            writer.write(b'c' * 40)
+            self.assertEqual(stats.num_bytes, 48)
+            self.assertEqual(writer.tell(), 60)
+            writer.flush()
+            self.assertEqual(stats.num_writes, 3)
+            self.assertEqual(stream.getvalue(), b'a' * 10 + b'b' * 10 + b'c' * 40)
+
+    def test_seek(self):
+        stats = WriteStats()
+        with io.BytesIO() as stream:
+            writer = BlockWriter(stream, block_size=16, stats=stats)
+            writer.write(b'a' * 20)
+            writer.seek(2)
+            writer.write(b'b' * 2)
+            # Realigns to the block boundaries after a seek
+            writer.write(b'c' * 14)
+            self.assertEqual(writer.num_pending_bytes, 2)
+            writer.seek(0, io.SEEK_END)
+            self.assertEqual(writer.tell(), 20)
+            self.assertEqual(stream.getvalue(), b'aabb' + b'c' * 14 + b'aa')
+            self.assertEqual(stats.num_writes, 4)
+            self.assertAlmostEqual(stats.bytes_per_write, 9.)
+
+    def test_passthrough(self):
+        stats = WriteStats()
+        with io.BytesIO() as stream:
+            writer = BlockWriter(stream, block_size=0, stats=stats)
+            writer.write(b'a')
+            writer.write(b'b')
+            self.assertEqual(stats.num_writes, 2)
+            self.assertEqual(stream.getvalue(), b'ab')
+
+
+class TestSegmentIndex(unittest.TestCase):
+    @staticmethod
+    def make_segment(folder, start_time, end_time, size=10):
+        with open(os.path.join(folder, segment_name(start_time, end_time)), 'wb') as fp:
+            fp.write(b'\x00' * size)
+
+    def test_find(self):
+        with TemporaryDirectory() as folder:
+            for i in range(5):
+                self.make_segment(folder, 100. + 10 * i, 110. + 10 * i)
+            index = SegmentIndex(folder)
+            index.scan()
+            self.assertEqual(index.num_segments, 5)
+            self.assertEqual((index.start_time, index.end_time), (100., 150.))
+            self.assertEqual(index.find(125.), [os.path.join(folder, segment_name(120., 130.))])
+            self.assertEqual(len(index.find(115., 135.)), 3)
+            self.assertEqual(index.find(90.), [])
+            self.assertEqual(index.find(160.), [])
+
+    def test_recovers_partial_segments(self):
+        with TemporaryDirectory() as folder:
+            with open(os.path.join(folder, segment_name(100.)), 'wb') as fp:
+                fp.write(b'\x00')
+            os.utime(os.path.join(folder, segment_name(100.)), (130., 130.))
+            index = SegmentIndex(folder)
+            index.scan()
+            self.assertEqual(os.listdir(folder), [segment_name(100., 130.)])
+            self.assertEqual(index.end_time, 130.)
+
+    def test_evict(self):
+        with TemporaryDirectory() as folder:
+            index = SegmentIndex(folder)
+            for i in range(5):
+                self.make_segment(folder, 100. + 10 * i, 110. + 10 * i)
+                index.add(segment_name(100. + 10 * i, 110. + 10 * i), 100. + 10 * i, 110. + 10 * i, 10)
+            self.assertEqual(index.evict(25), 3)
+            self.assertEqual(index.start_time, 130.)
+            self.assertEqual(len(os.listdir(folder)), 2)
+            # Never drops the newest segment
+            self.assertEqual(index.evict(0), 1)
+            self.assertEqual(index.num_segments, 1)
+
+
+class TestMP4Muxer(unittest.TestCase):
+    DEMO_DATA = load_demo_events()
+
+    @staticmethod
+    def top_level_boxes(data):
+        boxes = []
+        offset = 0
+        while offset < len(data):
+            size, box_type = struct.unpack_from('>I4s', data, offset)
+            if size == 1:
+                size, = struct.unpack_from('>Q', data, offset + 8)
+            boxes.append((box_type, size))
+            offset += size
+        return boxes
+
+    def mux_demo_data(self, muxer, repeat=1):
+        num_frames = 0
+        muxer.begin()
+        for _ in range(repeat):
+            for evt in self.DEMO_DATA['events']:
+                if evt.event_type.value != 'write':
+                    continue
+                muxer.append(evt.data, evt.frame.frame_type == PiVideoFrameType.sps_header, evt.frame.complete)
+                if evt.frame.frame_type != PiVideoFrameType.sps_header and evt.frame.complete:
+                    num_frames += 1
+        return num_frames
+
+    def test_split_annex_b(self):
+        self.assertEqual(split_annex_b(b'\x00\x00\x00\x01\x67\x01\x00\x00\x01\x68\x02\x00'),
+                         [b'\x67\x01', b'\x68\x02'])
+        self.assertEqual(split_annex_b(b'\x00\x00'), [])
+
+    def test_regular(self):
+        muxer = MP4StreamMuxer(io.BytesIO())
+        num_frames = self.mux_demo_data(muxer)
+        muxer.end(self.DEMO_DATA['framerate'], self.DEMO_DATA['resolution'])
+        data = muxer.stream.getvalue()
+        self.assertEqual(muxer.num_samples, num_frames)
+        boxes = self.top_level_boxes(data)
+        self.assertEqual([box_type for box_type, _ in boxes], [b'ftyp', b'mdat', b'moov'])
+        self.assertEqual(sum(size for _, size in boxes), len(data))
+
+    def test_fast_start(self):
+        muxer = MP4StreamMuxer(io.BytesIO(), fast_start=True)
+        self.mux_demo_data(muxer)
+        muxer.end(self.DEMO_DATA['framerate'], self.DEMO_DATA['resolution'])
+        self.assertTrue(muxer.moov_before_mdat)
+        boxes = self.top_level_boxes(muxer.stream.getvalue())
+        self.assertEqual([box_type for box_type, _ in boxes], [b'ftyp', b'moov', b'free', b'mdat'])
+
+    def test_move_movie_box_to_front(self):
+        muxer = MP4StreamMuxer(io.BytesIO())
+        self.mux_demo_data(muxer)
+        muxer.end(self.DEMO_DATA['framerate'], self.DEMO_DATA['resolution'])
+        self.assertFalse(muxer.moov_before_mdat)
+        with io.BytesIO() as fast_start_stream:
+            move_movie_box_to_front(muxer.stream, fast_start_stream)
+            data = fast_start_stream.getvalue()
+            boxes = list(iterate_boxes(fast_start_stream))
+        self.assertEqual([box[0] for box in boxes], [b'ftyp', b'moov', b'mdat'])
+        self.assertEqual(len(data), len(muxer.stream.getvalue()))
+        # The only chunk offset must point to the first sample, right after the mdat header
+        stco_offset = data.find(b'stco')
+        chunk_offset, = struct.unpack_from('>I', data, stco_offset + 12)
+        self.assertEqual(chunk_offset, boxes[2][1] + 16)
+
+    def test_temporary_mp4(self):
+        with TemporaryMP4Muxer() as temp_mp4:
+            for evt in self.DEMO_DATA['events']:
+                if evt.event_type.value == 'write':
+                    temp_mp4.append(evt.data, evt.frame.frame_type == PiVideoFrameType.sps_header,
+                                    evt.frame.complete)
+            file_name = temp_mp4.finalize(self.DEMO_DATA['framerate'], self.DEMO_DATA['resolution'],
+                                          keep_recording=False)
+        try:
+            with open(file_name, 'rb') as fp:
+                data = fp.read()
+            boxes = self.top_level_boxes(data)
+            self.assertIn(b'moov', [box_type for box_type, _ in boxes])
+            self.assertEqual(sum(size for _, size in boxes), len(data))
+        finally:
+            os.remove(file_name)
+
+    def test_fragmented(self):
+        muxer = MP4StreamMuxer(io.BytesIO(), fragment_configuration=lambda: (
+            self.DEMO_DATA['framerate'], self.DEMO_DATA['resolution']))
+        num_frames = self.mux_demo_data(muxer, repeat=2)
+        # Every SPS header closes a fragment, so the first GOP is already complete on file
+        boxes = self.top_level_boxes(muxer.stream.getvalue())
+        self.assertEqual([box_type for box_type, _ in boxes], [b'ftyp', b'moov', b'moof', b'mdat'])
+        muxer.end(None, None)
+        boxes = self.top_level_boxes(muxer.stream.getvalue())
+        self.assertEqual([box_type for box_type, _ in boxes], [b'ftyp', b'moov', b'moof', b'mdat', b'moof', b'mdat'])
+        self.assertEqual(muxer.num_samples, num_frames)
+
+    def test_read_duration(self):
+        framerate = self.DEMO_DATA['framerate']
+        regular = MP4StreamMuxer(io.BytesIO(), fast_start=True)
+        num_frames = self.mux_demo_data(regular)
+        regular.end(framerate, self.DEMO_DATA['resolution'])
+        self.assertAlmostEqual(read_duration(regular.stream), num_frames / framerate, places=3)
+        fragmented = MP4StreamMuxer(io.BytesIO(), fragment_configuration=lambda: (
+            framerate, self.DEMO_DATA['resolution']))
+        num_frames = self.mux_demo_data(fragmented, repeat=2)
+        fragmented.end(None, None)
+        self.assertAlmostEqual(read_duration(fragmented.stream), num_frames / framerate, places=3)
+        self.assertIsNone(read_duration(io.BytesIO()))
+
+    def test_read_samples(self):
+        for fragment_configuration in (None, lambda: (self.DEMO_DATA['framerate'], self.DEMO_DATA['resolution'])):
+            muxer = MP4StreamMuxer(io.BytesIO(), fragment_configuration=fragment_configuration)
+            num_frames = self.mux_demo_data(muxer, repeat=2)
+            muxer.end(self.DEMO_DATA['framerate'], self.DEMO_DATA['resolution'])
+            sps, pps, samples = read_samples(muxer.stream)
+            self.assertEqual(sps[0] & 0x1f, 7)
+            self.assertEqual(pps[0] & 0x1f, 8)
+            self.assertEqual(len(samples), num_frames)
+            self.assertEqual(sum(1 for _, _, is_sync in samples if is_sync), 2)
+            self.assertTrue(samples[0][2])
+            data = muxer.stream.getvalue()
+            # Every sample starts with the size of its first NAL unit
+            for offset, size, _ in samples:
+                self.assertLessEqual(struct.unpack_from('>I', data, offset)[0] + 4, size)
+
+
+class TestTrim(unittest.TestCase):
+    DEMO_DATA = load_demo_events()
+
+    def test_select_active_gops(self):
+        scores = [0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0]
+        self.assertEqual(select_active_gops([3, 3, 3, 3], scores, 0.5, 1), [False, True, False, False])
+        self.assertEqual(select_active_gops([3, 3, 3, 3], scores, 0.5, 2), [True, True, True, False])
+        self.assertEqual(select_active_gops([3, 3, 3, 3], scores, 2., 2), [False] * 4)
+        # Frames without a score are kept
+        self.assertEqual(select_active_gops([3, 3, 3, 3], scores[4:], 0.5, 0), [True, True, False, False])
+
+    def test_trim_to_motion(self):
+        gop_lengths = []
+        with TemporaryMP4Muxer() as temp_mp4:
+            for _ in range(3):
+                gop_lengths.append(0)
+                for evt in self.DEMO_DATA['events']:
+                    if evt.event_type.value != 'write':
+                        continue
+                    is_sps_header = evt.frame.frame_type == PiVideoFrameType.sps_header
+                    temp_mp4.append(evt.data, is_sps_header, evt.frame.complete)
+                    if evt.frame.complete and not is_sps_header:
+                        gop_lengths[-1] += 1
+            file_name = temp_mp4.finalize(self.DEMO_DATA['framerate'], self.DEMO_DATA['resolution'],
+                                          keep_recording=False)
+        trimmed_file_name = None
+        try:
+            # Motion only in the middle of the second GOP
+            scores = [0.] * gop_lengths[0] + [0.] * 10 + [1.] + [0.] * (gop_lengths[1] - 11) + [0.] * gop_lengths[2]
+            self.assertIsNone(trim_to_motion(file_name, [1.] * len(scores), 0.5, 0, self.DEMO_DATA['framerate'],
+                                             self.DEMO_DATA['resolution']))
+            trimmed_file_name = trim_to_motion(file_name, scores, 0.5, 0, self.DEMO_DATA['framerate'],
+                                               self.DEMO_DATA['resolution'], fast_start=True)
+            self.assertIsNotNone(trimmed_file_name)
+            with open(trimmed_file_name, 'rb') as fp:
+                _, _, samples = read_samples(fp)
+                self.assertAlmostEqual(read_duration(fp), gop_lengths[1] / self.DEMO_DATA['framerate'], places=3)
+            self.assertEqual(len(samples), gop_lengths[1])
+            self.assertTrue(samples[0][2])
+        finally:
+            os.remove(file_name)
+            if trimmed_file_name is not None:
+                os.remove(trimmed_file_name)
+
+
+class TestFrameStats(unittest.TestCase):
+    @staticmethod
+    def make_frame(index, timestamp, frame_type=PiVideoFrameType.frame):
+        return PiVideoFrame(index=index, frame_type=frame_type, frame_size=0, video_size=0, split_size=0,
+                            timestamp=timestamp, complete=True)
+
+    def test_dropped_and_late_frames(self):
+        stats = FrameStats(stall_time=2.)
+        # 10 fps, the frame index also counts motion data
+        stats.update_frame(self.make_frame(0, 0, PiVideoFrameType.key_frame), 0., 10.)
+        stats.update_frame(self.make_frame(2, 100000), 0.1, 10.)
+        # Two frames dropped by the camera
+        stats.update_frame(self.make_frame(4, 400000), 0.4, 10.)
+        # On time for the camera, but late for the process
+        stats.update_frame(self.make_frame(6, 500000), 0.7, 10.)
+        # SPS headers and incomplete frames do not count
+        stats.update_frame(self.make_frame(7, None, PiVideoFrameType.sps_header), 0.7, 10.)
+        stats.update_frame(self.make_frame(8, 600000, PiVideoFrameType.key_frame), 0.8, 10.)
+        self.assertFalse(stats.update_frame(self.make_frame(10, 700000), 0.9, 10.))
+        self.assertTrue(stats.update_frame(self.make_frame(12, 800000), 3.5, 10.))
+        stats_dict = stats.to_dict()
+        self.assertEqual(stats_dict['num_frames'], 7)
+        self.assertEqual(stats_dict['num_dropped_frames'], 2)
+        self.assertEqual(stats_dict['num_drop_events'], 1)
+        self.assertEqual(stats_dict['num_late_frames'], 1)
+        self.assertEqual(stats_dict['num_stalls'], 1)
+        self.assertEqual(stats_dict['key_frame_interval'], {'mean': 4., 'max': 4})
+        self.assertAlmostEqual(stats_dict['frame_interval']['max'], 0.3)
+
+    def test_restart(self):
+        stats = FrameStats()
+        stats.update_frame(self.make_frame(10, 1000000), 1., 10.)
+        stats.restart()
+        self.assertIsNone(stats.time_since_last_frame(2.))
+        # No gap is measured across a restart, and a lower index is a restart too
+        stats.update_frame(self.make_frame(20, 5000000), 10., 10.)
+        stats.update_frame(self.make_frame(0, 100000), 10.1, 10.)
+        stats.update_frame(self.make_frame(2, 200000), 10.2, 10.)
+        self.assertEqual(stats.num_frames, 4)
+        self.assertEqual(stats.num_dropped_frames, 0)
+        self.assertEqual(stats.num_stalls, 0)
+        self.assertEqual(stats.to_dict()['num_restarts'], 1)
+        self.assertAlmostEqual(stats.time_since_last_frame(10.5), 0.3)
+        stats.reset()
+        self.assertEqual(stats.num_frames, 0)
+
+    def test_motion_callbacks(self):
+        stats = FrameStats()
+        for arrival_time in (0., 0.1, 0.2, 0.5):
+            stats.update_motion(arrival_time, 10.)
+        stats_dict = stats.to_dict()
+        self.assertEqual(stats_dict['num_late_motion_callbacks'], 1)
+        self.assertAlmostEqual(stats_dict['motion_interval']['max'], 0.3)
+
+
+class TestNAL(unittest.TestCase):
+    DEMO_DATA = load_demo_events()
+
+    def test_find_start_codes(self):
+        self.assertEqual(find_start_codes(b'\x00\x00\x00\x01\x67\x00\x00\x01\x68\x01').tolist(), [4, 8])
+        self.assertEqual(find_start_codes(b'\x00\x01').tolist(), [])
+        self.assertEqual(find_start_codes(b'\x00\x00\x03\x01').tolist(), [])
+
+    def test_index_nal_units(self):
+        data = bytearray(b'\x00\x00\x00\x01\x67\x01\x00\x00\x01\x68\x02\x00\x00\x00\x00\x01\x65\x00')
+        starts, ends, nal_types = index_nal_units(data)
+        self.assertEqual(starts.tolist(), [4, 9, 16])
+        self.assertEqual(ends.tolist(), [6, 11, 17])
+        self.assertEqual(nal_types.tolist(), [NAL_TYPE_SPS, NAL_TYPE_PPS, NAL_TYPE_IDR])
+        nal_units = list(iterate_nal_units(data))
+        self.assertEqual([(nal_type, view.tobytes()) for nal_type, view in nal_units],
+                         [(NAL_TYPE_SPS, b'\x67\x01'), (NAL_TYPE_PPS, b'\x68\x02'), (NAL_TYPE_IDR, b'\x65')])
+        # The views share the memory of the buffer
+        data[5] = 0x02
+        self.assertEqual(nal_units[0][1].tobytes(), b'\x67\x02')
+
+    def test_matches_split_annex_b(self):
+        stream = b''.join(evt.data for evt in self.DEMO_DATA['events'] if evt.event_type.value == 'write')
+        self.assertGreater(len(stream), 32 * 1024)
+        nal_units = split_annex_b(stream)
+        # Large buffers go through the vectorized indexer, frames are split one at a time by bytes.find
+        self.assertEqual(nal_units, [nal_unit for evt in self.DEMO_DATA['events'] if evt.event_type.value == 'write'
+                                     for nal_unit in split_annex_b(evt.data)])
+
+    def test_frame_type_of(self):
+        for evt in self.DEMO_DATA['events']:
+            if evt.event_type.value == 'write' and evt.frame.complete:
+                self.assertEqual(frame_type_of(evt.data), evt.frame.frame_type)
+
+    def test_block_size(self):
+        stream = b''.join(evt.data for evt in self.DEMO_DATA['events'] if evt.event_type.value == 'write')
+        # Some start codes straddle the blocks
+        self.assertEqual(find_start_codes(stream, block_size=1001).tolist(), find_start_codes(stream).tolist())
+
+    def test_iterate_access_units(self):
+        writes = [evt for evt in self.DEMO_DATA['events'] if evt.event_type.value == 'write']
+        stream = b''.join(evt.data for evt in writes)
+        access_units = list(iterate_access_units(stream))
+        self.assertEqual(len(access_units), len(writes))
+        for (frame_type, begin, end), evt in zip(access_units, writes):
+            self.assertEqual(frame_type, evt.frame.frame_type)
+            self.assertEqual(split_annex_b(stream[begin:end]), split_annex_b(evt.data))
+        # A slice with first_mb_in_slice > 0 continues the picture, SEI and AUD begin a new one
+        stream = b'\x00\x00\x01\x65\x80\x00\x00\x01\x65\x40\x00\x00\x01\x09\x10\x00\x00\x01\x41\x80'
+        self.assertEqual(list(iterate_access_units(stream)),
+                         [(PiVideoFrameType.key_frame, 0, 10), (PiVideoFrameType.frame, 10, len(stream))])
+
+    def test_benchmark(self):
+        self.assertGreater(benchmark(num_bytes=1024 * 1024, repeat=1), 0.)
+
+
+
+class TestLatestFrameBroadcaster(unittest.TestCase):
+    def test_partial_frames(self):
+        broadcaster = LatestFrameBroadcaster()
+        broadcaster.append(b'ab', complete=False)
+        self.assertIsNone(broadcaster.wait_for_frame(timeout=0.))
+        broadcaster.append(b'cd')
+        self.assertEqual(broadcaster.wait_for_frame(timeout=0.), (1, b'abcd'))
+        broadcaster.append(b'ef', complete=False)
+        broadcaster.discard_partial_frame()
+        broadcaster.append(b'gh')
+        self.assertEqual(broadcaster.wait_for_frame(1, timeout=0.), (2, b'gh'))
+
+    def test_skips_to_latest(self):
+        broadcaster = LatestFrameBroadcaster()
+        for i in range(5):
+            broadcaster.append(bytes([i]))
+        # A slow consumer gets only the latest frame, another one is not affected
+        self.assertEqual(broadcaster.wait_for_frame(1, timeout=0.), (5, b'\x04'))
+        self.assertEqual(broadcaster.wait_for_frame(timeout=0.), (5, b'\x04'))
+        self.assertIsNone(broadcaster.wait_for_frame(5, timeout=0.01))
+
+    def test_wakes_up_consumers(self):
+        broadcaster = LatestFrameBroadcaster()
+        results = []
+        consumers = [Thread(target=lambda: results.append(broadcaster.wait_for_frame(timeout=5.))) for _ in range(3)]
+        for consumer in consumers:
+            consumer.start()
+        broadcaster.append(b'frame')
+        for consumer in consumers:
+            consumer.join()
+        self.assertEqual(results, [(1, b'frame')] * 3)
+
+    def test_close(self):
+        broadcaster = LatestFrameBroadcaster()
+        broadcaster.append(b'frame')
+        consumer = Thread(target=broadcaster.wait_for_frame, args=(1, 5.))
+        consumer.start()
+        broadcaster.close()
+        consumer.join(1.)
+        self.assertFalse(consumer.is_alive())
+        self.assertTrue(broadcaster.closed)
+        self.assertIsNone(broadcaster.wait_for_frame())
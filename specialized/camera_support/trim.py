@@ -0,0 +1,107 @@
+import logging
+import os
+from struct import error as struct_error
+from specialized.camera_support.mp4 import read_samples, sample_to_annex_b
+from specialized.camera_support.mux import TemporaryMP4Muxer
+
+
+_log = logging.getLogger('trim')
+
+
+def split_into_gops(samples):
+    """
+    :param samples: the samples as returned by `read_samples`.
+    :return: A list of lists of samples, each one starting at a sync sample. Samples preceding the first sync sample
+    are dropped.
+    """
+    gops = []
+    for sample in samples:
+        if sample[2]:
+            gops.append([])
+        if len(gops) > 0:
+            gops[-1].append(sample)
+    return gops
+
+
+def select_active_gops(gop_lengths, frame_scores, min_score, margin):
+    """
+    :param gop_lengths: number of frames in each GOP.
+    :param frame_scores: the motion score of each frame, aligned with the last frame. Frames without a score count
+    as active.
+    :param min_score: frames with at least this score are active.
+    :param margin: number of frames around each active frame that are kept too.
+    :return: A list of booleans, True for the GOPs containing at least one active frame or a frame within the margin.
+    """
+    num_frames = sum(gop_lengths)
+    num_missing = max(0, num_frames - len(frame_scores))
+    frame_scores = list(frame_scores)[-num_frames:] if num_frames > 0 else []
+    is_active = [True] * num_missing + [score >= min_score for score in frame_scores]
+    # Extend every active stretch by the margin on both sides
+    is_kept = [False] * num_frames
+    last_active = None
+    for i in range(num_frames):
+        if is_active[i]:
+            last_active = i
+        is_kept[i] = last_active is not None and i - last_active <= margin
+    next_active = None
+    for i in reversed(range(num_frames)):
+        if is_active[i]:
+            next_active = i
+        is_kept[i] = is_kept[i] or (next_active is not None and next_active - i <= margin)
+    selection = []
+    start = 0
+    for gop_length in gop_lengths:
+        selection.append(any(is_kept[start:start + gop_length]))
+        start += gop_length
+    return selection
+
+
+def trim_to_motion(file_name, frame_scores, min_score, margin, framerate, resolution, fragment_configuration=None,
+                   fast_start=False):
+    """
+    Copies the GOPs of the MP4 `file_name` that contain motion (see `select_active_gops`) to a new temporary MP4,
+    without re-encoding. The kept GOPs are concatenated.
+    :return: The name of the trimmed MP4, or None if every GOP, or none, has motion, and the file is left as is.
+    """
+    with open(file_name, 'rb') as src:
+        sps, pps, samples = read_samples(src)
+        gops = split_into_gops(samples)
+        selection = select_active_gops([len(gop) for gop in gops], frame_scores, min_score, margin)
+        if all(selection) or not any(selection):
+            return None
+        _log.info('Keeping %d out of %d GOPs of %s.', sum(selection), len(gops), file_name)
+        parameter_sets = b'\x00\x00\x00\x01' + sps + b'\x00\x00\x00\x01' + pps
+        trimmed = TemporaryMP4Muxer(expected_size=sum(size for gop in gops for _, size, _ in gop),
+                                    fragment_configuration=fragment_configuration, fast_start=fast_start)
+        trimmed.__enter__()
+        try:
+            for gop, keep in zip(gops, selection):
+                if not keep:
+                    continue
+                trimmed.append(parameter_sets, True, True)
+                for offset, size, _ in gop:
+                    src.seek(offset)
+                    trimmed.append(sample_to_annex_b(src.read(size)), False, True)
+            return trimmed.finalize(framerate, resolution, keep_recording=False)
+        except:
+            trimmed.__exit__(None, None, None)
+            raise
+
+
+def replace_with_trimmed(file_name, *args, **kwargs):
+    """
+    Calls `trim_to_motion`, and if the MP4 was trimmed, removes `file_name`.
+    :return: The name of the trimmed MP4, or `file_name` if it was not trimmed.
+    """
+    try:
+        trimmed_file_name = trim_to_motion(file_name, *args, **kwargs)
+    except (OSError, ValueError, struct_error):
+        _log.exception('Unable to trim %s, will keep it as is.', file_name)
+        return file_name
+    if trimmed_file_name is None:
+        return file_name
+    try:
+        os.remove(file_name)
+    except OSError:  # pragma: no cover
+        _log.exception('Unable to remove %s.', file_name)
+    return trimmed_file_name
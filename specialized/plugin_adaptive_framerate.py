@@ -0,0 +1,133 @@
+from plugins.base import Process
+from plugins.decorators import make_plugin
+from plugins.processes_host import find_plugin
+from Pyro4 import expose as pyro_expose
+import logging
+from misc.logging import ensure_logging_setup, camel_to_snake
+from misc.settings import SETTINGS
+from specialized.plugin_picamera import PiCameraProcessBase
+from specialized.plugin_motion_detector import MotionDetectorResponder, MOTION_DETECTOR_PLUGIN_NAME
+from specialized.plugin_buffered_recorder import BUFFERED_RECORDER_PLUGIN_NAME
+from specialized.support.thread_host import CallbackThreadHost
+from time import monotonic
+
+
+ADAPTIVE_FRAMERATE_PLUGIN_NAME = 'AdaptiveFramerate'
+ensure_logging_setup()
+_log = logging.getLogger(camel_to_snake(ADAPTIVE_FRAMERATE_PLUGIN_NAME))
+
+
+@make_plugin(ADAPTIVE_FRAMERATE_PLUGIN_NAME, Process.CAMERA)
+class AdaptiveFrameratePlugin(PiCameraProcessBase, MotionDetectorResponder):
+    """
+    Runs the camera at an idle framerate when nothing moves, and switches to the full framerate as soon as the motion
+    detector sees any activity. The camera goes back to idle only after `idle_delay` seconds without activity, and
+    never while the buffered recorder is recording or finalizing a clip. Every switch restarts the encoder; the buffered
+    recorder delivers the footage buffered at the old framerate as the first part of a recording that starts right
+    after, so that the pre-trigger footage is not lost on a ramp up.
+    """
+    def __init__(self):
+        super(AdaptiveFrameratePlugin, self).__init__()
+        self._idle_framerate = SETTINGS.camera.get('idle_framerate', cast_to_type=float, default=None, ge=0.1,
+                                                   le=90., allow_none=True)
+        self._active_framerate = SETTINGS.camera.get('framerate', cast_to_type=float, default=30., ge=0.1, le=90.)
+        self._idle_delay = SETTINGS.camera.get('idle_delay', cast_to_type=float, default=10., ge=0.)
+        self._last_activity_time = None
+        self._is_idle = False
+        self._switch_pending = False
+        self._switch_thread = CallbackThreadHost('adaptive_framerate_thread', self._switch_framerate)
+
+    def __enter__(self):
+        self._last_activity_time = monotonic()
+        self._is_idle = False
+        self._switch_pending = False
+        self._switch_thread.__enter__()
+        return super(AdaptiveFrameratePlugin, self).__enter__()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        super(AdaptiveFrameratePlugin, self).__exit__(exc_type, exc_val, exc_tb)
+        self._switch_thread.__exit__(exc_type, exc_val, exc_tb)
+
+    @pyro_expose
+    @property
+    def idle_framerate(self):
+        return self._idle_framerate
+
+    @pyro_expose
+    @idle_framerate.setter
+    def idle_framerate(self, value):
+        self._idle_framerate = None if value is None else min(max(float(value), 0.1), 90.)
+        self._request_switch()
+
+    @pyro_expose
+    @property
+    def active_framerate(self):
+        return self._active_framerate
+
+    @pyro_expose
+    @active_framerate.setter
+    def active_framerate(self, value):
+        self._active_framerate = min(max(float(value), 0.1), 90.)
+        self._request_switch()
+
+    @pyro_expose
+    @property
+    def idle_delay(self):
+        return self._idle_delay
+
+    @pyro_expose
+    @idle_delay.setter
+    def idle_delay(self, value):
+        self._idle_delay = max(float(value), 0.)
+
+    @pyro_expose
+    @property
+    def is_idle(self):
+        return self._is_idle
+
+    @property
+    def _recorder_busy(self):
+        recorder = find_plugin(BUFFERED_RECORDER_PLUGIN_NAME, Process.CAMERA)
+        return recorder is not None and (recorder.is_recording or recorder.is_finalizing)
+
+    @property
+    def _detector_sees_activity(self):
+        detector = find_plugin(MOTION_DETECTOR_PLUGIN_NAME, Process.CAMERA)
+        return detector is not None and detector.activity
+
+    @property
+    def _should_be_idle(self):
+        if self._idle_framerate is None:
+            return False
+        if monotonic() - self._last_activity_time < self._idle_delay:
+            return False
+        return not self._recorder_busy
+
+    def _request_switch(self):
+        if not self._switch_pending:
+            self._switch_pending = True
+            self._switch_thread.wake()
+
+    def _switch_framerate(self):
+        self._switch_pending = False
+        go_idle = self._should_be_idle
+        framerate = self._idle_framerate if go_idle else self._active_framerate
+        root = self.root_picamera_plugin
+        if root is None or framerate == root.framerate:
+            self._is_idle = go_idle
+            return
+        _log.info('Switching to %s framerate %0.1f.', 'idle' if go_idle else 'active', framerate)
+        root.reconfigure(framerate=framerate)
+        self._is_idle = go_idle
+
+    def analyze(self, array):
+        if self._detector_sees_activity:
+            self._last_activity_time = monotonic()
+        if self._is_idle != self._should_be_idle:
+            self._request_switch()
+
+    def _motion_status_changed_internal(self, is_moving, node=None):
+        if is_moving:
+            self._last_activity_time = monotonic()
+            if self._is_idle:
+                self._request_switch()
@@ -1,50 +1,150 @@
 from plugins.base import Process
 from specialized.plugin_picamera import PiCameraProcessBase
 from plugins.decorators import make_plugin
-from specialized.camera_support.mux import DualBufferedMP4
-from specialized.plugin_media_manager import MEDIA_MANAGER_PLUGIN_NAME
+from specialized.camera_support.mux import DualBufferedMP4, RingBufferedMP4
+from specialized.camera_support.block_writer import WRITE_STATS
+from specialized.camera_support.trim import replace_with_trimmed
+from specialized.plugin_media_manager import MEDIA_MANAGER_PLUGIN_NAME, MAIN_STREAM, SECONDARY_STREAM
+from specialized.plugin_motion_detector import MOTION_DETECTOR_PLUGIN_NAME
 from plugins.processes_host import find_plugin
 from Pyro4 import expose as pyro_expose
 import logging
 from misc.logging import ensure_logging_setup, camel_to_snake
-from datetime import datetime
 from misc.settings import SETTINGS
 from safe_picamera import PiVideoFrameType
 from threading import Lock
+from collections import OrderedDict
+from array import array
 import math
 from specialized.plugin_status_led import Status
+from specialized.support.thread_host import CallbackQueueThreadHost
+from time import monotonic
 
 
 BUFFERED_RECORDER_PLUGIN_NAME = 'BufferedRecorder'
+SECONDARY_RECORDER_PLUGIN_NAME = 'SecondaryRecorder'
 ensure_logging_setup()
 _log = logging.getLogger(camel_to_snake(BUFFERED_RECORDER_PLUGIN_NAME))
 
 
+class _RecordingSession:
+    """
+    A request to record. It ends when stopped, or when the footage reaches `max_footage_age` frames, if not None.
+    """
+
+    def __init__(self, session_id, info):
+        self.session_id = session_id
+        self.info = info
+        self.max_footage_age = None
+        self.is_active = True
+        self.keep_media = True
+
+
+def _merge_infos(infos):
+    unique_infos = []
+    for info in infos:
+        if info not in unique_infos:
+            unique_infos.append(info)
+    return unique_infos[0] if len(unique_infos) == 1 else unique_infos
+
+
 @make_plugin(BUFFERED_RECORDER_PLUGIN_NAME, Process.CAMERA)
 class BufferedRecorderPlugin(PiCameraProcessBase):
+    """
+    Records clips out of a rolling buffer of the camera stream. Every call to `record` opens a session; overlapping
+    sessions share the same recording, which goes on until the last session stops, and is finalized once. The clip is
+    delivered with the info of the session, or with the list of the distinct infos if several sessions shared it.
+
+    While the motion detector runs, the motion score of every frame is recorded, and the clip is delivered with the
+    highest score of its frames. If `camera.trim_to_motion` is set, the GOPs of the clip without any frame scoring at
+    least `camera.trim_min_motion_score`, or within `camera.trim_margin` seconds of one, are cut before delivery. Clips
+    without motion at all are delivered whole.
+
+    When the last session stops, the clip is held open for `camera.clip_merge_window` seconds: a session started in the
+    meantime continues the same clip, so that intermittent motion yields one clip rather than many short ones. The
+    footage recorded while waiting stays in the clip (and is cut by `camera.trim_to_motion`, if set).
+
+    Recordings that would exceed `camera.clip_max_bytes`, or that last longer than `camera.part_length` seconds, are
+    split at a key frame, and delivered as numbered parts as soon as each part is complete.
+
+    If the camera produces a secondary stream, every session is also recorded on it by `SecondaryRecorderPlugin`.
+
+    A reconfiguration of the camera cannot carry the buffered footage over to the new framerate or resolution. If
+    nothing is recording, the buffer is kept aside as a pre-roll: a session starting within the buffer length receives
+    it as its first part, so that e.g. ramping up the framerate on motion keeps the pre-trigger footage.
+    """
+
     def __init__(self):
         super(BufferedRecorderPlugin, self).__init__()
         self._last_sps_header_stamp = 0
-        self._recorder = DualBufferedMP4()
-        self._record_user_info = None
-        self._is_recording = False
-        self._keep_media = True
+        self._fragmented = SETTINGS.camera.get('fragmented_mp4', cast_to_type=bool, default=False)
+        fragment_configuration = self._footage_configuration if self._fragmented else None
+        fast_start = SETTINGS.camera.get('fast_start_mp4', cast_to_type=bool, default=True)
+        self._fast_start = fast_start
+        self._trim_to_motion = SETTINGS.camera.get('trim_to_motion', cast_to_type=bool, default=False)
+        self._trim_min_motion_score = SETTINGS.camera.get('trim_min_motion_score', cast_to_type=float,
+                                                          default=0.00002, ge=0., le=1.)
+        self._trim_margin = SETTINGS.camera.get('trim_margin', cast_to_type=float, default=1., ge=0.)
+        # Motion score of the last frames, up to the oldest frame of the footage
+        self._motion_scores = array('f')
+        self._motion_scores_lock = Lock()
+        self._clip_max_bytes = SETTINGS.camera.get('clip_max_bytes', cast_to_type=int, allow_none=True,
+                                                   default=45 * 1024 * 1024, ge=64 * 1024)
+        self._part_length = SETTINGS.camera.get('part_length', cast_to_type=float, allow_none=True, default=None,
+                                                ge=1.)
+        self._gop_size = 0
+        self._last_gop_size = 0
+        self._clip_merge_window = SETTINGS.camera.get('clip_merge_window', cast_to_type=float, default=0., ge=0.)
+        # Total age at which the last session stopped, while the clip is held open for further sessions
+        self._merge_window_start = None
+        # Number of parts of the current recording that were already handed off
+        self._num_parts = 0
+        if SETTINGS.camera.get('buffer_in_memory', cast_to_type=bool, default=True):
+            self._recorder = RingBufferedMP4(SETTINGS.camera.get('buffer_max_bytes', cast_to_type=int,
+                                                                 default=8 * 1024 * 1024, ge=64 * 1024),
+                                             fragment_configuration=fragment_configuration, fast_start=fast_start)
+        else:
+            self._recorder = DualBufferedMP4(fragment_configuration=fragment_configuration, fast_start=fast_start)
+        self._sessions = OrderedDict()
+        self._sessions_lock = Lock()
+        self._last_session_id = 0
         self._flush_lock = Lock()
         self._has_just_flushed = False
         self._buffer_max_age = None
         self._sps_header_max_age = None
-        self._footage_max_age = None
         self._record_status = None
         self._record_status_lock = Lock()
+        self._resume_after_reconfigure = None
+        # Framerate and resolution of the buffered footage while the camera is being reconfigured
+        self._reconfiguring_from = None
+        # Framerate and resolution of the buffer that will be kept as pre-roll at the end of the reconfiguration
+        self._preroll_configuration = None
+        # Finalization arguments of the pre-roll and the monotonic time until which it may start a session
+        self._preroll = None
+        self._preroll_expiry = None
+        self._holds_encoder = False
+        self._stop_request_time = None
+        self._last_stop_to_delivery_time = None
+        self._num_pending_finalizations = 0
+        self._pending_finalizations_lock = Lock()
+        # A single worker finalizes the clips in the order they were stopped; clips still queued at exit are
+        # finalized before the plugin exits
+        self._finalize_thread = CallbackQueueThreadHost(camel_to_snake(self.plugin_name()) + '_finalize_thread',
+                                                        self._finalize_clip, drain_on_exit=True)
 
     def __enter__(self):
         super(BufferedRecorderPlugin, self).__enter__()
         self._has_just_flushed = True
         self._recorder.__enter__()
+        self._finalize_thread.__enter__()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._set_recording_status(False)
+        self._set_holds_encoder(False)
+        with self._sessions_lock:
+            self._discard_preroll()
+        self._finalize_thread.__exit__(exc_type, exc_val, exc_tb)
         self._recorder.__exit__(exc_type, exc_val, exc_tb)
         super(BufferedRecorderPlugin, self).__exit__(exc_type, exc_val, exc_tb)
 
@@ -53,9 +153,20 @@ class BufferedRecorderPlugin(PiCameraProcessBase):
             if value and self._record_status is None:
                 self._record_status = Status.pulse((1, 0, 0))
                 self._record_status.__enter__()
+                self.root_picamera_plugin.set_annotation_field(BUFFERED_RECORDER_PLUGIN_NAME, 'REC')
             elif not value and self._record_status is not None:
                 self._record_status.__exit__(None, None, None)
                 self._record_status = None
+                self.root_picamera_plugin.set_annotation_field(BUFFERED_RECORDER_PLUGIN_NAME, None)
+
+    def _set_holds_encoder(self, value):
+        if value == self._holds_encoder:
+            return
+        self._holds_encoder = value
+        if value:
+            self.root_picamera_plugin.acquire_encoder(self.plugin_name())
+        else:
+            self.root_picamera_plugin.release_encoder(self.plugin_name())
 
     @pyro_expose
     @property
@@ -72,18 +183,140 @@ class BufferedRecorderPlugin(PiCameraProcessBase):
     def total_age(self):
         return self._recorder.total_age
 
+    @pyro_expose
+    @property
+    def footage_size(self):
+        return self._recorder.footage_size
+
+    @pyro_expose
+    @property
+    def clip_max_bytes(self):
+        return self._clip_max_bytes
+
+    @pyro_expose
+    @clip_max_bytes.setter
+    def clip_max_bytes(self, value):
+        self._clip_max_bytes = None if value is None else max(64 * 1024, int(value))
+
+    @pyro_expose
+    @property
+    def part_length(self):
+        """
+        Seconds after which an ongoing recording is split and its footage delivered, or None to deliver it whole.
+        """
+        return self._part_length
+
+    @pyro_expose
+    @part_length.setter
+    def part_length(self, value):
+        self._part_length = None if value is None else max(1., float(value))
+
+    @pyro_expose
+    @property
+    def clip_merge_window(self):
+        """
+        Seconds for which a stopped clip waits for new sessions before being finalized.
+        """
+        return self._clip_merge_window
+
+    @pyro_expose
+    @clip_merge_window.setter
+    def clip_merge_window(self, value):
+        self._clip_merge_window = max(0., float(value))
+
+    @property
+    def _in_merge_window(self):
+        if self._merge_window_start is None:
+            return False
+        return self._recorder.total_age - self._merge_window_start < self._clip_merge_window * self._camera.framerate
+
     @pyro_expose
     @property
     def footage_max_age(self):
-        return self._footage_max_age
+        """
+        Footage age at which the recording stops, or None if it does not stop on its own.
+        """
+        with self._sessions_lock:
+            max_footage_ages = [session.max_footage_age for session in self._sessions.values() if session.is_active]
+        if len(max_footage_ages) == 0 or None in max_footage_ages:
+            return None
+        return max(max_footage_ages)
+
+    @pyro_expose
+    @property
+    def session_ids(self):
+        """
+        Ids of the sessions that are recording.
+        """
+        with self._sessions_lock:
+            return [session.session_id for session in self._sessions.values() if session.is_active]
+
+    @property
+    def _is_recording(self):
+        with self._sessions_lock:
+            return any(session.is_active for session in self._sessions.values())
+
+    @property
+    def _keep_media(self):
+        with self._sessions_lock:
+            return any(session.keep_media for session in self._sessions.values())
+
+    @pyro_expose
+    @property
+    def last_stop_to_delivery_time(self):
+        """
+        Seconds elapsed between the last request to stop a clip and the delivery of the finalized file.
+        """
+        return self._last_stop_to_delivery_time
+
+    @pyro_expose
+    @property
+    def write_stats(self):
+        """
+        Number of writes and bytes written to the temporary MP4 files in the CAMERA process.
+        """
+        return WRITE_STATS.to_dict()
+
+    @pyro_expose
+    @property
+    def num_pending_finalizations(self):
+        return self._num_pending_finalizations
 
     @property
     def _camera(self):
         return self.root_picamera_plugin.camera
 
+    @property
+    def _resolution(self):
+        return self._camera.resolution
+
+    def _footage_configuration(self):
+        # The footage is detached after the camera changed configuration, and before the buffer is reset
+        if self._reconfiguring_from is not None:
+            return self._reconfiguring_from
+        return self._camera.framerate, self._resolution
+
     @property
     def _last_frame(self):
-        return self._camera.frame
+        return self.root_picamera_plugin.video_frame
+
+    def _request_key_frame(self):
+        self._camera.request_key_frame()
+
+    @property
+    def _secondary_recorder(self):
+        """
+        The SecondaryRecorderPlugin that follows the sessions of this recorder, or None.
+        """
+        secondary_recorder = find_plugin(SECONDARY_RECORDER_PLUGIN_NAME, Process.CAMERA)
+        if secondary_recorder is None or not secondary_recorder.enabled:
+            return None
+        return secondary_recorder
+
+    @property
+    def _stream(self):
+        # Stream of the delivered media, see `Media`
+        return None if self._secondary_recorder is None else MAIN_STREAM
 
     @pyro_expose
     @property
@@ -117,45 +350,265 @@ class BufferedRecorderPlugin(PiCameraProcessBase):
     def _last_sps_header_age(self):
         return self._recorder.total_age - self._last_sps_header_stamp
 
+    def _stop_expired_sessions(self):
+        footage_age = self.footage_age
+        with self._sessions_lock:
+            expired_sessions = [session for session in self._sessions.values() if session.is_active and
+                                session.max_footage_age is not None and footage_age >= session.max_footage_age]
+        if len(expired_sessions) > 0:
+            self._stop_and(True, [session.session_id for session in expired_sessions],
+                           handle_split_point_if_flushed=False)
+
+    @property
+    def _exceeds_clip_max_bytes(self):
+        """
+        True if the recording would likely exceed `clip_max_bytes` with one more GOP.
+        """
+        if self._clip_max_bytes is None or not self._recorder.is_recording:
+            return False
+        footage_size = self._recorder.footage_size
+        return footage_size > 0 and footage_size + self._last_gop_size >= self._clip_max_bytes
+
+    @property
+    def _exceeds_part_length(self):
+        if self._part_length is None or not self._recorder.is_recording:
+            return False
+        return self._recorder.footage_age >= self._part_length * self._camera.framerate
+
+    @property
+    def _must_split_part(self):
+        return self._exceeds_clip_max_bytes or self._exceeds_part_length
+
+    def _push_finalization(self, clip, infos, stop_request_time, caption):
+        self._queue_finalization(clip, self._camera.framerate, self._resolution, infos, stop_request_time,
+                                 self._clip_motion_scores(), caption)
+
+    def _queue_finalization(self, clip, framerate, resolution, infos, stop_request_time, motion_scores, caption):
+        # Muxing the buffered GOPs and writing the MP4 trailer take time, do not stall the encoder callback with them
+        with self._pending_finalizations_lock:
+            self._num_pending_finalizations += 1
+        self._finalize_thread.push_operation((clip, framerate, resolution, _merge_infos(infos), stop_request_time,
+                                              motion_scores, caption))
+
+    def _discard_preroll(self):
+        if self._preroll is not None:
+            _log.debug('Discarding the pre-roll.')
+            self._preroll[0].discard()
+            self._preroll = None
+            self._preroll_expiry = None
+
     def _handle_split_point(self):
-        if self.footage_max_age is not None and self.footage_age >= self.footage_max_age:
-            self._stop_and(True, handle_split_point_if_flushed=False)
-            self._footage_max_age = None
-        if self._recorder.is_recording and not self._is_recording:
-            # We requested stop, but we haven't reached a split point. Now we can really stop.
-            if self._keep_media:
-                media_mgr = find_plugin(MEDIA_MANAGER_PLUGIN_NAME, Process.CAMERA)
-                if not media_mgr:
-                    _log.error('No media manager is running on the CAMERA process.')
-                    _log.info('Discarding media with info %s.', str(self._record_user_info))
+        self._stop_expired_sessions()
+        with self._sessions_lock:
+            # A held clip that must be split anyway ends here, rather than continuing in a part without sessions
+            must_stop = self._recorder.is_recording and \
+                not any(session.is_active for session in self._sessions.values()) and \
+                (not self._in_merge_window or self._must_split_part)
+            if must_stop:
+                if self._merge_window_start is not None:
+                    # Measure the delivery time from the end of the wait
+                    self._stop_request_time = monotonic()
+                    self._merge_window_start = None
+                # We requested stop, but we haven't reached a split point. Now we can really stop.
+                infos = [session.info for session in self._sessions.values() if session.keep_media]
+                self._sessions.clear()
+                if len(infos) > 0 and self._num_parts > 0 and self._recorder.footage_size == 0:
+                    # The recording stopped right after a part was handed off
+                    _log.info('Media with info %s ended with part %d.', str(_merge_infos(infos)), self._num_parts)
                     self._recorder.stop_and_discard()
+                elif len(infos) > 0:
+                    caption = None if self._num_parts == 0 else 'Part %d (last)' % (self._num_parts + 1)
+                    self._push_finalization(self._recorder.stop_and_detach(), infos, self._stop_request_time,
+                                            caption)
                 else:
-                    file_name = self._recorder.stop_and_finalize(self._camera.framerate, self._camera.resolution)
-                    media = media_mgr.deliver_media(file_name, 'mp4', self._record_user_info)
-                    _log.info('Media %s with info %s was delivered.', str(media.uuid), str(self._record_user_info))
-            else:
-                _log.info('Discarding media with info %s.', str(self._record_user_info))
-                self._recorder.stop_and_discard()
-            self._record_user_info = None
+                    _log.info('Discarding media.')
+                    self._recorder.stop_and_discard()
+                self._num_parts = 0
+            elif self._must_split_part:
+                # Hand off what was recorded so far, the sessions that already stopped end with this part
+                self._num_parts += 1
+                infos = [session.info for session in self._sessions.values() if session.keep_media]
+                for session_id in [session.session_id for session in self._sessions.values() if not session.is_active]:
+                    del self._sessions[session_id]
+                _log.info('Splitting media with info %s into part %d of %d bytes and %d frames.',
+                          str(_merge_infos(infos)), self._num_parts, self._recorder.footage_size,
+                          self._recorder.footage_age)
+                self._push_finalization(self._recorder.split_and_detach(), infos, None, 'Part %d' % self._num_parts)
+            if self._preroll is not None and monotonic() > self._preroll_expiry:
+                self._discard_preroll()
+        if must_stop:
+            self._set_holds_encoder(False)
         if self._recorder.buffer_age > self.buffer_max_age:
             self._recorder.rewind_buffer()
+        self._drop_old_motion_scores()
         # Update the sps header age
         self._last_sps_header_stamp = self._recorder.total_age
 
-    @pyro_expose
-    def record(self, info=None, stop_after_seconds=None):
-        _log.info('Requested media with info %s of maximum length %s.', str(info), str(stop_after_seconds))
-        self._keep_media = True
-        self._is_recording = True
-        self._record_user_info = info
-        if stop_after_seconds is not None:
-            stop_after_seconds = float(stop_after_seconds)
-            if stop_after_seconds < 0 or math.isinf(stop_after_seconds):
-                self._footage_max_age = None
+    def _clip_motion_scores(self):
+        with self._motion_scores_lock:
+            # The clip ends with the last frame, which is all that is needed to align the scores
+            return array('f', self._motion_scores)
+
+    def _drop_old_motion_scores(self):
+        num_scores_to_keep = max(self._recorder.footage_age, self._recorder.buffer_age)
+        with self._motion_scores_lock:
+            if len(self._motion_scores) > num_scores_to_keep:
+                del self._motion_scores[:len(self._motion_scores) - num_scores_to_keep]
+
+    def _record_motion_score(self):
+        motion_detector = find_plugin(MOTION_DETECTOR_PLUGIN_NAME, Process.CAMERA)
+        if motion_detector is None and not self._trim_to_motion:
+            return
+        # Without a detector, no frame is ever trimmed
+        score = 1. if motion_detector is None else motion_detector.motion_score
+        with self._motion_scores_lock:
+            self._motion_scores.append(score)
+
+    def _trim_clip(self, file_name, motion_scores, framerate, resolution):
+        fragment_configuration = (lambda: (framerate, resolution)) if self._fragmented else None
+        return replace_with_trimmed(file_name, motion_scores, self._trim_min_motion_score,
+                                    int(self._trim_margin * framerate), framerate, resolution,
+                                    fragment_configuration=fragment_configuration, fast_start=self._fast_start)
+
+    @staticmethod
+    def _peak_motion_score(motion_scores, num_frames):
+        if find_plugin(MOTION_DETECTOR_PLUGIN_NAME, Process.CAMERA) is None or num_frames <= 0 or \
+                len(motion_scores) == 0:
+            return None
+        return float(max(motion_scores[-num_frames:]))
+
+    def _finalize_clip(self, args):
+        clip, framerate, resolution, info, stop_request_time, motion_scores, caption = args
+        try:
+            media_mgr = find_plugin(MEDIA_MANAGER_PLUGIN_NAME, Process.CAMERA)
+            if not media_mgr:
+                _log.error('No media manager is running on the CAMERA process.')
+                _log.info('Discarding media with info %s.', str(info))
+                clip.discard()
+                return
+            motion_score = self._peak_motion_score(motion_scores, clip.age)
+            file_name = clip.finalize(framerate, resolution)
+            if self._trim_to_motion:
+                file_name = self._trim_clip(file_name, motion_scores, framerate, resolution)
+            media = media_mgr.deliver_media(file_name, 'mp4', info, caption, stream=self._stream,
+                                            motion_score=motion_score)
+            if stop_request_time is None:
+                _log.info('Media %s with info %s was delivered.', str(media.uuid), str(info))
             else:
-                self._footage_max_age = int(max(1., stop_after_seconds) * self._camera.framerate)
-        self._set_recording_status(True)
+                self._last_stop_to_delivery_time = monotonic() - stop_request_time
+                _log.info('Media %s with info %s was delivered %s s after stopping.', str(media.uuid), str(info),
+                          str(self._last_stop_to_delivery_time))
+        except:  # pragma: no cover
+            _log.exception('Unable to finalize media with info %s.', str(info))
+        finally:
+            with self._pending_finalizations_lock:
+                self._num_pending_finalizations -= 1
+
+    def camera_reconfiguring(self, old_config, new_config):
+        if old_config.resolution == new_config.resolution and old_config.framerate == new_config.framerate:
+            return
+        self._reconfiguring_from = (old_config.framerate, self._resolution)
+        if self.is_recording:
+            # A clip cannot span different resolutions or framerates. Finalize on the flush that stops the encoder
+            # and resume the sessions as soon as the new configuration is in place.
+            footage_age = self.footage_age
+            with self._sessions_lock:
+                active_sessions = [session for session in self._sessions.values() if session.is_active]
+            self._resume_after_reconfigure = []
+            for session in active_sessions:
+                stop_after_seconds = None
+                if session.max_footage_age is not None:
+                    stop_after_seconds = max(0, session.max_footage_age - footage_age) / old_config.framerate
+                self._resume_after_reconfigure.append((session.session_id, session.info, stop_after_seconds))
+            _log.info('Splitting media with info %s because of camera reconfiguration.',
+                      str(_merge_infos([session.info for session in active_sessions])))
+            self._stop_and(True, handle_split_point_if_flushed=False)
+            self._merge_window_start = None
+        elif self._merge_window_start is not None:
+            _log.info('Finalizing held media because of camera reconfiguration.')
+            self._merge_window_start = None
+        else:
+            # The buffer is complete only after the flush that stops the encoder, keep it aside then
+            self._preroll_configuration = self._reconfiguring_from
+
+    def camera_reconfigured(self, old_config, new_config):
+        if old_config.resolution == new_config.resolution and old_config.framerate == new_config.framerate:
+            return
+        preroll_configuration, self._preroll_configuration = self._preroll_configuration, None
+        if preroll_configuration is not None and self._recorder.buffer_age > 0:
+            self._keep_preroll(*preroll_configuration)
+        # Ages are measured in frames, keep them constant in time
+        framerate_ratio = new_config.framerate / old_config.framerate
+        if self._buffer_max_age is not None:
+            self._buffer_max_age *= framerate_ratio
+        if self._sps_header_max_age is not None:
+            self._sps_header_max_age *= framerate_ratio
+        # The buffered footage is incompatible with the new configuration
+        self._recorder.reset()
+        self._reconfiguring_from = None
+        with self._motion_scores_lock:
+            del self._motion_scores[:]
+        self._last_sps_header_stamp = self._recorder.total_age
+        self._has_just_flushed = True
+        if self._resume_after_reconfigure is not None:
+            for session_id, info, stop_after_seconds in self._resume_after_reconfigure:
+                self._start_session(_RecordingSession(session_id, info), stop_after_seconds)
+            self._resume_after_reconfigure = None
+
+    def _keep_preroll(self, framerate, resolution):
+        motion_scores = self._clip_motion_scores()
+        # A session starting within `camera.buffer` seconds would have found this footage in the buffer
+        preroll_length = 0.5 * self.buffer_max_age / framerate
         self._recorder.record()
+        clip = self._recorder.stop_and_detach()
+        with self._sessions_lock:
+            self._discard_preroll()
+            self._preroll = (clip, framerate, resolution, motion_scores)
+            self._preroll_expiry = monotonic() + preroll_length
+        _log.info('Keeping %d frames at framerate %0.1f as pre-roll.', clip.age, framerate)
+
+    def _start_session(self, session, stop_after_seconds):
+        _log.info('Requested media with info %s of maximum length %s.', str(session.info), str(stop_after_seconds))
+        with self._sessions_lock:
+            if stop_after_seconds is not None:
+                stop_after_seconds = float(stop_after_seconds)
+                if stop_after_seconds >= 0 and not math.isinf(stop_after_seconds):
+                    # A session that joins an ongoing recording lasts from now on
+                    footage_age = self.footage_age if self._recorder.is_recording else 0
+                    session.max_footage_age = footage_age + int(max(1., stop_after_seconds) * self._camera.framerate)
+            if self._in_merge_window:
+                _log.info('Continuing held media with session %d.', session.session_id)
+            self._merge_window_start = None
+            if self._preroll is not None:
+                if not self._recorder.is_recording and monotonic() <= self._preroll_expiry:
+                    # The footage from before the reconfiguration becomes the first part of the recording
+                    clip, framerate, resolution, motion_scores = self._preroll
+                    self._preroll = None
+                    self._num_parts = 1
+                    _log.info('Delivering the pre-roll as part 1 of media with info %s.', str(session.info))
+                    self._queue_finalization(clip, framerate, resolution, [session.info], None, motion_scores,
+                                             'Part 1')
+                else:
+                    self._discard_preroll()
+            self._sessions[session.session_id] = session
+            self._recorder.record()
+        self._set_recording_status(True)
+        self._set_holds_encoder(True)
+
+    @pyro_expose
+    def record(self, info=None, stop_after_seconds=None):
+        """
+        Opens a recording session, which joins the ongoing recording, if any.
+        :return: The id of the session, to stop it alone with `stop_and_finalize` or `stop_and_discard`.
+        """
+        with self._sessions_lock:
+            self._last_session_id += 1
+            session = _RecordingSession(self._last_session_id, info)
+        self._start_session(session, stop_after_seconds)
+        secondary_recorder = self._secondary_recorder
+        if secondary_recorder is not None:
+            secondary_recorder._start_session(_RecordingSession(session.session_id, info), stop_after_seconds)
+        return session.session_id
 
     @pyro_expose
     @property
@@ -165,12 +618,34 @@ class BufferedRecorderPlugin(PiCameraProcessBase):
     @pyro_expose
     @property
     def is_finalizing(self):
-        return self._recorder.is_recording and self._keep_media and not self._is_recording
+        return (self._recorder.is_recording and self._keep_media and not self._is_recording) or \
+            self._num_pending_finalizations > 0
 
-    def _stop_and(self, finalize, handle_split_point_if_flushed=True):
+    def _stop_and(self, finalize, session_ids=None, handle_split_point_if_flushed=True):
+        with self._sessions_lock:
+            if session_ids is None:
+                sessions = list(self._sessions.values())
+            else:
+                sessions = [self._sessions[session_id] for session_id in session_ids if session_id in self._sessions]
+                if len(sessions) < len(session_ids):
+                    _log.warning('Attempt to stop unknown recording sessions %s.', str(session_ids))
+            for session in sessions:
+                # Discarding applies also to stopped sessions, whose clip may not be finalized yet
+                if session.is_active or not finalize:
+                    _log.info('Stopping session %d with info %s.', session.session_id, str(session.info))
+                    session.is_active = False
+                    session.keep_media = finalize
+            if any(session.is_active for session in self._sessions.values()):
+                # The recording goes on for the other sessions
+                return
+            if finalize and self._clip_merge_window > 0 and self._recorder.is_recording:
+                # Hold the clip open, a new session may continue it
+                if self._merge_window_start is None:
+                    self._merge_window_start = self._recorder.total_age
+            else:
+                self._merge_window_start = None
+        self._stop_request_time = monotonic()
         self._set_recording_status(False)
-        self._is_recording = False
-        self._keep_media = finalize
         if handle_split_point_if_flushed:
             with self._flush_lock:
                 # This is the only other split point at which we are sure that an SPS will have to follow
@@ -178,29 +653,95 @@ class BufferedRecorderPlugin(PiCameraProcessBase):
                     self._handle_split_point()
 
     @pyro_expose
-    def stop_and_discard(self):
-        self._stop_and(finalize=False)
+    def stop_and_discard(self, session_id=None):
+        """
+        Stops the given session, or all of them if None, and drops its footage.
+        """
+        self._stop_and(False, None if session_id is None else [session_id])
+        secondary_recorder = self._secondary_recorder
+        if secondary_recorder is not None:
+            secondary_recorder._stop_and(False, None if session_id is None else [session_id])
 
     @pyro_expose
-    def stop_and_finalize(self):
-        self._stop_and(finalize=True)
+    def stop_and_finalize(self, session_id=None):
+        """
+        Stops the given session, or all of them if None. The clip is delivered when all the sessions have stopped.
+        """
+        self._stop_and(True, None if session_id is None else [session_id])
+        secondary_recorder = self._secondary_recorder
+        if secondary_recorder is not None:
+            secondary_recorder._stop_and(True, None if session_id is None else [session_id])
 
     def write(self, data):
         with self._flush_lock:
             self._has_just_flushed = False
-        # Update annotation
-        self._camera.annotate_text = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         # If it's a split point, one can stop
         if self._last_frame.frame_type == PiVideoFrameType.sps_header:
+            if self._gop_size > 0:
+                self._last_gop_size, self._gop_size = self._gop_size, 0
             self._handle_split_point()
             self._recorder.append(data, True, self._last_frame.complete)
         else:
             self._recorder.append(data, False, self._last_frame.complete)
+            if self._last_frame.complete:
+                self._record_motion_score()
+        self._gop_size += len(data)
         # Do we need to request a new sps_header
-        if self._last_sps_header_age > min(self.sps_header_max_age, self.buffer_max_age):
-            self._camera.request_key_frame()
+        if self._last_sps_header_age > min(self.sps_header_max_age, self.buffer_max_age) or self._must_split_part:
+            self._request_key_frame()
 
     def flush(self):
         with self._flush_lock:
             self._has_just_flushed = True
             self._handle_split_point()
+
+
+@make_plugin(SECONDARY_RECORDER_PLUGIN_NAME, Process.CAMERA)
+class SecondaryRecorderPlugin(BufferedRecorderPlugin):
+    """
+    Records the secondary, downscaled stream of the camera (see `camera.secondary_resolution`), following the sessions
+    of `BufferedRecorderPlugin`, with the same settings. The clips are delivered as `SECONDARY_STREAM` media, so that
+    receivers can pick the stream that suits them. Idle if the camera has no secondary stream.
+    """
+    @classmethod
+    def plugin_name(cls):
+        return SECONDARY_RECORDER_PLUGIN_NAME
+
+    @pyro_expose
+    @property
+    def enabled(self):
+        return self.root_picamera_plugin.secondary_resolution is not None
+
+    @property
+    def _resolution(self):
+        return self.root_picamera_plugin.secondary_resolution
+
+    @property
+    def _last_frame(self):
+        return self.root_picamera_plugin.secondary_video_frame
+
+    def _request_key_frame(self):
+        self.root_picamera_plugin.request_secondary_key_frame()
+
+    @property
+    def _secondary_recorder(self):
+        return None
+
+    @property
+    def _stream(self):
+        return SECONDARY_STREAM
+
+    def _set_recording_status(self, value):
+        pass  # The main recorder drives the status LED
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+    def write_secondary(self, data):
+        super(SecondaryRecorderPlugin, self).write(data)
+
+    def flush_secondary(self):
+        super(SecondaryRecorderPlugin, self).flush()
@@ -0,0 +1,214 @@
+from plugins.base import Process
+from plugins.decorators import make_plugin
+from plugins.processes_host import find_plugin
+from Pyro4 import expose as pyro_expose
+import logging
+import os
+import shutil
+from time import time
+from misc.logging import ensure_logging_setup, camel_to_snake
+from misc.settings import SETTINGS
+from safe_picamera import PiVideoFrameType
+from specialized.plugin_picamera import PiCameraProcessBase
+from specialized.plugin_media_manager import MEDIA_MANAGER_PLUGIN_NAME
+from specialized.camera_support.archive import SegmentIndex, segment_name
+from specialized.camera_support.block_writer import BlockWriter
+from specialized.camera_support.mux import MP4StreamMuxer
+from specialized.support.temp_storage import named_temporary_file
+from specialized.support.thread_host import CallbackQueueThreadHost
+
+
+DVR_PLUGIN_NAME = 'Dvr'
+ensure_logging_setup()
+_log = logging.getLogger(camel_to_snake(DVR_PLUGIN_NAME))
+
+
+class _Segment:
+    """
+    A fragmented MP4 being written in the archive folder, under a partial name until it is closed.
+    """
+
+    def __init__(self, folder, start_time, fragment_configuration, block_size):
+        self.start_time = start_time
+        self.path = os.path.join(folder, segment_name(start_time))
+        self._fp = open(self.path, 'wb', buffering=0)
+        self._muxer = MP4StreamMuxer(BlockWriter(self._fp, block_size), fragment_configuration=fragment_configuration)
+        self._muxer.begin()
+
+    def append(self, data, frame_is_sps_header, frame_is_complete):
+        self._muxer.append(data, frame_is_sps_header, frame_is_complete)
+
+    def close(self, index, end_time):
+        self._muxer.end(None, None)
+        self._muxer.stream.flush()
+        self._fp.close()
+        name = segment_name(self.start_time, end_time)
+        os.rename(self.path, os.path.join(index.folder, name))
+        index.add(name, self.start_time, end_time, os.path.getsize(os.path.join(index.folder, name)))
+        _log.debug('Archived segment %s.', name)
+
+
+@make_plugin(DVR_PLUGIN_NAME, Process.CAMERA)
+class DvrPlugin(PiCameraProcessBase):
+    """
+    Continuously records the camera stream into the `dvr.archive_folder`, cut at SPS headers into fragmented MP4
+    segments of about `dvr.segment_length` seconds. The oldest segments are removed to keep the archive within
+    `dvr.max_bytes`. Disabled if no archive folder is set.
+    """
+
+    def __init__(self):
+        super(DvrPlugin, self).__init__()
+        self._archive_folder = SETTINGS.dvr.get('archive_folder', cast_to_type=str, allow_none=True, default=None)
+        self._segment_length = SETTINGS.dvr.get('segment_length', cast_to_type=float, default=60., ge=1.)
+        self._max_bytes = SETTINGS.dvr.get('max_bytes', cast_to_type=int, default=1024 * 1024 * 1024, ge=0)
+        self._block_size = SETTINGS.camera.get('write_block_size', cast_to_type=int, default=64 * 1024, ge=0)
+        self._index = None
+        self._segment = None
+        self._key_frame_requested = False
+        self._holds_encoder = False
+        # Segments are closed, indexed and evicted in order, off the encoder callback
+        self._close_thread = CallbackQueueThreadHost('dvr_close_segment_thread', self._close_segment,
+                                                     drain_on_exit=True)
+
+    @property
+    def _enabled(self):
+        return self._archive_folder is not None
+
+    def __enter__(self):
+        super(DvrPlugin, self).__enter__()
+        if self._enabled:
+            os.makedirs(self._archive_folder, exist_ok=True)
+            self._index = SegmentIndex(self._archive_folder)
+            self._index.scan()
+            self._close_thread.__enter__()
+            root = self.root_picamera_plugin
+            if root is not None:
+                root.acquire_encoder(DVR_PLUGIN_NAME)
+                self._holds_encoder = True
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._enabled:
+            if self._holds_encoder:
+                self.root_picamera_plugin.release_encoder(DVR_PLUGIN_NAME)
+                self._holds_encoder = False
+            self._hand_off_segment()
+            self._close_thread.__exit__(exc_type, exc_val, exc_tb)
+        super(DvrPlugin, self).__exit__(exc_type, exc_val, exc_tb)
+
+    @pyro_expose
+    @property
+    def archive_folder(self):
+        return self._archive_folder
+
+    @pyro_expose
+    @property
+    def segment_length(self):
+        return self._segment_length
+
+    @pyro_expose
+    @segment_length.setter
+    def segment_length(self, value):
+        self._segment_length = max(1., float(value))
+
+    @pyro_expose
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @pyro_expose
+    @max_bytes.setter
+    def max_bytes(self, value):
+        self._max_bytes = max(0, int(value))
+
+    @pyro_expose
+    @property
+    def num_segments(self):
+        return 0 if self._index is None else self._index.num_segments
+
+    @pyro_expose
+    @property
+    def archive_size(self):
+        return 0 if self._index is None else self._index.total_size
+
+    @pyro_expose
+    @property
+    def archive_time_span(self):
+        """
+        First and last instant (seconds since the epoch) in the archive, or None if it is empty.
+        """
+        if self._index is None or self._index.num_segments == 0:
+            return None
+        return self._index.start_time, self._index.end_time
+
+    @pyro_expose
+    def find_segments(self, start_time, end_time=None):
+        return [] if self._index is None else self._index.find(start_time, end_time)
+
+    @pyro_expose
+    def export(self, start_time, end_time=None, info=None):
+        """
+        Delivers through the media manager a copy of every archived segment overlapping [start_time, end_time], or
+        containing start_time if end_time is None. Times are in seconds since the epoch.
+        :return: The number of segments delivered.
+        """
+        media_mgr = find_plugin(MEDIA_MANAGER_PLUGIN_NAME, Process.CAMERA)
+        if media_mgr is None:
+            _log.error('No media manager is running on the CAMERA process.')
+            return 0
+        num_delivered = 0
+        for path in self.find_segments(start_time, end_time):
+            try:
+                with open(path, 'rb') as src, named_temporary_file(os.path.getsize(path)) as dst:
+                    shutil.copyfileobj(src, dst)
+            except OSError:
+                _log.exception('Unable to export segment %s.', path)
+                continue
+            media_mgr.deliver_media(dst.name, 'mp4', info)
+            num_delivered += 1
+        return num_delivered
+
+    def _current_configuration(self):
+        camera = self.root_picamera_plugin.camera
+        return camera.framerate, camera.resolution
+
+    def _hand_off_segment(self):
+        if self._segment is not None:
+            self._close_thread.push_operation((self._segment, time()))
+            self._segment = None
+
+    def _close_segment(self, args):
+        segment, end_time = args
+        try:
+            segment.close(self._index, end_time)
+        except OSError:  # pragma: no cover
+            _log.exception('Unable to close segment %s.', segment.path)
+        num_evicted = self._index.evict(self._max_bytes)
+        if num_evicted > 0:
+            _log.info('Evicted %d segments from the archive.', num_evicted)
+
+    def write(self, data):
+        if not self._enabled:
+            return
+        frame = self.root_picamera_plugin.video_frame
+        is_sps_header = frame.frame_type == PiVideoFrameType.sps_header
+        now = time()
+        if is_sps_header and (self._segment is None or now - self._segment.start_time >= self._segment_length):
+            self._hand_off_segment()
+            self._key_frame_requested = False
+            try:
+                self._segment = _Segment(self._archive_folder, now, self._current_configuration, self._block_size)
+            except OSError:  # pragma: no cover
+                _log.exception('Unable to create a new segment in %s.', self._archive_folder)
+                return
+        if self._segment is None:
+            return  # Wait for the first SPS header
+        self._segment.append(data, is_sps_header, frame.complete)
+        if not self._key_frame_requested and now - self._segment.start_time >= self._segment_length:
+            self.root_picamera_plugin.camera.request_key_frame()
+            self._key_frame_requested = True
+
+    def flush(self):
+        # The encoder stopped, e.g. for a reconfiguration or standby: the next segment will start afresh
+        if self._enabled:
+            self._hand_off_segment()
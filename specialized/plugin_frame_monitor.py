@@ -0,0 +1,76 @@
+from plugins.base import Process
+from plugins.decorators import make_plugin
+from Pyro4 import expose as pyro_expose
+import logging
+from time import monotonic
+from misc.logging import ensure_logging_setup, camel_to_snake
+from misc.settings import SETTINGS
+from specialized.plugin_picamera import PiCameraProcessBase
+from specialized.camera_support.frame_stats import FrameStats
+
+
+FRAME_MONITOR_PLUGIN_NAME = 'FrameMonitor'
+ensure_logging_setup()
+_log = logging.getLogger(camel_to_snake(FRAME_MONITOR_PLUGIN_NAME))
+
+
+@make_plugin(FRAME_MONITOR_PLUGIN_NAME, Process.CAMERA)
+class FrameMonitorPlugin(PiCameraProcessBase):
+    """
+    Keeps statistics of the frames of the recording encoder and of the motion analysis callbacks (see `FrameStats`):
+    frames dropped by the camera, frames reaching the CAMERA process late, stalls longer than `camera.stall_time`
+    seconds, and the intervals between key frames. These are the first sign that the Pi is overloaded.
+    """
+
+    def __init__(self):
+        super(FrameMonitorPlugin, self).__init__()
+        self._stats = FrameStats(SETTINGS.camera.get('stall_time', cast_to_type=float, default=2., ge=0.1))
+
+    @property
+    def _framerate(self):
+        return self.root_picamera_plugin.camera.framerate
+
+    @pyro_expose
+    @property
+    def frame_stats(self):
+        return self._stats.to_dict()
+
+    @pyro_expose
+    def reset_frame_stats(self):
+        self._stats.reset()
+
+    @pyro_expose
+    @property
+    def time_since_last_frame(self):
+        """
+        :return: Seconds since the last frame was written, or None if the encoder is not running.
+        """
+        if not self.root_picamera_plugin.is_encoding:
+            return None
+        return self._stats.time_since_last_frame(monotonic())
+
+    @pyro_expose
+    @property
+    def stall_time(self):
+        return self._stats.stall_time
+
+    @pyro_expose
+    @stall_time.setter
+    def stall_time(self, value):
+        self._stats.stall_time = max(0.1, float(value))
+
+    def write(self, data):
+        now = monotonic()
+        time_since_last_frame = self._stats.time_since_last_frame(now)
+        if self._stats.update_frame(self.root_picamera_plugin.video_frame, now, self._framerate):
+            _log.warning('The encoder stalled, no frame for %0.1fs.', time_since_last_frame)
+
+    def analyze(self, array):
+        self._stats.update_motion(monotonic(), self._framerate)
+
+    def flush(self):
+        # The encoder stopped, the next frames are not expected to follow the last one
+        self._stats.restart()
+
+    def camera_reconfigured(self, old_config, new_config):
+        self._stats.restart()
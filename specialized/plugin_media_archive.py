@@ -0,0 +1,146 @@
+from plugins.base import Process, PluginProcessBase
+from plugins.decorators import make_plugin
+from Pyro4 import expose as pyro_expose
+import logging
+import os
+import shutil
+from time import time
+from misc.logging import ensure_logging_setup, camel_to_snake
+from misc.settings import SETTINGS
+from specialized.plugin_media_manager import MediaReceiver, SECONDARY_STREAM
+from specialized.camera_support.mp4 import read_duration
+from specialized.support.media_index import MediaIndex
+from specialized.support.txtutils import user_desc
+
+
+MEDIA_ARCHIVE_PLUGIN_NAME = 'MediaArchive'
+ensure_logging_setup()
+_log = logging.getLogger(camel_to_snake(MEDIA_ARCHIVE_PLUGIN_NAME))
+
+_INDEX_FILE_NAME = 'index.sqlite3'
+_VIDEO_KINDS = ('mp4',)
+
+
+def _trigger_desc(info):
+    if info is None:
+        return 'motion'
+    elif isinstance(info, list):
+        # Several recording sessions shared the media
+        return ', '.join(map(_trigger_desc, info))
+    elif hasattr(info, 'effective_chat'):
+        # A Telegram update
+        return user_desc(info)
+    return str(info)
+
+
+@make_plugin(MEDIA_ARCHIVE_PLUGIN_NAME, Process.MAIN)
+class MediaArchivePlugin(PluginProcessBase, MediaReceiver):
+    """
+    Keeps a copy of every media delivered in `media_archive.folder`, indexed in a SQLite database by time and kind,
+    together with duration, size, trigger and motion score. The oldest media are removed to keep the archive within
+    `media_archive.max_bytes`. The downscaled copies of the media recorded on two streams are not archived. Disabled
+    if no folder is set.
+    """
+
+    def __init__(self):
+        super(MediaArchivePlugin, self).__init__()
+        self._folder = SETTINGS.media_archive.get('folder', cast_to_type=str, allow_none=True, default=None)
+        self._max_bytes = SETTINGS.media_archive.get('max_bytes', cast_to_type=int, default=1024 * 1024 * 1024, ge=0)
+        self._index = None
+
+    def __enter__(self):
+        super(MediaArchivePlugin, self).__enter__()
+        if self._folder is not None:
+            os.makedirs(self._folder, exist_ok=True)
+            self._index = MediaIndex(os.path.join(self._folder, _INDEX_FILE_NAME))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+        super(MediaArchivePlugin, self).__exit__(exc_type, exc_val, exc_tb)
+
+    @pyro_expose
+    @property
+    def folder(self):
+        return self._folder
+
+    @pyro_expose
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @pyro_expose
+    @max_bytes.setter
+    def max_bytes(self, value):
+        self._max_bytes = max(0, int(value))
+
+    @pyro_expose
+    @property
+    def num_entries(self):
+        return 0 if self._index is None else self._index.num_entries
+
+    @pyro_expose
+    @property
+    def archive_size(self):
+        return 0 if self._index is None else self._index.total_size
+
+    @pyro_expose
+    def query(self, kinds=None, since=None, until=None, limit=10):
+        """
+        :return: The archived media matching the criteria, newest first, as dictionaries (see `MediaIndex`), with
+        absolute paths.
+        """
+        if self._index is None:
+            return []
+        return [self._with_absolute_path(entry) for entry in self._index.query(kinds, since, until, limit)]
+
+    @pyro_expose
+    def get(self, entry_id):
+        if self._index is None:
+            return None
+        entry = self._index.get(entry_id)
+        return None if entry is None else self._with_absolute_path(entry)
+
+    def _with_absolute_path(self, entry):
+        entry['path'] = os.path.join(self._folder, entry['path'])
+        return entry
+
+    def _copy_to_archive(self, media):
+        name = '%s.%s' % (str(media.uuid), media.kind)
+        path = os.path.join(self._folder, name)
+        try:
+            # The media manager removes only its own path, so a hard link is enough when on the same file system
+            os.link(media.path, path)
+        except OSError:
+            shutil.copyfile(media.path, path)
+        return name, path
+
+    def handle_media(self, media):
+        if self._index is None or media.kind is None or media.stream == SECONDARY_STREAM or \
+                not os.path.isfile(media.path):
+            return
+        kind = media.kind.lower()
+        try:
+            name, path = self._copy_to_archive(media)
+        except OSError:
+            _log.exception('Unable to archive media %s at %s.', str(media.uuid), media.path)
+            return
+        duration = None
+        if kind in _VIDEO_KINDS:
+            try:
+                with open(path, 'rb') as fp:
+                    duration = read_duration(fp)
+            except (OSError, ValueError):
+                _log.exception('Unable to read the duration of %s.', path)
+        entry_id = self._index.add(time(), kind, os.path.getsize(path), name, duration=duration, uuid=media.uuid,
+                                   trigger=_trigger_desc(media.info), motion_score=media.motion_score)
+        _log.info('Archived media %s as entry %d at %s.', str(media.uuid), entry_id, path)
+        for entry in self._index.evict(self._max_bytes):
+            evicted_path = os.path.join(self._folder, entry['path'])
+            _log.debug('Evicting media %d at %s.', entry['id'], evicted_path)
+            try:
+                os.remove(evicted_path)
+            except OSError:  # pragma: no cover
+                _log.exception('Unable to remove %s.', evicted_path)
@@ -1,22 +1,39 @@
 from Pyro4 import expose as pyro_expose, oneway as pyro_oneway
-from plugins.base import PluginProcessBase, Process, ProcessPack
+from Pyro4.errors import PyroError
+from plugins.base import PluginProcessBase, Process, ProcessPack, node_plugin_name
 from plugins.decorators import register
 from collections import namedtuple
-from plugins.processes_host import active_process, find_plugin, active_plugins
+from plugins.processes_host import active_process, active_node, find_plugin, active_plugins
 import logging
 from uuid import uuid4
 from threading import Lock
 import os
 from misc.logging import camel_to_snake
+from misc.settings import SETTINGS
 from specialized.support.thread_host import CallbackQueueThreadHost
+from specialized.support.temp_storage import named_temporary_file
 
 
 MEDIA_MANAGER_PLUGIN_NAME = 'MediaManager'
 _log = logging.getLogger(camel_to_snake(MEDIA_MANAGER_PLUGIN_NAME))
 
 
-class Media(namedtuple('_Media', ['uuid', 'owning_process', 'kind', 'path', 'info'])):
-    pass
+MAIN_STREAM = 'main'
+SECONDARY_STREAM = 'secondary'
+# The processes of the central host that receive the media of the camera nodes
+_CENTRAL_PROCESSES = (Process.MAIN, Process.TELEGRAM)
+
+
+class Media(namedtuple('_Media', ['uuid', 'owning_process', 'kind', 'path', 'info', 'caption', 'stream', 'node',
+                                  'motion_score'])):
+    """
+    `stream` is None, unless the media is recorded on two camera streams: then it is `MAIN_STREAM` for the full
+    resolution copy and `SECONDARY_STREAM` for the downscaled one. `node` is the camera node that owns the media, None
+    for the central host. `motion_score` is the highest motion score of the footage in the media, None if unknown.
+    """
+    def __new__(cls, uuid, owning_process, kind, path, info, caption=None, stream=None, node=None, motion_score=None):
+        return super(Media, cls).__new__(cls, uuid, owning_process, kind, path, info, caption, stream, node,
+                                         motion_score)
 
 
 class MediaReceiver:
@@ -53,13 +70,45 @@ class MediaManagerPlugin(PluginProcessBase):
                 # Mark for deletion
                 self._dispatch_and_delete_thread.wake()
 
-    def deliver_media(self, path, kind, info=None):
-        media_mgr_pack = find_plugin(self)
+    @pyro_expose
+    def get_media_size(self, uuid):
+        """
+        :return: The size of the media file in bytes, or None if the media was already removed.
+        """
+        with self._media_lock:
+            media = self._media.get(uuid)
+        return None if media is None else os.path.getsize(media.path)
+
+    @pyro_expose
+    def read_media_chunk(self, uuid, offset, size):
+        """
+        Lets the media managers of the other nodes copy a media a chunk at a time, so that no single transfer is large.
+        :return: Up to size bytes of the media file from offset, or None if the media was already removed.
+        """
+        with self._media_lock:
+            media = self._media.get(uuid)
+        if media is None:
+            return None
+        with open(media.path, 'rb') as fp:
+            fp.seek(offset)
+            return fp.read(size)
+
+    def _dispatch_targets(self):
+        media_mgr_pack = ProcessPack(*find_plugin(self).values())
+        if active_node() is not None:
+            # Only the first process of the central host copies the media, and shares the copy with the others
+            central_processes = [process for process in _CENTRAL_PROCESSES if media_mgr_pack[process] is not None]
+            for process in central_processes[1:]:
+                media_mgr_pack[process] = None
+        return media_mgr_pack
+
+    def deliver_media(self, path, kind, info=None, caption=None, stream=None, motion_score=None):
+        media_mgr_pack = self._dispatch_targets()
         with self._media_lock:
             uuid = None
             while uuid is None or uuid in self._media:
                 uuid = uuid4()
-            media = Media(uuid, active_process(), kind, path, info)
+            media = Media(uuid, active_process(), kind, path, info, caption, stream, active_node(), motion_score)
             self._media[uuid] = media
             # Assume not necessarily we have a media manager on every single process. This makes easier testing.
             self._media_in_use[uuid] = ProcessPack(*[entry is not None for entry in media_mgr_pack.values()])
@@ -88,10 +137,70 @@ class MediaManagerPlugin(PluginProcessBase):
                 continue
             yield plugin
 
+    @staticmethod
+    def _is_remote(media):
+        # Camera nodes run only the CAMERA process, their media on the other processes are copies made by this host
+        return media.node is not None and media.node != active_node() and media.owning_process == Process.CAMERA
+
+    def _find_owning_manager(self, media):
+        if not self._is_remote(media):
+            return find_plugin(self, media.owning_process)
+        return find_plugin(node_plugin_name(media.node, self.plugin_name()), media.owning_process)
+
+    @staticmethod
+    def _fetch_media(media, owning_manager):
+        """
+        Copies the media owned by another node to a local temporary file, in chunks of `nodes.media_chunk_size` bytes.
+        :return: The media with the path of the local copy, or None if it could not be copied.
+        """
+        chunk_size = SETTINGS.nodes.get('media_chunk_size', cast_to_type=int, default=1048576, ge=4096)
+        fp = None
+        try:
+            size = owning_manager.get_media_size(media.uuid)
+            if size is None:
+                raise OSError('The media was removed.')
+            with named_temporary_file(expected_size=size) as fp:
+                while fp.tell() < size:
+                    chunk = owning_manager.read_media_chunk(media.uuid, fp.tell(), chunk_size)
+                    if not chunk:
+                        raise OSError('The media was truncated or removed.')
+                    fp.write(chunk)
+        except (OSError, PyroError):
+            _log.exception('Could not copy media %s from node %s.', str(media.uuid), media.node)
+            if fp is not None and os.path.isfile(fp.name):
+                os.remove(fp.name)
+            return None
+        # The temporary file may have moved to disk while growing, take its name only now
+        path = fp.name
+        _log.debug('Copied media %s from node %s to %s.', str(media.uuid), media.node, path)
+        return media._replace(path=path)
+
+    def _share_media_copy(self, media):
+        """
+        Takes ownership of the local copy of a media of a camera node, and dispatches it to the media managers of the
+        central processes of this host, including this one. The copy is removed once all of them consumed it.
+        """
+        media = media._replace(owning_process=active_process())
+        media_mgr_pack = ProcessPack()
+        for process in _CENTRAL_PROCESSES:
+            media_mgr_pack[process] = find_plugin(self, process)
+        with self._media_lock:
+            self._media[media.uuid] = media
+            self._media_in_use[media.uuid] = ProcessPack(*[entry is not None for entry in media_mgr_pack.values()])
+        for media_mgr in media_mgr_pack.nonempty_values():
+            media_mgr.dispatch_media(media)
+
     def _dispatch_media_locally(self, media):
-        for media_receiver in MediaManagerPlugin.active_local_media_receivers():
-            media_receiver.handle_media(media)
-        owning_manager = find_plugin(self, media.owning_process)
+        owning_manager = self._find_owning_manager(media)
+        if self._is_remote(media):
+            if owning_manager is not None:
+                # The file is on another machine, copy it once for all the processes of this host
+                local_media = self._fetch_media(media, owning_manager)
+                if local_media is not None:
+                    self._share_media_copy(local_media)
+        else:
+            for media_receiver in MediaManagerPlugin.active_local_media_receivers():
+                media_receiver.handle_media(media)
         if owning_manager is None:
             _log.warning('Could not consume media %s at %s, no media manager on process %s', str(media.uuid),
                          media.path, media.owning_process.value.upper())
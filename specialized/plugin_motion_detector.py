@@ -1,6 +1,6 @@
-from plugins.base import PluginProcessBase, Process
+from plugins.base import PluginProcessBase, Process, node_plugin_name
 from plugins.decorators import register
-from plugins.processes_host import find_plugin, active_plugins, active_process
+from plugins.processes_host import find_plugin, active_plugins, active_process, active_node
 from Pyro4 import expose as pyro_expose, oneway as pyro_oneway
 import logging
 from misc.logging import ensure_logging_setup, camel_to_snake
@@ -10,8 +10,9 @@ from math import log, exp
 from specialized.detector_support.imaging import get_denoised_motion_vector_norm, overlay_motion_vector_to_image
 from specialized.detector_support.ramp import make_rgb_lut, clamp
 import numpy as np
+from threading import Lock
 from specialized.support.thread_host import CallbackThreadHost, CallbackQueueThreadHost
-from tempfile import NamedTemporaryFile
+from specialized.support.temp_storage import named_temporary_file
 from specialized.plugin_media_manager import MEDIA_MANAGER_PLUGIN_NAME
 import os
 
@@ -34,13 +35,16 @@ class MotionDetectorResponder:
     def root_motion_detector_plugin(self):
         return find_plugin(MOTION_DETECTOR_PLUGIN_NAME).camera
 
-    def _motion_status_changed_internal(self, is_moving):
+    def _motion_status_changed_internal(self, is_moving, node=None):
         pass
 
     @pyro_expose
     @pyro_oneway
-    def motion_status_changed(self, is_moving):
-        self._motion_status_changed_internal(is_moving)
+    def motion_status_changed(self, is_moving, node=None):
+        """
+        :param node: the camera node whose detector changed status, None for the local camera.
+        """
+        self._motion_status_changed_internal(is_moving, node)
 
 
 class MotionDetectorDispatcherPlugin(PluginProcessBase):
@@ -55,29 +59,50 @@ class MotionDetectorDispatcherPlugin(PluginProcessBase):
 
     def __init__(self):
         self._notify_thread = CallbackThreadHost('notify_movement_thread', self._notify_movement)
+        # Nodes whose detector changed status since the last notification, None for the local camera
+        self._pending_nodes = set()
+        self._pending_nodes_lock = Lock()
 
     def __enter__(self):
+        self._pending_nodes.clear()
         self._notify_thread.__enter__()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._notify_thread.__exit__(exc_type, exc_val, exc_tb)
 
+    def _find_detector(self, node):
+        if node is None or node == active_node():
+            return find_plugin(self, Process.CAMERA)
+        return find_plugin(node_plugin_name(node, self.plugin_name()), Process.CAMERA)
+
     def _notify_movement(self):
-        value = find_plugin(self, Process.CAMERA).triggered
+        with self._pending_nodes_lock:
+            nodes, self._pending_nodes = self._pending_nodes, set()
         proc = active_process()
-        for plugin_name, plugin in active_plugins().items():
-            if plugin[proc] is None or not isinstance(plugin[proc], MotionDetectorResponder):
+        for node in nodes:
+            detector = self._find_detector(node)
+            if detector is None:  # pragma: no cover
+                _log.error('Cannot find the motion detector of node %s.', str(node))
                 continue
-            # noinspection PyBroadException
-            try:
-                plugin[proc].motion_status_changed(value)
-            except:  # pragma: no cover
-                _log.exception('Plugin %s has triggered an exception during motion_status_changed.', plugin_name)
+            value = detector.triggered
+            for plugin_name, plugin in active_plugins().items():
+                if plugin[proc] is None or not isinstance(plugin[proc], MotionDetectorResponder):
+                    continue
+                # noinspection PyBroadException
+                try:
+                    plugin[proc].motion_status_changed(value, node)
+                except:  # pragma: no cover
+                    _log.exception('Plugin %s has triggered an exception during motion_status_changed.', plugin_name)
 
     @pyro_oneway
     @pyro_expose
-    def notify_movement_status_changed(self):
+    def notify_movement_status_changed(self, node=None):
+        """
+        :param node: the camera node whose detector changed status, None for the local camera.
+        """
+        with self._pending_nodes_lock:
+            self._pending_nodes.add(node)
         self._notify_thread.wake()
 
 
@@ -99,6 +124,7 @@ class MotionDetectorCameraPlugin(MotionDetectorDispatcherPlugin, PiCameraProcess
         self._time_window = None
         self._accumulator = None
         self._triggered = False
+        self._motion_score = 0.
         self._cached_video_frame = None
         self._capture_thread = CallbackQueueThreadHost('capture_motion_image_thread', self._take_motion_image_with_info)
 
@@ -184,24 +210,33 @@ class MotionDetectorCameraPlugin(MotionDetectorDispatcherPlugin, PiCameraProcess
 
     @property
     def _frame_area(self):
-        w, h = self._resolution
+        w, h = self.root_picamera_plugin.motion_resolution
         return w * h
 
     def _prepare_video_frame_cache(self):
-        if self._cached_video_frame is None:
-            self._cached_video_frame = np.empty((self._resolution[1], self._resolution[0], 3), dtype=np.uint8)
+        shape = (self._resolution[1], self._resolution[0], 3)
+        if self._cached_video_frame is None or self._cached_video_frame.shape != shape:
+            self._cached_video_frame = np.empty(shape, dtype=np.uint8)
+        return self._cached_video_frame
+
+    def camera_reconfigured(self, old_config, new_config):
+        if old_config.resolution != new_config.resolution:
+            # The motion vectors may have a different shape
+            self._accumulator = None
+            self._motion_score = 0.
 
     def _take_motion_image_with_info(self, info):
-        self._prepare_video_frame_cache()
-        with NamedTemporaryFile(delete=False, dir=SETTINGS.get('temp_folder', cast_to_type=str, allow_none=True)) as \
-                temp_file:
-            media_path = temp_file.name
-            _log.info('Taking motion image with info %s to %s.', str(info), media_path)
-            self.root_picamera_plugin.camera.capture(self._cached_video_frame, format='rgb', use_video_port=True)
-            image = overlay_motion_vector_to_image(self._cached_video_frame, self._accumulator, MOTION_COLOR_RAMP)
+        video_frame = self._prepare_video_frame_cache()
+        with named_temporary_file() as temp_file:
+            _log.info('Taking motion image with info %s.', str(info))
+            self.root_picamera_plugin.camera.capture(video_frame, format='rgb', use_video_port=True)
+            motion_score = self._motion_score
+            image = overlay_motion_vector_to_image(video_frame, self._accumulator, MOTION_COLOR_RAMP)
             image.save(temp_file, format='jpeg', quality=self._jpeg_quality)
             temp_file.flush()
             temp_file.close()
+        # The temporary file may have moved to disk while growing, take its name only now
+        media_path = temp_file.name
         media_mgr = find_plugin(MEDIA_MANAGER_PLUGIN_NAME, Process.CAMERA)
         if media_mgr is None:
             _log.error('Could not find a media manager on the CAMERA thread.')
@@ -211,7 +246,7 @@ class MotionDetectorCameraPlugin(MotionDetectorDispatcherPlugin, PiCameraProcess
             except OSError:  # pragma: no cover
                 _log.exception('Could not delete %s.', media_path)
         else:
-            media = media_mgr.deliver_media(media_path, 'jpeg', info)
+            media = media_mgr.deliver_media(media_path, 'jpeg', info, motion_score=motion_score)
             _log.info('Dispatched motion image %s with info %s at %s.', str(media.uuid), str(media.info), media.path)
 
     @pyro_expose
@@ -219,15 +254,41 @@ class MotionDetectorCameraPlugin(MotionDetectorDispatcherPlugin, PiCameraProcess
         _log.info('Requested motion image with info %s', str(info))
         self._capture_thread.push_operation(info)
 
+    def _movement_above_thresholds(self, level):
+        threshold = self.trigger_thresholds[level]
+        min_area = self.trigger_area_fractions[level] * self._frame_area
+        return np.sum(self._accumulator > threshold) >= min_area
+
+    @pyro_expose
+    @property
+    def activity(self):
+        """
+        :return: True if the motion estimate is above the lower (release) thresholds. This may happen before the
+        detector triggers.
+        """
+        return self._accumulator is not None and bool(self._movement_above_thresholds(1))
+
+    @pyro_expose
+    @property
+    def motion_score(self):
+        """
+        :return: The fraction of the frame area where the motion estimate is above the higher (trigger) threshold, as
+        of the last frame analyzed.
+        """
+        return self._motion_score
+
+    def _compute_motion_score(self):
+        if self._accumulator is None:
+            return 0.
+        return float(np.sum(self._accumulator > self.trigger_thresholds[0])) / self._frame_area
+
     def _updated_trigger_status(self):
-        threshold = self.trigger_thresholds[1 if self.triggered else 0]
-        min_area = self.trigger_area_fractions[1 if self.triggered else 0] * self._frame_area
-        movement_amount_above_thresholds = (np.sum(self._accumulator > threshold) >= min_area)
+        movement_amount_above_thresholds = self._movement_above_thresholds(1 if self.triggered else 0)
         if movement_amount_above_thresholds != self.triggered:
             self._triggered = movement_amount_above_thresholds
-            # Trigger all plugins
+            # Trigger all plugins, also those of the central host if this is a camera node
             for plugin_instance in find_plugin(self).nonempty_values():
-                plugin_instance.notify_movement_status_changed()
+                plugin_instance.notify_movement_status_changed(active_node())
 
     def analyze(self, array):  # pragma: no cover
         array = get_denoised_motion_vector_norm(array)
@@ -236,7 +297,10 @@ class MotionDetectorCameraPlugin(MotionDetectorDispatcherPlugin, PiCameraProcess
         else:
             self._accumulator *= self._decay_factor
             self._accumulator += array
+        self._motion_score = self._compute_motion_score()
         self._updated_trigger_status()
+        self.root_picamera_plugin.set_annotation_field(
+            MOTION_DETECTOR_PLUGIN_NAME, 'motion %.2f%%' % (100. * self._motion_score) if self._triggered else None)
 
 
 # Have a motion detector dispatcher on all procs
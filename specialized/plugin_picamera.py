@@ -5,12 +5,21 @@ from Pyro4 import expose as pyro_expose
 import logging
 from misc.logging import ensure_logging_setup, camel_to_snake
 from misc.settings import SETTINGS
-from time import sleep
-from threading import Thread
+from time import sleep, monotonic, time
+from datetime import datetime
+from threading import Thread, RLock, Lock
+from collections import namedtuple, Counter, OrderedDict
+from specialized.support.thread_host import CallbackThreadHost
+from specialized.camera_support.settle import SettleDetector
 
 
-_WARMUP_THREAD_TIME = 2.  # seconds
+_WARMUP_THREAD_TIME = 2.  # seconds, upper bound to the time waited for the sensor to settle
 _WARMUP_THREAD_LEASE_TIME = _WARMUP_THREAD_TIME * 1.1
+_WARMUP_POLL_TIME = 0.1  # seconds
+_ANNOTATION_INTERVAL = 1.  # seconds
+_VIDEO_SPLITTER_PORT = 1
+_MOTION_SPLITTER_PORT = 2
+_SECONDARY_SPLITTER_PORT = 3
 
 PICAMERA_ROOT_PLUGIN_NAME = 'PiCameraRoot'
 ensure_logging_setup()
@@ -28,6 +37,41 @@ except (ImportError, OSError) as e:  # pragma: no cover
         _log.warning('Faulty PiCamera package (installed s/w else than a RPi?), running mockup.')
 
 
+def make_camera():
+    """
+    :return: The camera source set in `camera.source`: the Raspberry Pi camera if None, otherwise the path to a raw H264
+    file to stream in its place (see `H264FileCamera`), together with the motion vectors in `camera.source_motion`.
+    """
+    source = SETTINGS.camera.get('source', cast_to_type=str, allow_none=True, default=None)
+    if source is None:
+        return PiCamera()
+    from misc.cam_replay import H264FileCamera
+    motion_source = SETTINGS.camera.get('source_motion', cast_to_type=str, allow_none=True, default=None)
+    _log.info('Streaming %s instead of the camera.', source)
+    return H264FileCamera(source, motion_path=motion_source,
+                          speed=SETTINGS.camera.get('source_speed', cast_to_type=float, default=1., ge=0.01),
+                          loop=SETTINGS.camera.get('source_loop', cast_to_type=bool, default=True))
+
+
+def parse_resolution(value):
+    """
+    Parses a resolution specified as a 'WxH' string or as a pair of integers.
+    :return: A (width, height) tuple, or None if value is None.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.lower().split('x')
+    width, height = map(int, value)
+    if width <= 0 or height <= 0:
+        raise ValueError('Invalid resolution %s.' % str(value))
+    return width, height
+
+
+class CameraConfiguration(namedtuple('_CameraConfiguration', ['resolution', 'framerate', 'bitrate'])):
+    pass
+
+
 class PiCameraProcessBase(PluginProcessBase):
     @classmethod
     def process(cls):  # pragma: no cover
@@ -60,6 +104,40 @@ class PiCameraProcessBase(PluginProcessBase):
     def analyze(self, array):  # pragma: no cover
         pass
 
+    def write_secondary(self, data):  # pragma: no cover
+        """
+        Receives the data of the secondary, downscaled encoder, if `camera.secondary_resolution` is set.
+        """
+        pass
+
+    def flush_secondary(self):  # pragma: no cover
+        pass
+
+    def write_preview(self, data):  # pragma: no cover
+        """
+        Receives the MJPEG data of the preview encoder, while started with `PiCameraRootPlugin.start_preview_stream`.
+        """
+        pass
+
+    def flush_preview(self):  # pragma: no cover
+        pass
+
+    def camera_reconfiguring(self, old_config, new_config):  # pragma: no cover
+        """
+        Called before the encoder is stopped for a reconfiguration. The final flush of the stream will follow.
+        :param old_config: the CameraConfiguration currently in use.
+        :param new_config: the requested CameraConfiguration; unchanged entries are copied from old_config.
+        """
+        pass
+
+    def camera_reconfigured(self, old_config, new_config):  # pragma: no cover
+        """
+        Called after the new settings are applied and before the encoder is restarted.
+        :param old_config: the CameraConfiguration that was in use.
+        :param new_config: the CameraConfiguration now in use.
+        """
+        pass
+
 
 def _cam_dispatch(method_name, *args, **kwargs):
     for plugin_name, plugin in active_plugins().items():
@@ -80,8 +158,8 @@ class _CameraPluginMotionDispatcher(PiMotionAnalysis):
     def analyze(self, array):
         _cam_dispatch('analyze', array)
 
-    def __init__(self, camera):
-        super(_CameraPluginMotionDispatcher, self).__init__(camera)
+    def __init__(self, camera, size=None):
+        super(_CameraPluginMotionDispatcher, self).__init__(camera, size)
 
 
 class _CameraPluginVideoDispatcher:
@@ -92,49 +170,489 @@ class _CameraPluginVideoDispatcher:
         _cam_dispatch('flush')
 
 
+class _CameraPluginSecondaryVideoDispatcher:
+    def write(self, data):
+        _cam_dispatch('write_secondary', data)
+
+    def flush(self):
+        _cam_dispatch('flush_secondary')
+
+
+class _CameraPluginPreviewDispatcher:
+    def write(self, data):
+        _cam_dispatch('write_preview', data)
+
+    def flush(self):
+        _cam_dispatch('flush_preview')
+
+
+class _DiscardOutput:
+    def write(self, data):
+        pass
+
+
 @make_plugin(PICAMERA_ROOT_PLUGIN_NAME, Process.CAMERA)
 class PiCameraRootPlugin(PluginProcessBase):
     def __init__(self):
         super(PiCameraRootPlugin, self).__init__()
-        self._camera = PiCamera()
+        self._camera = make_camera()
+        self._encoder_lock = RLock()
+        self._last_blackout = None
         self._bitrate = SETTINGS.camera.get('bitrate', cast_to_type=int, default=750000, ge=100)
-        self.framerate = SETTINGS.camera.get('framerate', cast_to_type=float, default=30., ge=0.1, le=90.)
-        self.resolution = SETTINGS.camera.get('resolution', cast_to_type=str, default='720p')
+        # Do not go through the setters, there is no plugin to notify yet
+        self._camera.framerate = SETTINGS.camera.get('framerate', cast_to_type=float, default=30., ge=0.1, le=90.)
+        self._camera.resolution = SETTINGS.camera.get('resolution', cast_to_type=str, default='720p')
         self._warmup_thread = Thread(target=self._warmup, name='PiCamera warmup thread')
+        self._standby_enabled = SETTINGS.camera.get('standby', cast_to_type=bool, default=False)
+        self._standby_delay = SETTINGS.camera.get('standby_delay', cast_to_type=float, default=10., ge=0.)
+        self._standby_thread = CallbackThreadHost('encoder_standby_thread', self._standby_if_unused)
+        self._consumers = Counter()
+        self._consumers_lock = Lock()
+        self._last_release_time = monotonic()
+        self._standby_since = None
+        self._standby_time = 0.
+        # If set, motion vectors come from a second, downscaled encoder, and do not depend on the recording resolution
+        self._motion_resize = None
+        try:
+            self._motion_resize = parse_resolution(SETTINGS.detector.get('resolution', cast_to_type=str,
+                                                                         allow_none=True, default=None))
+        except ValueError:
+            _log.error('Invalid detector resolution, motion detection will use the recording encoder.')
+        # If set, a second, downscaled and lower bitrate H264 stream is produced, e.g. for fast uploads
+        self._secondary_resize = None
+        try:
+            self._secondary_resize = parse_resolution(SETTINGS.camera.get('secondary_resolution', cast_to_type=str,
+                                                                          allow_none=True, default=None))
+        except ValueError:
+            _log.error('Invalid secondary resolution, no secondary stream will be recorded.')
+        self._secondary_bitrate = SETTINGS.camera.get('secondary_bitrate', cast_to_type=int, allow_none=True,
+                                                      default=None, ge=100)
+        self._running_splitter_ports = []
+        # (resize, quality) of the MJPEG preview encoder, while a plugin needs it
+        self._preview_config = None
+        # The annotation is a timestamp followed by the fields set by the plugins, and it is updated at most once per
+        # second, only when its text changes
+        self._annotation_format = SETTINGS.camera.get('annotation_format', cast_to_type=str, allow_none=True,
+                                                      default='%Y-%m-%d %H:%M:%S')
+        self._annotation_fields = OrderedDict()
+        self._annotation_lock = Lock()
+        self._annotation_text = None
+        self._annotation_thread = CallbackThreadHost('annotation_thread', self._keep_annotation_updated)
 
     def __enter__(self):
         super(PiCameraRootPlugin, self).__enter__()
+        self._standby_thread.__enter__()
+        self._annotation_thread.__enter__()
+        self._annotation_thread.wake()
         self._warmup_thread.start()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         super(PiCameraRootPlugin, self).__exit__(exc_type, exc_val, exc_tb)
+        self._annotation_thread.__exit__(exc_type, exc_val, exc_tb)
+        self._standby_thread.__exit__(exc_type, exc_val, exc_tb)
         self._warmup_thread.join(_WARMUP_THREAD_LEASE_TIME)
         if self._warmup_thread.is_alive():  # pragma: no cover
             _log.warning('The warmup thread did not join within %0.1fs.', _WARMUP_THREAD_LEASE_TIME)
             self._warmup_thread.join()
             _log.info('The warmup thread finally joined.')
         _log.info('Stopping streaming data...')
-        self.camera.stop_recording()
+        with self._encoder_lock:
+            self._stop_encoder()
+        # Releases the camera, or the file streamed in its place
+        self._camera.close()
         _log.info('Stopped')
 
+    def _start_encoder(self):
+        if self._motion_resize is None:
+            self._camera.start_recording(
+                _CameraPluginVideoDispatcher(),
+                format='h264',
+                splitter_port=_VIDEO_SPLITTER_PORT,
+                motion_output=_CameraPluginMotionDispatcher(self.camera),
+                quality=None,
+                bitrate=self.bitrate)
+            self._running_splitter_ports.append(_VIDEO_SPLITTER_PORT)
+        else:
+            self._camera.start_recording(
+                _CameraPluginVideoDispatcher(),
+                format='h264',
+                splitter_port=_VIDEO_SPLITTER_PORT,
+                quality=None,
+                bitrate=self.bitrate)
+            self._running_splitter_ports.append(_VIDEO_SPLITTER_PORT)
+            # The video from this encoder is discarded, only the motion vectors are used
+            self._camera.start_recording(
+                _DiscardOutput(),
+                format='h264',
+                resize=self._motion_resize,
+                splitter_port=_MOTION_SPLITTER_PORT,
+                motion_output=_CameraPluginMotionDispatcher(self.camera, self._motion_resize),
+                quality=None,
+                bitrate=self._motion_bitrate)
+            self._running_splitter_ports.append(_MOTION_SPLITTER_PORT)
+        if self._secondary_resize is not None:
+            self._camera.start_recording(
+                _CameraPluginSecondaryVideoDispatcher(),
+                format='h264',
+                resize=self._secondary_resize,
+                splitter_port=_SECONDARY_SPLITTER_PORT,
+                quality=None,
+                bitrate=self.secondary_bitrate)
+            self._running_splitter_ports.append(_SECONDARY_SPLITTER_PORT)
+        if self._preview_config is not None:
+            self._start_preview_encoder()
+
+    @property
+    def _preview_splitter_port(self):
+        # The Pi has four splitter ports, and port 0 is used for stills
+        if self._motion_resize is None:
+            return _MOTION_SPLITTER_PORT
+        elif self._secondary_resize is None:
+            return _SECONDARY_SPLITTER_PORT
+        return None
+
+    def _start_preview_encoder(self):
+        resize, quality = self._preview_config
+        self._camera.start_recording(
+            _CameraPluginPreviewDispatcher(),
+            format='mjpeg',
+            resize=resize,
+            splitter_port=self._preview_splitter_port,
+            quality=quality)
+        self._running_splitter_ports.append(self._preview_splitter_port)
+
+    def _stop_encoder(self):
+        while len(self._running_splitter_ports) > 0:
+            self._camera.stop_recording(splitter_port=self._running_splitter_ports.pop())
+
+    def _scaled_bitrate(self, resize):
+        # Scale the bitrate with the area
+        width, height = resize
+        try:
+            full_width, full_height = parse_resolution(self.resolution)
+        except ValueError:  # pragma: no cover
+            return self.bitrate
+        return max(100, int(self.bitrate * min(1., (width * height) / (full_width * full_height))))
+
+    @property
+    def _motion_bitrate(self):
+        # The motion encoder output is discarded anyway
+        return self._scaled_bitrate(self._motion_resize)
+
+    @property
+    def is_encoding(self):
+        return len(self._running_splitter_ports) > 0
+
+    def _encoder_frame(self, splitter_port):
+        # noinspection PyProtectedMember
+        encoders = getattr(self._camera, '_encoders', None)
+        if encoders is not None and splitter_port in encoders:
+            return encoders[splitter_port].frame
+        return self._camera.frame
+
+    @property
+    def video_frame(self):
+        """
+        :return: The PiVideoFrame of the recording encoder. PiCamera.frame is not reliable when more than one encoder
+        is running.
+        """
+        return self._encoder_frame(_VIDEO_SPLITTER_PORT)
+
+    @property
+    def secondary_video_frame(self):
+        """
+        :return: The PiVideoFrame of the secondary encoder.
+        """
+        return self._encoder_frame(_SECONDARY_SPLITTER_PORT)
+
+    @property
+    def preview_frame(self):
+        """
+        :return: The PiVideoFrame of the MJPEG preview encoder.
+        """
+        return self._encoder_frame(self._preview_splitter_port)
+
+    def start_preview_stream(self, resize, quality):
+        """
+        Starts a MJPEG encoder at the given resolution and JPEG quality (1 to 100) on a free splitter port, whose frames
+        are dispatched to `PiCameraProcessBase.write_preview`. The encoder follows the others through reconfigurations
+        and standby.
+        :return: False if all the splitter ports are in use.
+        """
+        with self._encoder_lock:
+            if self._preview_splitter_port is None:
+                _log.error('No splitter port left for the preview, disable the secondary stream or the detector '
+                           'resolution.')
+                return False
+            if self._preview_config is not None:
+                return True
+            self._preview_config = (resize, quality)
+            if self.is_encoding:
+                self._start_preview_encoder()
+            return True
+
+    def stop_preview_stream(self):
+        with self._encoder_lock:
+            if self._preview_config is None:
+                return
+            self._preview_config = None
+            if self._preview_splitter_port in self._running_splitter_ports:
+                self._running_splitter_ports.remove(self._preview_splitter_port)
+                self._camera.stop_recording(splitter_port=self._preview_splitter_port)
+
+    def request_secondary_key_frame(self):
+        self._camera.request_key_frame(splitter_port=_SECONDARY_SPLITTER_PORT)
+
+    @pyro_expose
+    @property
+    def secondary_resolution(self):
+        """
+        :return: The resolution of the secondary stream, or None if there is no secondary stream.
+        """
+        return self._secondary_resize
+
+    @pyro_expose
+    @property
+    def secondary_bitrate(self):
+        if self._secondary_resize is None:
+            return None
+        if self._secondary_bitrate is None:
+            return self._scaled_bitrate(self._secondary_resize)
+        return self._secondary_bitrate
+
+    def _render_annotation(self):
+        with self._annotation_lock:
+            parts = list(self._annotation_fields.values())
+        if self._annotation_format is not None:
+            parts.insert(0, datetime.now().strftime(self._annotation_format))
+        return ' '.join(parts)
+
+    def _keep_annotation_updated(self):
+        while True:
+            text = self._render_annotation()
+            if text != self._annotation_text:
+                self._annotation_text = text
+                self._camera.annotate_text = text
+            # Wake up right after the second changes, so that the timestamp is never behind
+            if self._annotation_thread.wait_stop(_ANNOTATION_INTERVAL - time() % _ANNOTATION_INTERVAL):
+                return
+
+    @pyro_expose
+    def set_annotation_field(self, name, text):
+        """
+        Sets the text that `name` contributes to the annotation, after the timestamp. Fields appear in the order in
+        which they were first set. The change shows up within one second.
+        :param name: any hashable identifying the field, e.g. the plugin name.
+        :param text: the text of the field, or None to remove it.
+        """
+        with self._annotation_lock:
+            if text is None:
+                self._annotation_fields.pop(name, None)
+            else:
+                self._annotation_fields[name] = str(text)
+
+    @pyro_expose
+    @property
+    def annotation_text(self):
+        """
+        :return: The text currently annotated on the frames, or None if it was not set yet.
+        """
+        return self._annotation_text
+
+    @pyro_expose
+    @property
+    def motion_resolution(self):
+        """
+        :return: The resolution of the frames on which the motion vectors are computed.
+        """
+        if self._motion_resize is None:
+            return self.resolution
+        return self._motion_resize
+
+    def _sensor_reading(self):
+        awb_red_gain, awb_blue_gain = self._camera.awb_gains
+        return self._camera.analog_gain, self._camera.digital_gain, awb_red_gain, awb_blue_gain, \
+            self._camera.exposure_speed
+
+    def _wait_for_sensor_to_settle(self, max_time):
+        settle_detector = SettleDetector()
+        start_time = monotonic()
+        elapsed = 0.
+        while elapsed < max_time:
+            if settle_detector.update(self._sensor_reading()):
+                _log.info('Exposure and white balance settled in %0.1fs.', elapsed)
+                return
+            sleep(min(_WARMUP_POLL_TIME, max_time - elapsed))
+            elapsed = monotonic() - start_time
+        _log.info('Exposure and white balance did not settle within %0.1fs.', max_time)
+
     def _warmup(self):
-        _log.info('Warming up (%0.fs).', _WARMUP_THREAD_TIME)
+        _log.info('Warming up (at most %0.fs).', _WARMUP_THREAD_TIME)
         self._camera.start_preview()
-        sleep(_WARMUP_THREAD_TIME)
-        _log.info('Beginning streaming data at bitrate %s, framerate %s and resolution %s.',
-                  str(self.bitrate), str(self.framerate), str(self.resolution))
-        self._camera.start_recording(
-            _CameraPluginVideoDispatcher(),
-            format='h264',
-            motion_output=_CameraPluginMotionDispatcher(self.camera),
-            quality=None,
-            bitrate=self.bitrate)
+        self._wait_for_sensor_to_settle(_WARMUP_THREAD_TIME)
+        with self._encoder_lock:
+            _log.info('Beginning streaming data at bitrate %s, framerate %s and resolution %s.',
+                      str(self.bitrate), str(self.framerate), str(self.resolution))
+            self._start_encoder()
+        if self._standby_enabled:
+            self._standby_thread.wake()
+
+    def _standby_if_unused(self):
+        # Wait until nobody has needed the encoder for at least the standby delay
+        while True:
+            with self._consumers_lock:
+                if not self._standby_enabled or sum(self._consumers.values()) > 0:
+                    return
+                wait_time = self._standby_delay - (monotonic() - self._last_release_time)
+            if wait_time <= 0.:
+                break
+            if self._standby_thread.wait_stop(wait_time):
+                return
+        with self._encoder_lock:
+            with self._consumers_lock:
+                if sum(self._consumers.values()) > 0 or not self.is_encoding:
+                    return
+                _log.info('No consumer needs the encoder, going in standby.')
+                self._stop_encoder()
+                self._standby_since = monotonic()
+
+    def _resume_from_standby(self):
+        with self._encoder_lock:
+            if self._standby_since is None:
+                return
+            standby_time = monotonic() - self._standby_since
+            self._standby_time += standby_time
+            self._standby_since = None
+            # The preview keeps running in standby, so exposure and white balance are still settled
+            _log.info('Resuming from standby after %0.1fs.', standby_time)
+            self._start_encoder()
+
+    @pyro_expose
+    def acquire_encoder(self, consumer):
+        """
+        Declares that consumer needs the encoder output, and resumes the encoder if it is in standby.
+        :param consumer: any hashable identifying the consumer, e.g. the plugin name. Calls are reference counted.
+        """
+        with self._consumers_lock:
+            self._consumers[consumer] += 1
+        self._resume_from_standby()
+
+    @pyro_expose
+    def release_encoder(self, consumer):
+        """
+        Releases one reference acquired with acquire_encoder. When no consumer is left for more than standby_delay
+        seconds, and standby is enabled, the encoder is stopped.
+        """
+        with self._consumers_lock:
+            if self._consumers[consumer] <= 1:
+                del self._consumers[consumer]
+            else:
+                self._consumers[consumer] -= 1
+            if sum(self._consumers.values()) > 0:
+                return
+            self._last_release_time = monotonic()
+        self._standby_thread.wake()
+
+    @pyro_expose
+    @property
+    def encoder_consumers(self):
+        with self._consumers_lock:
+            return dict(self._consumers)
+
+    @pyro_expose
+    @property
+    def standby_enabled(self):
+        return self._standby_enabled
+
+    @pyro_expose
+    @standby_enabled.setter
+    def standby_enabled(self, value):
+        self._standby_enabled = bool(value)
+        if self._standby_enabled:
+            self._standby_thread.wake()
+        else:
+            self._resume_from_standby()
+
+    @pyro_expose
+    @property
+    def standby_delay(self):
+        return self._standby_delay
+
+    @pyro_expose
+    @standby_delay.setter
+    def standby_delay(self, value):
+        self._standby_delay = max(0., float(value))
+
+    @pyro_expose
+    @property
+    def is_standby(self):
+        return self._standby_since is not None
+
+    @pyro_expose
+    @property
+    def standby_time(self):
+        """
+        :return: Total time in seconds spent in standby so far.
+        """
+        standby_since = self._standby_since
+        if standby_since is None:
+            return self._standby_time
+        return self._standby_time + monotonic() - standby_since
 
     @property
     def camera(self):
         return self._camera
 
+    @pyro_expose
+    @property
+    def configuration(self):
+        return CameraConfiguration(parse_resolution(self.resolution), self.framerate, self.bitrate)
+
+    @pyro_expose
+    @property
+    def last_blackout(self):
+        """
+        :return: Duration in seconds of the gap in the stream caused by the last reconfiguration, or None.
+        """
+        return self._last_blackout
+
+    @pyro_expose
+    def reconfigure(self, resolution=None, framerate=None, bitrate=None):
+        """
+        Applies the given settings, restarting the encoder if it is running. All camera plugins are notified through
+        PiCameraProcessBase.camera_reconfiguring and PiCameraProcessBase.camera_reconfigured.
+        :return: The duration in seconds during which no data was streamed, zero if the encoder was not running.
+        """
+        with self._encoder_lock:
+            old_config = self.configuration
+            # Resolutions come as 'WxH' strings, tuples or PiResolution, compare them as (width, height) tuples
+            requested_config = CameraConfiguration(
+                old_config.resolution if resolution is None else parse_resolution(resolution),
+                old_config.framerate if framerate is None else float(framerate),
+                old_config.bitrate if bitrate is None else max(100, int(bitrate)))
+            if requested_config == old_config:
+                return 0.
+            was_recording = self.is_encoding
+            _log.info('Reconfiguring camera from %s to %s.', str(old_config), str(requested_config))
+            _cam_dispatch('camera_reconfiguring', old_config, requested_config)
+            blackout_start = monotonic()
+            # Stopping the encoder flushes the stream, which is a split point for all plugins
+            self._stop_encoder()
+            self._camera.resolution = requested_config.resolution
+            self._camera.framerate = requested_config.framerate
+            self._bitrate = requested_config.bitrate
+            new_config = self.configuration
+            _cam_dispatch('camera_reconfigured', old_config, new_config)
+            if was_recording:
+                self._start_encoder()
+                self._last_blackout = monotonic() - blackout_start
+                _log.info('Camera reconfigured, the stream was interrupted for %0.3fs.', self._last_blackout)
+            else:
+                self._last_blackout = 0.
+                _log.info('Camera reconfigured.')
+            return self._last_blackout
+
     @pyro_expose
     @property
     def framerate(self):
@@ -143,7 +661,7 @@ class PiCameraRootPlugin(PluginProcessBase):
     @pyro_expose
     @framerate.setter
     def framerate(self, value):  # pragma: no cover
-        self.camera.framerate = value
+        self.reconfigure(framerate=value)
 
     @pyro_expose
     @property
@@ -153,7 +671,7 @@ class PiCameraRootPlugin(PluginProcessBase):
     @pyro_expose
     @resolution.setter
     def resolution(self, value):  # pragma: no cover
-        self.camera.resolution = value
+        self.reconfigure(resolution=value)
 
     @pyro_expose
     @property
@@ -163,8 +681,4 @@ class PiCameraRootPlugin(PluginProcessBase):
     @pyro_expose
     @bitrate.setter
     def bitrate(self, value):  # pragma: no cover
-        if self.camera.recording:
-            # TODO: possibly stop and restart recording?
-            raise RuntimeError('Unable to set bitrate while recording')
-        else:
-            self._bitrate = value
+        self.reconfigure(bitrate=value)
@@ -0,0 +1,226 @@
+from plugins.base import Process
+from plugins.decorators import make_plugin
+from Pyro4 import expose as pyro_expose
+import logging
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread, Lock, Condition
+from misc.logging import ensure_logging_setup, camel_to_snake
+from misc.settings import SETTINGS
+from specialized.plugin_picamera import PiCameraProcessBase, parse_resolution
+from specialized.camera_support.broadcast import LatestFrameBroadcaster
+
+
+PREVIEW_PLUGIN_NAME = 'Preview'
+ensure_logging_setup()
+_log = logging.getLogger(camel_to_snake(PREVIEW_PLUGIN_NAME))
+
+_BOUNDARY = 'ratcamframe'
+_FRAME_WAIT_TIME = 1.  # seconds, how often the clients check whether the server is closing
+_CLIENT_TIMEOUT = 10.  # seconds, a client that does not take any data for this long is dropped
+_SNAPSHOT_TIMEOUT = 5.  # seconds, upper bound to the time waited for the encoder to produce a frame
+
+
+class _PreviewRequestHandler(BaseHTTPRequestHandler):
+    timeout = _CLIENT_TIMEOUT
+
+    def log_message(self, format, *args):
+        _log.debug('%s - %s', self.address_string(), format % args)
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path in ('/', '/stream.mjpg'):
+            self._send_stream()
+        elif path == '/snapshot.jpg':
+            self._send_snapshot()
+        else:
+            self.send_error(404)
+
+    def _send_no_cache_headers(self):
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.send_header('Pragma', 'no-cache')
+
+    def _send_stream(self):
+        preview = self.server.preview_plugin
+        if not preview.client_connected():
+            self.send_error(503)
+            return
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=' + _BOUNDARY)
+            self._send_no_cache_headers()
+            self.end_headers()
+            frame_number = 0
+            while True:
+                latest_frame = preview.broadcaster.wait_for_frame(frame_number, _FRAME_WAIT_TIME)
+                if latest_frame is None:
+                    if preview.broadcaster.closed:
+                        break
+                    continue
+                # Whatever came in while sending the previous frame is dropped for this client only
+                preview.frame_sent(0 if frame_number == 0 else latest_frame[0] - frame_number - 1)
+                frame_number, frame = latest_frame
+                self.wfile.write(('--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' %
+                                  (_BOUNDARY, len(frame))).encode('ascii'))
+                self.wfile.write(frame)
+                self.wfile.write(b'\r\n')
+        except OSError:
+            _log.debug('Client %s left the preview.', self.address_string())
+        finally:
+            preview.client_disconnected()
+
+    def _send_snapshot(self):
+        preview = self.server.preview_plugin
+        if not preview.client_connected():
+            self.send_error(503)
+            return
+        try:
+            # A frame is encoded only when requested, wait for a fresh one
+            latest_frame = preview.broadcaster.wait_for_frame(preview.broadcaster.frame_number, _SNAPSHOT_TIMEOUT)
+        finally:
+            preview.client_disconnected()
+        if latest_frame is None:
+            self.send_error(503)
+            return
+        _, frame = latest_frame
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(frame)))
+        self._send_no_cache_headers()
+        self.end_headers()
+        self.wfile.write(frame)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _PreviewServer(_ThreadingHTTPServer):
+    def __init__(self, address, preview_plugin):
+        super(_PreviewServer, self).__init__(address, _PreviewRequestHandler)
+        self.preview_plugin = preview_plugin
+
+
+@make_plugin(PREVIEW_PLUGIN_NAME, Process.CAMERA)
+class PreviewPlugin(PiCameraProcessBase):
+    """
+    Serves a live, low resolution MJPEG stream at http://`preview.host`:`preview.port`/stream.mjpg, and single frames at
+    /snapshot.jpg. A MJPEG encoder on a free splitter port produces the JPEGs at `preview.resolution` only while some
+    client is connected, and every client is sent the same frames, so that more viewers cost almost nothing. A client
+    that cannot keep up skips frames. Disabled if no port is set.
+    """
+
+    def __init__(self):
+        super(PreviewPlugin, self).__init__()
+        self._host = SETTINGS.preview.get('host', cast_to_type=str, default='0.0.0.0')
+        self._port = SETTINGS.preview.get('port', cast_to_type=int, allow_none=True, default=None, ge=0, le=65535)
+        self._resize = (320, 240)
+        try:
+            self._resize = parse_resolution(SETTINGS.preview.get('resolution', cast_to_type=str, default='320x240'))
+        except ValueError:
+            _log.error('Invalid preview resolution, will use %dx%d.', *self._resize)
+        self._quality = SETTINGS.preview.get('quality', cast_to_type=int, default=25, ge=1, le=100)
+        self._broadcaster = None
+        self._server = None
+        self._server_thread = None
+        self._clients_lock = Lock()
+        self._clients_changed = Condition(self._clients_lock)
+        self._num_clients = 0
+        self._num_frames_sent = 0
+        self._num_frames_skipped = 0
+
+    def __enter__(self):
+        super(PreviewPlugin, self).__enter__()
+        self._broadcaster = LatestFrameBroadcaster()
+        if self._port is None:
+            return self
+        try:
+            self._server = _PreviewServer((self._host, self._port), self)
+        except OSError:
+            _log.exception('Unable to serve the preview on %s:%d.', self._host, self._port)
+            return self
+        self._server_thread = Thread(target=self._server.serve_forever, name='preview_server_thread')
+        self._server_thread.start()
+        _log.info('Serving the preview at http://%s:%d/stream.mjpg', *self.address)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._broadcaster.close()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server_thread.join()
+            # The clients leave as soon as they notice that the broadcaster is closed
+            with self._clients_changed:
+                if not self._clients_changed.wait_for(lambda: self._num_clients == 0, _CLIENT_TIMEOUT):
+                    _log.warning('%d preview clients did not leave.', self._num_clients)
+            self._server = None
+            self._server_thread = None
+        super(PreviewPlugin, self).__exit__(exc_type, exc_val, exc_tb)
+
+    @property
+    def broadcaster(self):
+        return self._broadcaster
+
+    def client_connected(self):
+        """
+        Starts the preview encoder for the first client.
+        :return: False if the preview encoder cannot run.
+        """
+        with self._clients_lock:
+            if self._num_clients == 0:
+                self.root_picamera_plugin.acquire_encoder(PREVIEW_PLUGIN_NAME)
+                if not self.root_picamera_plugin.start_preview_stream(self._resize, self._quality):
+                    self.root_picamera_plugin.release_encoder(PREVIEW_PLUGIN_NAME)
+                    return False
+                _log.info('Starting the preview encoder.')
+            self._num_clients += 1
+            return True
+
+    def client_disconnected(self):
+        """
+        Stops the preview encoder after the last client.
+        """
+        with self._clients_lock:
+            self._num_clients -= 1
+            self._clients_changed.notify_all()
+            if self._num_clients > 0:
+                return
+            _log.info('No client left, stopping the preview encoder.')
+            self.root_picamera_plugin.stop_preview_stream()
+            self.root_picamera_plugin.release_encoder(PREVIEW_PLUGIN_NAME)
+
+    def frame_sent(self, num_frames_skipped):
+        with self._clients_lock:
+            self._num_frames_sent += 1
+            self._num_frames_skipped += num_frames_skipped
+
+    @pyro_expose
+    @property
+    def address(self):
+        """
+        :return: The (host, port) pair the server is bound to, or None if it is not running.
+        """
+        return None if self._server is None else self._server.server_address[:2]
+
+    @pyro_expose
+    @property
+    def num_clients(self):
+        return self._num_clients
+
+    @pyro_expose
+    @property
+    def preview_stats(self):
+        with self._clients_lock:
+            return {
+                'num_clients': self._num_clients,
+                'num_frames': self._broadcaster.frame_number,
+                'num_frames_sent': self._num_frames_sent,
+                'num_frames_skipped': self._num_frames_skipped
+            }
+
+    def write_preview(self, data):
+        self._broadcaster.append(data, self.root_picamera_plugin.preview_frame.complete)
+
+    def flush_preview(self):
+        self._broadcaster.discard_partial_frame()
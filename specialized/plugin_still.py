@@ -7,7 +7,7 @@ from Pyro4 import expose as pyro_expose
 import logging
 from misc.logging import ensure_logging_setup, camel_to_snake
 from misc.settings import SETTINGS
-from tempfile import NamedTemporaryFile
+from specialized.support.temp_storage import named_temporary_file
 import os
 from specialized.support.thread_host import CallbackQueueThreadHost
 from specialized.plugin_status_led import Status
@@ -51,15 +51,15 @@ class StillPlugin(PluginProcessBase):
             _log.error('No %s is running on CAMERA! Will not take a still with info %s.',
                        PICAMERA_ROOT_PLUGIN_NAME, str(info))
             return
-        with NamedTemporaryFile(delete=False, dir=SETTINGS.get('temp_folder', cast_to_type=str, allow_none=True)) as \
-                temp_file:
-            media_path = temp_file.name
-            _log.info('Taking still picture with info %s to %s.', str(info), media_path)
+        with named_temporary_file() as temp_file:
+            _log.info('Taking still picture with info %s.', str(info))
             with Status.set((1, 0, 0), persist_time=float('inf')):
-                camera.camera.capture(media_path, format='jpeg', use_video_port=True,
+                camera.camera.capture(temp_file, format='jpeg', use_video_port=True,
                                       quality=self._integral_jpg_quality)
             temp_file.flush()
             temp_file.close()
+        # The temporary file may have moved to disk while growing, take its name only now
+        media_path = temp_file.name
         media_mgr = find_plugin(MEDIA_MANAGER_PLUGIN_NAME, Process.CAMERA)
         if media_mgr is None:
             _log.error('Could not find a media manager on the CAMERA thread.')
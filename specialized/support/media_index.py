@@ -0,0 +1,126 @@
+from threading import Lock
+import sqlite3
+
+
+MEDIA_INDEX_COLUMNS = ('id', 'uuid', 'timestamp', 'kind', 'duration', 'size', 'path', 'trigger', 'motion_score')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS media (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    uuid TEXT,
+    timestamp REAL NOT NULL,
+    kind TEXT NOT NULL,
+    duration REAL,
+    size INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    trigger TEXT,
+    motion_score REAL
+);
+CREATE INDEX IF NOT EXISTS media_timestamp ON media (timestamp);
+CREATE INDEX IF NOT EXISTS media_kind_timestamp ON media (kind, timestamp);
+'''
+
+
+class MediaIndex:
+    """
+    SQLite index of archived media. Every entry records the time at which the media was archived (seconds since the
+    epoch), its kind, duration (None for pictures), size, path, what triggered it and the motion score. Entries are
+    returned as dictionaries with the keys in `MEDIA_INDEX_COLUMNS`, and can be used from any thread.
+    """
+
+    def __init__(self, db_path):
+        self._lock = Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def num_entries(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM media').fetchone()[0]
+
+    @property
+    def total_size(self):
+        with self._lock:
+            return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM media').fetchone()[0]
+
+    def add(self, timestamp, kind, size, path, duration=None, uuid=None, trigger=None, motion_score=None):
+        """
+        :return: The id of the new entry.
+        """
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                'INSERT INTO media (uuid, timestamp, kind, duration, size, path, trigger, motion_score) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (None if uuid is None else str(uuid), timestamp, kind, duration, size, path, trigger, motion_score))
+            return cursor.lastrowid
+
+    def get(self, entry_id):
+        """
+        :return: The entry with the given id, or None.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT %s FROM media WHERE id = ?' % ', '.join(MEDIA_INDEX_COLUMNS),
+                                   (entry_id,)).fetchone()
+        return None if row is None else dict(zip(MEDIA_INDEX_COLUMNS, row))
+
+    def query(self, kinds=None, since=None, until=None, limit=10):
+        """
+        :param kinds: if not None, a list of the kinds to return.
+        :param since: if not None, return only the entries archived at or after this time.
+        :param until: if not None, return only the entries archived at or before this time.
+        :param limit: maximum number of entries to return; None returns all of them.
+        :return: The matching entries, newest first.
+        """
+        conditions = []
+        params = []
+        if kinds is not None:
+            kinds = list(kinds)
+            conditions.append('kind IN (%s)' % ', '.join('?' * len(kinds)))
+            params += kinds
+        if since is not None:
+            conditions.append('timestamp >= ?')
+            params.append(since)
+        if until is not None:
+            conditions.append('timestamp <= ?')
+            params.append(until)
+        sql = 'SELECT %s FROM media' % ', '.join(MEDIA_INDEX_COLUMNS)
+        if len(conditions) > 0:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY timestamp DESC, id DESC'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(int(limit))
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+        return [dict(zip(MEDIA_INDEX_COLUMNS, row)) for row in rows]
+
+    def evict(self, max_bytes):
+        """
+        Removes the oldest entries until the total size is within max_bytes. The newest entry is never removed. The
+        caller is responsible for removing the files.
+        :return: The removed entries, oldest first.
+        """
+        evicted = []
+        with self._lock, self._db:
+            total_size, num_entries = self._db.execute('SELECT COALESCE(SUM(size), 0), COUNT(*) FROM media').fetchone()
+            if total_size <= max_bytes:
+                return evicted
+            for row in self._db.execute('SELECT %s FROM media ORDER BY timestamp, id' % ', '.join(MEDIA_INDEX_COLUMNS)):
+                if total_size <= max_bytes or len(evicted) >= num_entries - 1:
+                    break
+                entry = dict(zip(MEDIA_INDEX_COLUMNS, row))
+                evicted.append(entry)
+                total_size -= entry['size']
+            self._db.executemany('DELETE FROM media WHERE id = ?', [(entry['id'],) for entry in evicted])
+        return evicted
@@ -0,0 +1,177 @@
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from misc.settings import SETTINGS
+import logging
+import shutil
+import os
+
+
+_log = logging.getLogger('temp_storage')
+_DEFAULT_RAM_FOLDER = '/dev/shm'
+# All processes use this prefix, so that they can account for each other's files in the RAM folder
+_TEMP_PREFIX = 'ratcam_'
+_MAX_GROWTH_STEP = 1024 * 1024
+
+
+class _RamTemporaryFile:
+    """
+    Wraps a temporary file in the RAM folder of a TemporaryStorage, and moves it to the disk folder as soon as growing
+    further would exceed the RAM quota. The name of the file changes then, so read it only after writing.
+    """
+
+    def __init__(self, storage, temp_file, buffering, checked_size):
+        self._storage = storage
+        self._file = temp_file
+        self._buffering = buffering
+        # Size up to which the file is known to fit in the quota
+        self._checked_size = checked_size
+        self._in_ram = True
+
+    def __getattr__(self, item):
+        return getattr(self._file, item)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._file.close()
+
+    @property
+    def name(self):
+        return self._file.name
+
+    @property
+    def in_ram(self):
+        return self._in_ram
+
+    def _ensure_room(self, size):
+        if not self._in_ram or size <= self._checked_size:
+            return
+        # Scanning the RAM folder at every write would be too slow, reserve some room in advance
+        checked_size = max(size, self._checked_size + self._storage.growth_step)
+        if self._storage.fits_in_ram(checked_size - os.fstat(self._file.fileno()).st_size):
+            self._checked_size = checked_size
+        else:
+            self._move_to_disk()
+
+    def _move_to_disk(self):
+        position = self._file.tell()
+        self._file.flush()
+        disk_file = NamedTemporaryFile(delete=False, dir=self._storage.disk_folder, prefix=_TEMP_PREFIX,
+                                       buffering=self._buffering)
+        self._file.seek(0)
+        shutil.copyfileobj(self._file, disk_file)
+        disk_file.seek(position)
+        ram_file, self._file = self._file, disk_file
+        self._in_ram = False
+        ram_file.close()
+        os.remove(ram_file.name)
+        _log.info('Temporary file %s exceeds the RAM quota, moved to %s.', ram_file.name, disk_file.name)
+
+    def write(self, data):
+        self._ensure_room(self._file.tell() + len(data))
+        return self._file.write(data)
+
+    def truncate(self, size=None):
+        if size is not None:
+            self._ensure_room(size)
+        return self._file.truncate(size)
+
+
+class TemporaryStorage:
+    """
+    Creates named temporary files in a RAM-backed folder (tmpfs) as long as all the temporary files in there, created
+    by any process, fit in ram_quota bytes, and in disk_folder otherwise. A file in RAM that outgrows the quota is moved
+    to disk_folder. The files are regular files with a path, so they can be opened and removed from any process.
+    """
+
+    def __init__(self, ram_folder=None, ram_quota=0, disk_folder=None):
+        self._ram_folder = ram_folder
+        self._ram_quota = ram_quota
+        self._disk_folder = disk_folder
+        self._lock = Lock()
+
+    @property
+    def ram_folder(self):
+        return self._ram_folder
+
+    @property
+    def disk_folder(self):
+        return self._disk_folder
+
+    @property
+    def ram_quota(self):
+        return self._ram_quota
+
+    @property
+    def growth_step(self):
+        """
+        Bytes by which a file in RAM may grow before the quota is checked again.
+        """
+        return min(_MAX_GROWTH_STEP, max(1, self._ram_quota // 32))
+
+    @property
+    def ram_usage(self):
+        """
+        Bytes used by the temporary files of all the processes in the RAM folder.
+        """
+        if self._ram_folder is None:
+            return 0
+        usage = 0
+        for entry in os.scandir(self._ram_folder):
+            if not entry.name.startswith(_TEMP_PREFIX):
+                continue
+            try:
+                usage += entry.stat().st_size
+            except OSError:
+                pass  # The file was consumed and removed
+        return usage
+
+    def fits_in_ram(self, num_bytes):
+        """
+        :return: True if num_bytes more bytes fit both in the quota and in the free space of the RAM folder.
+        """
+        if self._ram_folder is None or self.ram_usage + num_bytes > self._ram_quota:
+            return False
+        stats = os.statvfs(self._ram_folder)
+        return stats.f_bavail * stats.f_frsize >= num_bytes
+
+    def named_temporary_file(self, expected_size=0, buffering=-1):
+        """
+        :param expected_size: estimate of the size in bytes that the file will reach.
+        :param buffering: as in `open`.
+        :return: A NamedTemporaryFile, opened in binary mode, that is not deleted on close.
+        """
+        with self._lock:
+            if self.fits_in_ram(expected_size):
+                try:
+                    temp_file = NamedTemporaryFile(delete=False, dir=self._ram_folder, prefix=_TEMP_PREFIX,
+                                                   buffering=buffering)
+                    return _RamTemporaryFile(self, temp_file, buffering, expected_size)
+                except OSError:  # pragma: no cover
+                    _log.exception('Unable to create a temporary file in %s, falling back to disk.', self._ram_folder)
+            return NamedTemporaryFile(delete=False, dir=self._disk_folder, prefix=_TEMP_PREFIX, buffering=buffering)
+
+
+_TEMPORARY_STORAGE = None
+
+
+def temporary_storage():
+    """
+    :return: The TemporaryStorage of this process, configured from the settings upon first use.
+    """
+    global _TEMPORARY_STORAGE
+    if _TEMPORARY_STORAGE is None:
+        ram_folder = SETTINGS.get('temp_ram_folder', cast_to_type=str, allow_none=True, default=_DEFAULT_RAM_FOLDER)
+        if ram_folder is not None and not os.path.isdir(ram_folder):
+            _log.warning('RAM temporary folder %s does not exist, will use only the disk.', ram_folder)
+            ram_folder = None
+        _TEMPORARY_STORAGE = TemporaryStorage(
+            ram_folder=ram_folder,
+            ram_quota=SETTINGS.get('temp_ram_quota', cast_to_type=int, default=32 * 1024 * 1024, ge=0),
+            disk_folder=SETTINGS.get('temp_folder', cast_to_type=str, allow_none=True))
+    return _TEMPORARY_STORAGE
+
+
+def named_temporary_file(expected_size=0, buffering=-1):
+    return temporary_storage().named_temporary_file(expected_size, buffering)
@@ -0,0 +1,126 @@
+import unittest
+import os
+from tempfile import TemporaryDirectory
+from threading import Event
+from specialized.support.temp_storage import TemporaryStorage
+from specialized.support.thread_host import CallbackQueueThreadHost
+from specialized.support.media_index import MediaIndex
+
+
+class TestTemporaryStorage(unittest.TestCase):
+    def test_spill_to_disk(self):
+        with TemporaryDirectory() as ram_dir, TemporaryDirectory() as disk_dir:
+            storage = TemporaryStorage(ram_folder=ram_dir, ram_quota=100, disk_folder=disk_dir)
+            with storage.named_temporary_file(expected_size=60) as first:
+                first.write(b'0' * 60)
+            self.assertEqual(os.path.dirname(first.name), ram_dir)
+            self.assertEqual(storage.ram_usage, 60)
+            with storage.named_temporary_file(expected_size=60) as second:
+                second.write(b'0' * 60)
+            self.assertEqual(os.path.dirname(second.name), disk_dir)
+            # Once consumed, the RAM is available again
+            os.remove(first.name)
+            self.assertEqual(storage.ram_usage, 0)
+            with storage.named_temporary_file(expected_size=60) as third:
+                pass
+            self.assertEqual(os.path.dirname(third.name), ram_dir)
+            for temp_file in (second, third):
+                self.assertTrue(os.path.isfile(temp_file.name))
+                os.remove(temp_file.name)
+
+    def test_moves_to_disk_when_growing(self):
+        with TemporaryDirectory() as ram_dir, TemporaryDirectory() as disk_dir:
+            storage = TemporaryStorage(ram_folder=ram_dir, ram_quota=100, disk_folder=disk_dir)
+            with storage.named_temporary_file(buffering=0) as temp_file:
+                temp_file.write(b'0' * 60)
+                self.assertEqual(os.path.dirname(temp_file.name), ram_dir)
+                ram_name = temp_file.name
+                temp_file.write(b'1' * 60)
+                # Seeking and rewriting keeps working on the moved file
+                temp_file.seek(0)
+                temp_file.write(b'2')
+            self.assertEqual(os.path.dirname(temp_file.name), disk_dir)
+            self.assertFalse(os.path.exists(ram_name))
+            self.assertEqual(storage.ram_usage, 0)
+            with open(temp_file.name, 'rb') as fp:
+                self.assertEqual(fp.read(), b'2' + b'0' * 59 + b'1' * 60)
+            os.remove(temp_file.name)
+
+    def test_quota_is_shared(self):
+        with TemporaryDirectory() as ram_dir, TemporaryDirectory() as disk_dir:
+            # As if in two different processes
+            storage = TemporaryStorage(ram_folder=ram_dir, ram_quota=100, disk_folder=disk_dir)
+            other_storage = TemporaryStorage(ram_folder=ram_dir, ram_quota=100, disk_folder=disk_dir)
+            with storage.named_temporary_file() as first:
+                first.write(b'0' * 60)
+            self.assertEqual(other_storage.ram_usage, 60)
+            with other_storage.named_temporary_file(expected_size=60) as second:
+                pass
+            self.assertEqual(os.path.dirname(second.name), disk_dir)
+            for temp_file in (first, second):
+                os.remove(temp_file.name)
+
+    def test_no_ram_folder(self):
+        with TemporaryDirectory() as disk_dir:
+            storage = TemporaryStorage(ram_folder=None, ram_quota=100, disk_folder=disk_dir)
+            with storage.named_temporary_file() as temp_file:
+                pass
+            self.assertEqual(os.path.dirname(temp_file.name), disk_dir)
+            os.remove(temp_file.name)
+
+
+class TestQueueThreadHost(unittest.TestCase):
+    def test_drain_on_exit(self):
+        processed = []
+        release = Event()
+
+        def action(o):
+            release.wait(1.)
+            processed.append(o)
+
+        thread_host = CallbackQueueThreadHost('test_drain_thread', action, drain_on_exit=True)
+        with thread_host:
+            for i in range(3):
+                thread_host.push_operation(i)
+            # Stop the thread while the first item is still being processed
+            thread_host._thread_stop.set()
+            release.set()
+        self.assertEqual(processed, [0, 1, 2])
+
+
+class TestMediaIndex(unittest.TestCase):
+    def test_query(self):
+        with TemporaryDirectory() as folder, MediaIndex(os.path.join(folder, 'index.sqlite3')) as index:
+            photo_id = index.add(10., 'jpeg', 100, 'a.jpeg', trigger='motion', motion_score=0.5)
+            video_id = index.add(20., 'mp4', 1000, 'b.mp4', duration=8., trigger='someone')
+            self.assertEqual(index.num_entries, 2)
+            self.assertEqual(index.total_size, 1100)
+            self.assertEqual([entry['id'] for entry in index.query()], [video_id, photo_id])
+            self.assertEqual([entry['id'] for entry in index.query(kinds=['jpeg'])], [photo_id])
+            self.assertEqual([entry['id'] for entry in index.query(since=15.)], [video_id])
+            self.assertEqual([entry['id'] for entry in index.query(until=15.)], [photo_id])
+            self.assertEqual(len(index.query(limit=1)), 1)
+            entry = index.get(video_id)
+            self.assertEqual(entry['kind'], 'mp4')
+            self.assertEqual(entry['duration'], 8.)
+            self.assertEqual(entry['path'], 'b.mp4')
+            self.assertIsNone(entry['motion_score'])
+            self.assertIsNone(index.get(video_id + 1))
+
+    def test_evict(self):
+        with TemporaryDirectory() as folder:
+            db_path = os.path.join(folder, 'index.sqlite3')
+            with MediaIndex(db_path) as index:
+                for i in range(4):
+                    index.add(float(i), 'mp4', 100, '%d.mp4' % i)
+                self.assertEqual([entry['path'] for entry in index.evict(250)], ['0.mp4', '1.mp4'])
+                self.assertEqual(index.total_size, 200)
+                # The newest entry is always kept
+                self.assertEqual(len(index.evict(0)), 1)
+            # The index persists
+            with MediaIndex(db_path) as index:
+                self.assertEqual([entry['path'] for entry in index.query()], ['3.mp4'])
+
+
+if __name__ == '__main__':  # pragma: no cover
+    unittest.main()
@@ -43,9 +43,17 @@ class ThreadHost:
 
 
 class QueueThreadHost(ThreadHost):
-    def __init__(self, thread_name):
+    def __init__(self, thread_name, drain_on_exit=False):
         super(QueueThreadHost, self).__init__(thread_name)
         self._queue = Queue()
+        self._drain_on_exit = drain_on_exit
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        super(QueueThreadHost, self).__exit__(exc_type, exc_val, exc_tb)
+        if self._drain_on_exit:
+            # Process on the calling thread whatever the worker did not get to
+            while not self._queue.empty():
+                self._queue_action(self._queue.get_nowait())
 
     def push_operation(self, o):
         self._queue.put_nowait(o)
@@ -65,8 +73,8 @@ class QueueThreadHost(ThreadHost):
 
 
 class CallbackQueueThreadHost(QueueThreadHost):
-    def __init__(self, thread_name, queue_action=None, queue_cleared=None):
-        super(CallbackQueueThreadHost, self).__init__(thread_name)
+    def __init__(self, thread_name, queue_action=None, queue_cleared=None, drain_on_exit=False):
+        super(CallbackQueueThreadHost, self).__init__(thread_name, drain_on_exit=drain_on_exit)
         self._callback_queue_action = queue_action
         self._callback_queue_cleared = queue_cleared
 
@@ -1,23 +1,36 @@
 import unittest
-from plugins.base import ProcessPack, Process, PluginProcessBase
+from plugins.base import ProcessPack, Process, PluginProcessBase, node_plugin_name
 from plugins.decorators import make_plugin
-from plugins.processes_host import ProcessesHost, active_process
-from specialized.plugin_media_manager import MediaManagerPlugin, MediaReceiver, MEDIA_MANAGER_PLUGIN_NAME, Media
+from plugins.processes_host import ProcessesHost, NodeHost, active_process
+from specialized.plugin_media_manager import MediaManagerPlugin, MediaReceiver, MEDIA_MANAGER_PLUGIN_NAME, Media, \
+    MAIN_STREAM, SECONDARY_STREAM
 from Pyro4 import expose as pyro_expose
 import tempfile
 import os
 from threading import Event
 import time
+import numpy as np
 from specialized.plugin_picamera import PiCameraProcessBase, PICAMERA_ROOT_PLUGIN_NAME, PiCameraRootPlugin
-from misc.cam_replay import PiCameraReplay, load_demo_events
+from misc.cam_replay import PiCameraReplay, CamEventType, load_demo_events
 from plugins.processes_host import find_plugin
 from uuid import UUID
-from specialized.plugin_buffered_recorder import BufferedRecorderPlugin, BUFFERED_RECORDER_PLUGIN_NAME
+from specialized.plugin_buffered_recorder import BufferedRecorderPlugin, BUFFERED_RECORDER_PLUGIN_NAME, \
+    SecondaryRecorderPlugin, SECONDARY_RECORDER_PLUGIN_NAME
 from safe_picamera import PiVideoFrameType
 from specialized.plugin_still import StillPlugin, STILL_PLUGIN_NAME
 from specialized.plugin_motion_detector import MotionDetectorResponder, MotionDetectorCameraPlugin, \
     MotionDetectorDispatcherPlugin, MOTION_DETECTOR_PLUGIN_NAME
 from specialized.plugin_status_led import BlinkingStatus, infrange
+from misc.settings import SETTINGS
+from specialized.plugin_adaptive_framerate import AdaptiveFrameratePlugin, ADAPTIVE_FRAMERATE_PLUGIN_NAME
+from specialized.plugin_dvr import DvrPlugin, DVR_PLUGIN_NAME
+from specialized.plugin_media_archive import MediaArchivePlugin, MEDIA_ARCHIVE_PLUGIN_NAME
+from specialized.plugin_frame_monitor import FrameMonitorPlugin, FRAME_MONITOR_PLUGIN_NAME
+from specialized.plugin_preview import PreviewPlugin, PREVIEW_PLUGIN_NAME
+from http.client import HTTPConnection
+from specialized.camera_support.mp4 import read_duration
+from specialized.support import temp_storage
+from specialized.support.temp_storage import TemporaryStorage
 
 
 class RatcamUnitTestCase(unittest.TestCase):
@@ -34,8 +47,8 @@ class RatcamUnitTestCase(unittest.TestCase):
 
 class RemoteMediaManager(MediaManagerPlugin):
     @pyro_expose
-    def test_deliver_media(self, path, kind=None, info=None):
-        self.deliver_media(path, kind, info)
+    def test_deliver_media(self, path, kind=None, info=None, motion_score=None):
+        self.deliver_media(path, kind, info, motion_score=motion_score)
 
 
 class ControlledMediaReceiver(PluginProcessBase, MediaReceiver):
@@ -66,7 +79,77 @@ class ControlledMediaReceiver(PluginProcessBase, MediaReceiver):
         self._let_go_of_media.clear()
 
 
+class NodeMediaSource(PluginProcessBase):
+    @classmethod
+    def plugin_name(cls):  # pragma: no cover
+        return 'NodeMediaSource'
+
+    @classmethod
+    def process(cls):  # pragma: no cover
+        return Process.CAMERA
+
+    @pyro_expose
+    def deliver_test_media(self, content):
+        with tempfile.NamedTemporaryFile(delete=False) as media_file:
+            media_file.write(content)
+        find_plugin(MEDIA_MANAGER_PLUGIN_NAME).camera.deliver_media(media_file.name, 'bin', caption='Test')
+        return media_file.name
+
+
+class ContentMediaReceiver(PluginProcessBase, MediaReceiver):
+    @classmethod
+    def plugin_name(cls):  # pragma: no cover
+        return 'ContentMediaReceiver'
+
+    @classmethod
+    def process(cls):  # pragma: no cover
+        return Process.MAIN
+
+    def handle_media(self, media):
+        with open(media.path, 'rb') as fp:
+            self._received.append((media.node, media.caption, media.path, fp.read()))
+
+    @pyro_expose
+    @property
+    def received(self):
+        return self._received
+
+    def __init__(self):
+        self._received = []
+
+
 class TestMediaManager(RatcamUnitTestCase):
+    def test_media_from_node(self):
+        plugins = {
+            MEDIA_MANAGER_PLUGIN_NAME: ProcessPack(main=MediaManagerPlugin, telegram=MediaManagerPlugin,
+                                                   camera=MediaManagerPlugin),
+            NodeMediaSource.plugin_name(): ProcessPack(camera=NodeMediaSource),
+            ContentMediaReceiver.plugin_name(): ProcessPack(main=ContentMediaReceiver, telegram=ContentMediaReceiver)
+        }
+        content = os.urandom(10000)
+        SETTINGS.nodes.media_chunk_size = 4096
+        try:
+            with NodeHost(plugins, '127.0.0.1', hmac_key='test') as node:
+                with ProcessesHost(plugins, nodes={'kitchen': node.address}, host='127.0.0.1',
+                                   hmac_key='test') as phost:
+                    source = phost.plugin_instances[node_plugin_name('kitchen', NodeMediaSource.plugin_name())].camera
+                    media_rcv = phost.plugin_instances[ContentMediaReceiver.plugin_name()].main
+                    telegram_media_rcv = phost.plugin_instances[ContentMediaReceiver.plugin_name()].telegram
+                    path = source.deliver_test_media(content)
+                    self.retry_until_timeout(lambda: len(media_rcv.received) > 0 and
+                                             len(telegram_media_rcv.received) > 0)
+                    node, caption, local_path, received_content = media_rcv.received[0]
+                    self.assertEqual(node, 'kitchen')
+                    self.assertEqual(caption, 'Test')
+                    # The receivers got a copy, which is removed after use, as the original once consumed
+                    self.assertNotEqual(local_path, path)
+                    self.assertEqual(received_content, content)
+                    # The media is copied once for all the processes
+                    self.assertEqual(telegram_media_rcv.received, [(node, caption, local_path, content)])
+                    self.retry_until_timeout(lambda: not os.path.isfile(local_path) and not os.path.isfile(path))
+        finally:
+            SETTINGS.nodes.media_chunk_size = None
+
     def test_simple(self):
         with ProcessesHost({MEDIA_MANAGER_PLUGIN_NAME: ProcessPack(main=RemoteMediaManager)}) as phost:
             self.assertIn(MEDIA_MANAGER_PLUGIN_NAME, phost.plugin_instances)
@@ -149,6 +232,49 @@ class TestMediaManager(RatcamUnitTestCase):
                 media_rcv.let_media_go()
 
 
+class StreamsMediaReceiver(PluginProcessBase, MediaReceiver):
+    @classmethod
+    def plugin_name(cls):  # pragma: no cover
+        return 'StreamsMediaReceiver'
+
+    @classmethod
+    def process(cls):  # pragma: no cover
+        return Process.MAIN
+
+    def handle_media(self, media):
+        self._streams.append(media.stream)
+
+    @pyro_expose
+    @property
+    def streams(self):
+        return self._streams
+
+    def __init__(self):
+        self._streams = []
+
+
+class ClipMediaReceiver(PluginProcessBase, MediaReceiver):
+    @classmethod
+    def plugin_name(cls):  # pragma: no cover
+        return 'ClipMediaReceiver'
+
+    @classmethod
+    def process(cls):  # pragma: no cover
+        return Process.CAMERA
+
+    def handle_media(self, media):
+        with open(media.path, 'rb') as fp:
+            self._clips.append((media.info, media.caption, read_duration(fp)))
+
+    @pyro_expose
+    @property
+    def clips(self):
+        return self._clips
+
+    def __init__(self):
+        self._clips = []
+
+
 @make_plugin('TestCam', Process.CAMERA)
 class TestCam(PiCameraProcessBase):
     def __init__(self):
@@ -156,6 +282,7 @@ class TestCam(PiCameraProcessBase):
         self._num_writes = 0
         self._num_flushes = 0
         self._num_analysis = 0
+        self._num_reconfigurations = 0
 
     @pyro_expose
     def get_picamera_root_plugin_id(self):
@@ -176,6 +303,11 @@ class TestCam(PiCameraProcessBase):
     def num_analysis(self):
         return self._num_analysis
 
+    @pyro_expose
+    @property
+    def num_reconfigurations(self):
+        return self._num_reconfigurations
+
     def write(self, data):
         self._num_writes += 1
 
@@ -185,6 +317,29 @@ class TestCam(PiCameraProcessBase):
     def analyze(self, array):
         self._num_analysis += 1
 
+    def camera_reconfigured(self, old_config, new_config):
+        self._num_reconfigurations += 1
+
+
+class CameraCloseProbe(PluginProcessBase):
+    """
+    Writes to `result_path` whether the camera is closed when this plugin exits. List it after the root plugin, which
+    then exits first.
+    """
+    result_path = None
+
+    @classmethod
+    def plugin_name(cls):  # pragma: no cover
+        return 'CameraCloseProbe'
+
+    @classmethod
+    def process(cls):  # pragma: no cover
+        return Process.CAMERA
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with open(self.__class__.result_path, 'w') as fp:
+            fp.write(str(find_plugin(PICAMERA_ROOT_PLUGIN_NAME).camera.camera.closed))
+
 
 @make_plugin('InjectDemoData', Process.CAMERA)
 class InjectDemoData(PluginProcessBase):
@@ -212,7 +367,23 @@ class InjectDemoData(PluginProcessBase):
         self._replay = None
 
 
-class TestPicameraPlugin(unittest.TestCase):
+def write_demo_source(folder):
+    """
+    Writes the demo data as a raw H.264 file and a NumPy file of motion vectors, to use as `camera.source`.
+    :return: The paths of the two files.
+    """
+    events = InjectDemoData.DEMO_DATA['events']
+    source = os.path.join(folder, 'demo.h264')
+    source_motion = os.path.join(folder, 'demo.npy')
+    with open(source, 'wb') as fp:
+        for event in events:
+            if event.event_type == CamEventType.WRITE:
+                fp.write(event.data)
+    np.save(source_motion, np.stack([event.data for event in events if event.event_type == CamEventType.ANALYZE]))
+    return source, source_motion
+
+
+class TestPicameraPlugin(RatcamUnitTestCase):
 
     def test_simple(self):
         plugins = {PICAMERA_ROOT_PLUGIN_NAME: ProcessPack(camera=PiCameraRootPlugin)}
@@ -244,6 +415,142 @@ class TestPicameraPlugin(unittest.TestCase):
             self.assertGreater(test_cam_plugin.num_flushes, 0)
             self.assertGreater(test_cam_plugin.num_analysis, 0)
 
+    def test_file_source(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source, source_motion = write_demo_source(temp_dir)
+            SETTINGS.camera.source = source
+            SETTINGS.camera.source_motion = source_motion
+            SETTINGS.camera.source_speed = 10.
+            CameraCloseProbe.result_path = os.path.join(temp_dir, 'closed')
+            plugins = {
+                PICAMERA_ROOT_PLUGIN_NAME: ProcessPack(camera=PiCameraRootPlugin),
+                'TestCam': ProcessPack(camera=TestCam),
+                BUFFERED_RECORDER_PLUGIN_NAME: ProcessPack(camera=BufferedRecorderPlugin),
+                MOTION_DETECTOR_PLUGIN_NAME: ProcessPack(camera=MotionDetectorCameraPlugin),
+                ControlledMediaReceiver.plugin_name(): ProcessPack(camera=ControlledMediaReceiver),
+                MEDIA_MANAGER_PLUGIN_NAME: ProcessPack(camera=MediaManagerPlugin),
+                CameraCloseProbe.plugin_name(): ProcessPack(camera=CameraCloseProbe)
+            }
+            try:
+                with ProcessesHost(plugins) as host:
+                    picamera_plugin = host.plugin_instances[PICAMERA_ROOT_PLUGIN_NAME].camera
+                    test_cam_plugin = host.plugin_instances['TestCam'].camera
+                    buffered_recorder = host.plugin_instances[BUFFERED_RECORDER_PLUGIN_NAME].camera
+                    media_rcv = host.plugin_instances[ControlledMediaReceiver.plugin_name()].camera
+                    # The resolution from the settings is a string, the camera exposes it as a tuple
+                    self.assertEqual(tuple(picamera_plugin.resolution), (1640, 922))
+                    start_time = time.time()
+                    # The file is 40 writes long and loops
+                    while test_cam_plugin.num_writes < 100:
+                        self.assertLess(time.time() - start_time, 10.)
+                        time.sleep(0.05)
+                    self.assertGreater(test_cam_plugin.num_analysis, 0)
+                    num_flushes = test_cam_plugin.num_flushes
+                    num_writes = test_cam_plugin.num_writes
+                    picamera_plugin.reconfigure(bitrate=100000)
+                    self.assertGreater(test_cam_plugin.num_flushes, num_flushes)
+                    while test_cam_plugin.num_writes <= num_writes:
+                        self.assertLess(time.time() - start_time, 10.)
+                        time.sleep(0.05)
+                    # The whole pipeline runs on the file: the detector scores the motion, and a clip is delivered
+                    buffered_recorder.record(12345)
+                    self.retry_until_timeout(lambda: buffered_recorder.footage_age > 0, timeout=10.)
+                    buffered_recorder.stop_and_finalize()
+                    self.retry_until_timeout(lambda: media_rcv.media is not None, timeout=10.)
+                    self.assertEqual(media_rcv.media.kind, 'mp4')
+                    self.assertEqual(media_rcv.media.info, 12345)
+                    self.assertGreater(media_rcv.media.motion_score, 0.)
+                    with open(media_rcv.media.path, 'rb') as fp:
+                        self.assertGreater(read_duration(fp), 0.)
+                    media_rcv.let_media_go()
+                # The root plugin releases the file
+                with open(CameraCloseProbe.result_path, 'r') as fp:
+                    self.assertEqual(fp.read(), 'True')
+            finally:
+                CameraCloseProbe.result_path = None
+                SETTINGS.camera.source = None
+                SETTINGS.camera.source_motion = None
+                SETTINGS.camera.source_speed = 1.
+
+    def test_annotation(self):
+        plugins = {PICAMERA_ROOT_PLUGIN_NAME: ProcessPack(camera=PiCameraRootPlugin)}
+        with ProcessesHost(plugins) as host:
+            picamera_plugin = host.plugin_instances[PICAMERA_ROOT_PLUGIN_NAME].camera
+            picamera_plugin.set_annotation_field('first', 'A')
+            picamera_plugin.set_annotation_field('second', 'B')
+            picamera_plugin.set_annotation_field('first', 'C')
+            start_time = time.time()
+            while picamera_plugin.annotation_text is None or not picamera_plugin.annotation_text.endswith(' C B'):
+                self.assertLess(time.time() - start_time, 2.5)
+                time.sleep(0.05)
+            picamera_plugin.set_annotation_field('first', None)
+            while not picamera_plugin.annotation_text.endswith(' B') or ' C' in picamera_plugin.annotation_text:
+                self.assertLess(time.time() - start_time, 5.)
+                time.sleep(0.05)
+
+    def test_reconfigure(self):
+        plugins = {
+            PICAMERA_ROOT_PLUGIN_NAME: ProcessPack(camera=PiCameraRootPlugin),
+            'TestCam': ProcessPack(camera=TestCam),
+            'InjectDemoData': ProcessPack(camera=InjectDemoData)
+        }
+        with ProcessesHost(plugins) as host:
+            injector = host.plugin_instances['InjectDemoData'].camera
+            picamera_plugin = host.plugin_instances[PICAMERA_ROOT_PLUGIN_NAME].camera
+            test_cam_plugin = host.plugin_instances['TestCam'].camera
+            injector.wait_for_completion()
+            num_flushes = test_cam_plugin.num_flushes
+            blackout = picamera_plugin.reconfigure(framerate=5, bitrate=100000)
+            self.assertGreaterEqual(blackout, 0.)
+            self.assertEqual(blackout, picamera_plugin.last_blackout)
+            self.assertEqual(picamera_plugin.framerate, 5)
+            self.assertEqual(picamera_plugin.bitrate, 100000)
+            self.assertEqual(test_cam_plugin.num_reconfigurations, 1)
+            # Stopping the encoder flushes the stream
+            self.assertGreater(test_cam_plugin.num_flushes, num_flushes)
+            # Nothing changes, nothing happens
+            self.assertEqual(picamera_plugin.reconfigure(framerate=5), 0.)
+            width, height = picamera_plugin.resolution
+            self.assertEqual(picamera_plugin.reconfigure(resolution='%dx%d' % (width, height)), 0.)
+            self.assertEqual(picamera_plugin.reconfigure(resolution=[width, height]), 0.)
+            self.assertEqual(test_cam_plugin.num_reconfigurations, 1)
+            num_writes = test_cam_plugin.num_writes
+            injector.replay()
+            injector.wait_for_completion()
+            self.assertGreater(test_cam_plugin.num_writes, num_writes)
+
+
+class TestEncoderStandby(RatcamUnitTestCase):
+    def test_standby(self):
+        plugins = {
+            PICAMERA_ROOT_PLUGIN_NAME: ProcessPack(camera=PiCameraRootPlugin),
+            'InjectDemoData': ProcessPack(camera=InjectDemoData)
+        }
+        with ProcessesHost(plugins) as host:
+            injector = host.plugin_instances['InjectDemoData'].camera
+            picamera_plugin = host.plugin_instances[PICAMERA_ROOT_PLUGIN_NAME].camera
+            injector.wait_for_completion()
+            self.assertFalse(picamera_plugin.is_standby)
+            picamera_plugin.acquire_encoder('test')
+            picamera_plugin.standby_delay = 0.
+            picamera_plugin.standby_enabled = True
+            time.sleep(0.1)
+            self.assertFalse(picamera_plugin.is_standby)
+            self.assertEqual(picamera_plugin.encoder_consumers, {'test': 1})
+            picamera_plugin.release_encoder('test')
+            self.assertEqual(picamera_plugin.encoder_consumers, {})
+            self.retry_until_timeout(lambda: picamera_plugin.is_standby)
+            self.assertGreater(picamera_plugin.standby_time, 0.)
+            picamera_plugin.acquire_encoder('test')
+            self.assertFalse(picamera_plugin.is_standby)
+            standby_time = picamera_plugin.standby_time
+            time.sleep(0.1)
+            self.assertEqual(standby_time, picamera_plugin.standby_time)
+            picamera_plugin.release_encoder('test')
+            self.retry_until_timeout(lambda: picamera_plugin.is_standby)
+            picamera_plugin.standby_enabled = False
+            self.assertFalse(picamera_plugin.is_standby)
+
 
 class TestBufferedRecorder(RatcamUnitTestCase):
     def test_simple(self):
@@ -307,12 +614,249 @@ class TestBufferedRecorder(RatcamUnitTestCase):
             injector.replay()
             injector.wait_for_completion()
             buffered_recorder.stop_and_finalize()
+            # Finalization happens in the background
+            self.retry_until_timeout(lambda: media_rcv.media is not None)
+            self.assertIsNotNone(buffered_recorder.last_stop_to_delivery_time)
             self.assertTrue(os.path.isfile(media_rcv.media.path))
             self.assertEqual(media_rcv.media.kind, 'mp4')
             self.assertEqual(media_rcv.media.info, 54321)
+            # There is no motion detector to score the footage
+            self.assertIsNone(media_rcv.media.motion_score)
             media_rcv.let_media_go()
             self.retry_until_timeout(lambda: not os.path.isfile(media_rcv.media.path))
 
+    def test_media_has_peak_motion_score(self):
+        plugins = {
+            PICAMERA_ROOT_PLUGIN_NAME: ProcessPack(camera=PiCameraRootPlugin),
+            BUFFERED_RECORDER_PLUGIN_NAME: ProcessPack(camera=BufferedRecorderPlugin),
+            MOTION_DETECTOR_PLUGIN_NAME: ProcessPack(camera=MotionDetectorCameraPlugin),
+            'InjectDemoData': ProcessPack(camera=InjectDemoData),
+            ControlledMediaReceiver.plugin_name(): ProcessPack(camera=ControlledMediaReceiver),
+            MEDIA_MANAGER_PLUGIN_NAME: ProcessPack(camera=MediaManagerPlugin)
+        }
+        with ProcessesHost(plugins) as host:
+            injector = host.plugin_instances['InjectDemoData'].camera
+            buffered_recorder = host.plugin_instances[BUFFERED_RECORDER_PLUGIN_NAME].camera
+            detector = host.plugin_instances[MOTION_DETECTOR_PLUGIN_NAME].camera
+            media_rcv = host.plugin_instances[ControlledMediaReceiver.plugin_name()].camera
+            buffered_recorder.record(12345)
+            injector.wait_for_completion()
+            # Taking a motion image does not affect the score of the clip
+            detector.take_motion_picture(12345)
+            self.retry_until_timeout(lambda: media_rcv.media is not None)
+            self.assertEqual(media_rcv.media.kind, 'jpeg')
+            self.assertIsNotNone(media_rcv.media.motion_score)
+            media_rcv.let_media_go()
+            buffered_recorder.stop_and_finalize()
+            self.retry_until_timeout(lambda: media_rcv.media.kind == 'mp4')
+            # The demo data contains motion
+            self.assertGreater(media_rcv.media.motion_score, 0.)
+            media_rcv.let_media_go()
+
+    def test_overlapping_sessions(self):
+        plugins = {
+            PICAMERA_ROOT_PLUGIN_NAME: ProcessPack(camera=PiCameraRootPlugin),
+            BUFFERED_RECORDER_PLUGIN_NAME: ProcessPack(camera=BufferedRecorderPlugin),
+            'InjectDemoData': ProcessPack(camera=InjectDemoData),
+            ControlledMediaReceiver.plugin_name(): ProcessPack(camera=ControlledMediaReceiver),
+            MEDIA_MANAGER_PLUGIN_NAME: ProcessPack(camera=MediaManagerPlugin)
+        }
+        with ProcessesHost(plugins) as host:
+            injector = host.plugin_instances['InjectDemoData'].camera
+            buffered_recorder = host.plugin_instances[BUFFERED_RECORDER_PLUGIN_NAME].camera
+            media_rcv = host.plugin_instances[ControlledMediaReceiver.plugin_name()].camera
+            first_session = buffered_recorder.record(12345)
+            second_session = buffered_recorder.record(54321)
+            self.assertNotEqual(first_session, second_session)
+            self.assertEqual(buffered_recorder.session_ids, [first_session, second_session])
+            buffered_recorder.stop_and_finalize(first_session)
+            # The recording goes on for the second session
+            self.assertTrue(buffered_recorder.is_recording)
+            self.assertEqual(buffered_recorder.session_ids, [second_session])
+            injector.wait_for_completion()
+            self.assertIsNone(media_rcv.media)
+            buffered_recorder.stop_and_finalize(second_session)
+            self.assertFalse(buffered_recorder.is_recording)
+            # A single clip is delivered to both
+            self.retry_until_timeout(lambda: media_rcv.media is not None)
+            self.assertEqual(media_rcv.media.info, [12345, 54321])
+            media_rcv.let_media_go()
+
+    def test_splits_into_parts(self):
+        plugins = {
+            PICAMERA_ROOT_PLUGIN_NAME: ProcessPack(camera=PiCameraRootPlugin),
+            BUFFERED_RECORDER_PLUGIN_NAME: ProcessPack(camera=BufferedRecorderPlugin),
+            'InjectDemoData': ProcessPack(camera=InjectDemoData),
+            ControlledMediaReceiver.plugin_name(): ProcessPack(camera=ControlledMediaReceiver),
+            MEDIA_MANAGER_PLUGIN_NAME: ProcessPack(camera=MediaManagerPlugin)
+        }
+        with ProcessesHost(plugins) as host:
+            injector = host.plugin_instances['InjectDemoData'].camera
+            buffered_recorder = host.plugin_instances[BUFFERED_RECORDER_PLUGIN_NAME].camera
+            media_rcv = host.plugin_instances[ControlledMediaReceiver.plugin_name()].camera
+            injector.wait_for_completion()
+            # Every GOP of the demo data is larger than this
+            buffered_recorder.clip_max_bytes = 64 * 1024
+            buffered_recorder.record(12345)
+            injector.replay()
+            injector.wait_for_completion()
+            # The part is handed off at the next SPS header, while the recording goes on
+            injector.replay()
+            self.retry_until_timeout(lambda: media_rcv.media is not None, timeout=2.)
+            self.assertEqual(media_rcv.media.info, 12345)
+            self.assertEqual(media_rcv.media.caption, 'Part 1')
+            self.assertTrue(buffered_recorder.is_recording)
+            self.assertLess(buffered_recorder.footage_size, 2 * 64 * 1024)
+            injector.wait_for_completion()
+            media_rcv.let_media_go()
+            buffered_recorder.stop_and_discard()
+
+    def test_delivers_parts_progressively(self):
+        plugins = {
+            PICAMERA_ROOT_PLUGIN_NAME: ProcessPack(camera=PiCameraRootPlugin),
+            BUFFERED_RECORDER_PLUGIN_NAME: ProcessPack(camera=BufferedRecorderPlugin),
+            'InjectDemoData': ProcessPack(camera=InjectDemoData),
+            ControlledMediaReceiver.plugin_name(): ProcessPack(camera=ControlledMediaReceiver),
+            MEDIA_MANAGER_PLUGIN_NAME: ProcessPack(camera=MediaManagerPlugin)
+        }
+        with ProcessesHost(plugins) as host:
+            injector = host.plugin_instances['InjectDemoData'].camera
+            buffered_recorder = host.plugin_instances[BUFFERED_RECORDER_PLUGIN_NAME].camera
+            media_rcv = host.plugin_instances[ControlledMediaReceiver.plugin_name()].camera
+            injector.wait_for_completion()
+            # Every GOP of the demo data is longer than this
+            buffered_recorder.part_length = 1.
+            buffered_recorder.record(12345)
+            # The part is handed off as soon as it is complete, while the recording goes on
+            injector.replay()
+            self.retry_until_timeout(lambda: media_rcv.media is not None, timeout=6.)
+            self.assertEqual(media_rcv.media.info, 12345)
+            self.assertEqual(media_rcv.media.caption, 'Part 1')
+            self.assertTrue(buffered_recorder.is_recording)
+            injector.wait_for_completion()
+            media_rcv.let_media_go()
+            buffered_recorder.stop_and_discard()
+
+    def test_merges_clips_within_window(self):
+        plugins = {
+            PICAMERA_ROOT_PLUGIN_NAME: ProcessPack(camera=PiCameraRootPlugin),
+            BUFFERED_RECORDER_PLUGIN_NAME: ProcessPack(camera=BufferedRecorderPlugin),
+            'InjectDemoData': ProcessPack(camera=InjectDemoData),
+            ControlledMediaReceiver.plugin_name(): ProcessPack(camera=ControlledMediaReceiver),
+            MEDIA_MANAGER_PLUGIN_NAME: ProcessPack(camera=MediaManagerPlugin)
+        }
+        with ProcessesHost(plugins) as host:
+            injector = host.plugin_instances['InjectDemoData'].camera
+            buffered_recorder = host.plugin_instances[BUFFERED_RECORDER_PLUGIN_NAME].camera
+            media_rcv = host.plugin_instances[ControlledMediaReceiver.plugin_name()].camera
+            injector.wait_for_completion()
+            buffered_recorder.clip_merge_window = 60.
+            buffered_recorder.record(12345)
+            buffered_recorder.stop_and_finalize()
+            # The clip is held open instead of being finalized
+            self.assertTrue(buffered_recorder.is_finalizing)
+            self.assertIsNone(media_rcv.media)
+            buffered_recorder.record(54321)
+            self.assertTrue(buffered_recorder.is_recording)
+            buffered_recorder.stop_and_finalize()
+            # Close the window, the clip is finalized at the next split point
+            buffered_recorder.clip_merge_window = 0.
+            injector.replay()
+            self.retry_until_timeout(lambda: media_rcv.media is not None, timeout=6.)
+            self.assertEqual(media_rcv.media.info, [12345, 54321])
+            injector.wait_for_completion()
+            media_rcv.let_media_go()
+
+    def test_records_secondary_stream(self):
+        SETTINGS.camera.secondary_resolution = '160x120'
+        try:
+            plugins = {
+                PICAMERA_ROOT_PLUGIN_NAME: ProcessPack(camera=PiCameraRootPlugin),
+                BUFFERED_RECORDER_PLUGIN_NAME: ProcessPack(camera=BufferedRecorderPlugin),
+                SECONDARY_RECORDER_PLUGIN_NAME: ProcessPack(camera=SecondaryRecorderPlugin),
+                'InjectDemoData': ProcessPack(camera=InjectDemoData),
+                StreamsMediaReceiver.plugin_name(): ProcessPack(camera=StreamsMediaReceiver),
+                MEDIA_MANAGER_PLUGIN_NAME: ProcessPack(camera=MediaManagerPlugin)
+            }
+            with ProcessesHost(plugins) as host:
+                injector = host.plugin_instances['InjectDemoData'].camera
+                buffered_recorder = host.plugin_instances[BUFFERED_RECORDER_PLUGIN_NAME].camera
+                secondary_recorder = host.plugin_instances[SECONDARY_RECORDER_PLUGIN_NAME].camera
+                media_rcv = host.plugin_instances[StreamsMediaReceiver.plugin_name()].camera
+                self.assertTrue(secondary_recorder.enabled)
+                session_id = buffered_recorder.record(12345)
+                # The secondary recorder follows the same sessions
+                self.assertEqual(secondary_recorder.session_ids, [session_id])
+                injector.replay()
+                injector.wait_for_completion()
+                buffered_recorder.stop_and_finalize()
+                self.assertFalse(secondary_recorder.is_recording)
+                self.retry_until_timeout(lambda: len(media_rcv.streams) == 2, timeout=2.)
+                self.assertEqual(sorted(media_rcv.streams), [MAIN_STREAM, SECONDARY_STREAM])
+        finally:
+            SETTINGS.camera.secondary_resolution = None
+
+    def test_reconfigure_while_recording(self):
+        plugins = {
+            PICAMERA_ROOT_PLUGIN_NAME: ProcessPack(camera=PiCameraRootPlugin),
+            BUFFERED_RECORDER_PLUGIN_NAME: ProcessPack(camera=BufferedRecorderPlugin),
+            'InjectDemoData': ProcessPack(camera=InjectDemoData),
+            ControlledMediaReceiver.plugin_name(): ProcessPack(camera=ControlledMediaReceiver),
+            MEDIA_MANAGER_PLUGIN_NAME: ProcessPack(camera=MediaManagerPlugin)
+        }
+        with ProcessesHost(plugins) as host:
+            injector = host.plugin_instances['InjectDemoData'].camera
+            picamera_plugin = host.plugin_instances[PICAMERA_ROOT_PLUGIN_NAME].camera
+            buffered_recorder = host.plugin_instances[BUFFERED_RECORDER_PLUGIN_NAME].camera
+            media_rcv = host.plugin_instances[ControlledMediaReceiver.plugin_name()].camera
+            buffered_recorder.record(12345)
+            injector.wait_for_completion()
+            old_buffer_max_age = buffered_recorder.buffer_max_age
+            picamera_plugin.reconfigure(framerate=2 * picamera_plugin.framerate)
+            # The footage so far was delivered, and the recording goes on
+            self.retry_until_timeout(lambda: media_rcv.media is not None)
+            self.assertEqual(media_rcv.media.info, 12345)
+            self.assertTrue(buffered_recorder.is_recording)
+            self.assertEqual(buffered_recorder.footage_age, 0)
+            self.assertAlmostEqual(buffered_recorder.buffer_max_age, 2 * old_buffer_max_age)
+            media_rcv.let_media_go()
+            buffered_recorder.stop_and_discard()
+
+    def test_fragmented_parts_keep_configuration(self):
+        SETTINGS.camera.fragmented_mp4 = True
+        try:
+            plugins = {
+                PICAMERA_ROOT_PLUGIN_NAME: ProcessPack(camera=PiCameraRootPlugin),
+                BUFFERED_RECORDER_PLUGIN_NAME: ProcessPack(camera=BufferedRecorderPlugin),
+                'InjectDemoData': ProcessPack(camera=InjectDemoData),
+                ClipMediaReceiver.plugin_name(): ProcessPack(camera=ClipMediaReceiver),
+                MEDIA_MANAGER_PLUGIN_NAME: ProcessPack(camera=MediaManagerPlugin)
+            }
+            with ProcessesHost(plugins) as host:
+                injector = host.plugin_instances['InjectDemoData'].camera
+                picamera_plugin = host.plugin_instances[PICAMERA_ROOT_PLUGIN_NAME].camera
+                buffered_recorder = host.plugin_instances[BUFFERED_RECORDER_PLUGIN_NAME].camera
+                media_rcv = host.plugin_instances[ClipMediaReceiver.plugin_name()].camera
+                injector.wait_for_completion()
+                framerate = picamera_plugin.framerate
+                # The buffer is detached as pre-roll once the camera runs at the new framerate
+                preroll_age = buffered_recorder.buffer_age
+                self.assertGreater(preroll_age, 0)
+                picamera_plugin.reconfigure(framerate=2 * framerate)
+                buffered_recorder.record(12345)
+                injector.replay()
+                injector.wait_for_completion()
+                # The footage is split at the flush, and finalized after the camera went back to the old framerate
+                footage_age = buffered_recorder.footage_age
+                picamera_plugin.reconfigure(framerate=framerate)
+                self.retry_until_timeout(lambda: len(media_rcv.clips) == 2, timeout=5.)
+                (_, _, preroll_duration), (_, _, duration) = media_rcv.clips
+                self.assertAlmostEqual(preroll_duration, preroll_age / framerate, places=3)
+                self.assertAlmostEqual(duration, footage_age / (2 * framerate), places=3)
+                buffered_recorder.stop_and_discard()
+        finally:
+            SETTINGS.camera.fragmented_mp4 = False
+
     def test_rewinds(self):
         # Identify the max age of a split point
         max_sps_age = 0
@@ -392,6 +936,33 @@ class TestStillPlugin(RatcamUnitTestCase):
             media_rcv.let_media_go()
             self.retry_until_timeout(lambda: not os.path.isfile(media_rcv.media.path))
 
+    def test_still_exceeding_ram_quota_goes_to_disk(self):
+        plugins = {
+            PICAMERA_ROOT_PLUGIN_NAME: ProcessPack(camera=PiCameraRootPlugin),
+            STILL_PLUGIN_NAME: ProcessPack(camera=StillPlugin),
+            ControlledMediaReceiver.plugin_name(): ProcessPack(camera=ControlledMediaReceiver),
+            MEDIA_MANAGER_PLUGIN_NAME: ProcessPack(camera=MediaManagerPlugin)
+        }
+        previous_storage = temp_storage._TEMPORARY_STORAGE
+        with tempfile.TemporaryDirectory() as ram_dir, tempfile.TemporaryDirectory() as disk_dir:
+            # Any still is larger than the quota, the plugin processes inherit the storage
+            temp_storage._TEMPORARY_STORAGE = TemporaryStorage(ram_folder=ram_dir, ram_quota=100, disk_folder=disk_dir)
+            try:
+                with ProcessesHost(plugins) as host:
+                    media_rcv = host.plugin_instances[ControlledMediaReceiver.plugin_name()].camera
+                    still = host.plugin_instances[STILL_PLUGIN_NAME].camera
+                    still.take_picture(123)
+                    self.retry_until_timeout(lambda: media_rcv.media is not None)
+                    media_path = media_rcv.media.path
+                    media_size = os.path.getsize(media_path)
+                    ram_files = os.listdir(ram_dir)
+                    media_rcv.let_media_go()
+                self.assertEqual(os.path.dirname(media_path), disk_dir)
+                self.assertGreater(media_size, 100)
+                self.assertEqual(ram_files, [])
+            finally:
+                temp_storage._TEMPORARY_STORAGE = previous_storage
+
 
 class TestMotionDetectorPlugin(RatcamUnitTestCase):
     class TestMovementResponder(MotionDetectorResponder, PluginProcessBase):
@@ -399,6 +970,7 @@ class TestMotionDetectorPlugin(RatcamUnitTestCase):
             self._num_distinct_movements = 0
             self._num_wrong_changed_events = 0
             self._last_changed_event = None
+            self._nodes = set()
 
         @classmethod
         def plugin_name(cls):  # pragma: no cover
@@ -418,7 +990,13 @@ class TestMotionDetectorPlugin(RatcamUnitTestCase):
         def num_wrong_changed_events(self):
             return self._num_wrong_changed_events
 
-        def _motion_status_changed_internal(self, is_moving):
+        @pyro_expose
+        @property
+        def nodes(self):
+            return self._nodes
+
+        def _motion_status_changed_internal(self, is_moving, node=None):
+            self._nodes.add(node)
             if is_moving == self._last_changed_event:
                 self._num_wrong_changed_events += 1
             self._last_changed_event = is_moving
@@ -466,6 +1044,53 @@ class TestMotionDetectorPlugin(RatcamUnitTestCase):
         self.assertGreater(main_num_mvmts, 0)
         self.assertEqual(main_num_wrong_evts, 0)
 
+    def test_motion_reported_from_node(self):
+        node_plugins = {
+            MOTION_DETECTOR_PLUGIN_NAME: ProcessPack(camera=MotionDetectorCameraPlugin),
+            PICAMERA_ROOT_PLUGIN_NAME: ProcessPack(camera=PiCameraRootPlugin),
+            'InjectDemoData': ProcessPack(camera=InjectDemoData)
+        }
+        # The central host has no camera
+        plugins = {
+            MOTION_DETECTOR_PLUGIN_NAME: ProcessPack(main=MotionDetectorDispatcherPlugin),
+            TestMotionDetectorPlugin.TestMovementResponder.plugin_name(): ProcessPack(
+                main=TestMotionDetectorPlugin.TestMovementResponder)
+        }
+        with NodeHost(node_plugins, '127.0.0.1', hmac_key='test') as node:
+            with ProcessesHost(plugins, nodes={'kitchen': node.address}, host='127.0.0.1', hmac_key='test') as phost:
+                injector = phost.plugin_instances[node_plugin_name('kitchen', 'InjectDemoData')].camera
+                responder = phost.plugin_instances[TestMotionDetectorPlugin.TestMovementResponder.plugin_name()].main
+                injector.wait_for_completion()
+                self.assertGreater(responder.num_distinct_movements, 0)
+                self.assertEqual(responder.num_wrong_changed_events, 0)
+                self.assertEqual(responder.nodes, {'kitchen'})
+
+    def test_motion_reported_from_secondary_encoder(self):
+        SETTINGS.detector.resolution = '160x120'
+        try:
+            plugins = {
+                MOTION_DETECTOR_PLUGIN_NAME: ProcessPack(camera=MotionDetectorCameraPlugin),
+                PICAMERA_ROOT_PLUGIN_NAME: ProcessPack(camera=PiCameraRootPlugin),
+                'InjectDemoData': ProcessPack(camera=InjectDemoData),
+                TestMotionDetectorPlugin.TestMovementResponder.plugin_name(): ProcessPack(
+                    camera=TestMotionDetectorPlugin.TestMovementResponder),
+                'TestCam': ProcessPack(camera=TestCam)
+            }
+            with ProcessesHost(plugins) as host:
+                injector = host.plugin_instances['InjectDemoData'].camera
+                picamera_plugin = host.plugin_instances[PICAMERA_ROOT_PLUGIN_NAME].camera
+                responder = host.plugin_instances[TestMotionDetectorPlugin.TestMovementResponder.plugin_name()].camera
+                test_cam_plugin = host.plugin_instances['TestCam'].camera
+                injector.wait_for_completion()
+                self.assertEqual(tuple(picamera_plugin.motion_resolution), (160, 120))
+                self.assertGreater(responder.num_distinct_movements, 0)
+                # Video and motion data are still dispatched once
+                self.assertGreater(test_cam_plugin.num_writes, 0)
+                self.assertEqual(test_cam_plugin.num_analysis, len([
+                    evt for evt in InjectDemoData.DEMO_DATA['events'] if evt.event_type.value == 'analyze']))
+        finally:
+            SETTINGS.detector.resolution = None
+
     def test_take_motion_image(self):
         plugins = {
             MOTION_DETECTOR_PLUGIN_NAME: ProcessPack(camera=MotionDetectorCameraPlugin),
@@ -488,6 +1113,243 @@ class TestMotionDetectorPlugin(RatcamUnitTestCase):
             self.retry_until_timeout(lambda: not os.path.isfile(media_rcv.media.path))
 
 
+class TestAdaptiveFrameratePlugin(RatcamUnitTestCase):
+    def test_goes_idle(self):
+        plugins = {
+            PICAMERA_ROOT_PLUGIN_NAME: ProcessPack(camera=PiCameraRootPlugin),
+            ADAPTIVE_FRAMERATE_PLUGIN_NAME: ProcessPack(camera=AdaptiveFrameratePlugin),
+            'InjectDemoData': ProcessPack(camera=InjectDemoData)
+        }
+        with ProcessesHost(plugins) as host:
+            injector = host.plugin_instances['InjectDemoData'].camera
+            picamera_plugin = host.plugin_instances[PICAMERA_ROOT_PLUGIN_NAME].camera
+            adaptive_framerate = host.plugin_instances[ADAPTIVE_FRAMERATE_PLUGIN_NAME].camera
+            injector.wait_for_completion()
+            self.assertFalse(adaptive_framerate.is_idle)
+            adaptive_framerate.idle_delay = 0.
+            adaptive_framerate.idle_framerate = 2
+            # Without a motion detector there is never any activity
+            self.retry_until_timeout(lambda: adaptive_framerate.is_idle)
+            self.assertEqual(picamera_plugin.framerate, 2)
+            adaptive_framerate.idle_framerate = None
+            self.retry_until_timeout(lambda: not adaptive_framerate.is_idle)
+            self.assertEqual(picamera_plugin.framerate, adaptive_framerate.active_framerate)
+
+    def test_ramp_up_keeps_pretrigger_footage(self):
+        plugins = {
+            PICAMERA_ROOT_PLUGIN_NAME: ProcessPack(camera=PiCameraRootPlugin),
+            ADAPTIVE_FRAMERATE_PLUGIN_NAME: ProcessPack(camera=AdaptiveFrameratePlugin),
+            BUFFERED_RECORDER_PLUGIN_NAME: ProcessPack(camera=BufferedRecorderPlugin),
+            MEDIA_MANAGER_PLUGIN_NAME: ProcessPack(camera=MediaManagerPlugin),
+            ClipMediaReceiver.plugin_name(): ProcessPack(camera=ClipMediaReceiver),
+            'InjectDemoData': ProcessPack(camera=InjectDemoData)
+        }
+        with ProcessesHost(plugins) as host:
+            injector = host.plugin_instances['InjectDemoData'].camera
+            picamera_plugin = host.plugin_instances[PICAMERA_ROOT_PLUGIN_NAME].camera
+            adaptive_framerate = host.plugin_instances[ADAPTIVE_FRAMERATE_PLUGIN_NAME].camera
+            buffered_recorder = host.plugin_instances[BUFFERED_RECORDER_PLUGIN_NAME].camera
+            media_rcv = host.plugin_instances[ClipMediaReceiver.plugin_name()].camera
+            injector.wait_for_completion()
+            adaptive_framerate.idle_delay = 0.
+            adaptive_framerate.idle_framerate = 2
+            self.retry_until_timeout(lambda: adaptive_framerate.is_idle)
+            # Buffer some footage at the idle framerate
+            injector.replay()
+            injector.wait_for_completion()
+            self.assertGreater(buffered_recorder.buffer_age, 0)
+            adaptive_framerate.idle_delay = 60.
+            adaptive_framerate.motion_status_changed(True)
+            self.retry_until_timeout(lambda: not adaptive_framerate.is_idle)
+            self.assertEqual(picamera_plugin.framerate, adaptive_framerate.active_framerate)
+            # The motion session starts after the ramp up, and still gets the pre-trigger footage
+            buffered_recorder.record(12345)
+            injector.replay()
+            injector.wait_for_completion()
+            buffered_recorder.stop_and_finalize()
+            self.retry_until_timeout(lambda: len(media_rcv.clips) == 2, timeout=5.)
+            (preroll_info, preroll_caption, preroll_duration), (info, caption, _) = media_rcv.clips
+            self.assertEqual((preroll_info, preroll_caption), (12345, 'Part 1'))
+            self.assertEqual((info, caption), (12345, 'Part 2 (last)'))
+            # At least one frame at the idle framerate
+            self.assertGreaterEqual(preroll_duration, 0.5)
+
+
+class TestDvrPlugin(RatcamUnitTestCase):
+    def test_archives_segments(self):
+        with tempfile.TemporaryDirectory() as archive_folder:
+            SETTINGS.dvr.archive_folder = archive_folder
+            try:
+                plugins = {
+                    PICAMERA_ROOT_PLUGIN_NAME: ProcessPack(camera=PiCameraRootPlugin),
+                    DVR_PLUGIN_NAME: ProcessPack(camera=DvrPlugin),
+                    'InjectDemoData': ProcessPack(camera=InjectDemoData),
+                    ControlledMediaReceiver.plugin_name(): ProcessPack(camera=ControlledMediaReceiver),
+                    MEDIA_MANAGER_PLUGIN_NAME: ProcessPack(camera=MediaManagerPlugin)
+                }
+                with ProcessesHost(plugins) as host:
+                    injector = host.plugin_instances['InjectDemoData'].camera
+                    dvr = host.plugin_instances[DVR_PLUGIN_NAME].camera
+                    media_rcv = host.plugin_instances[ControlledMediaReceiver.plugin_name()].camera
+                    # The demo data ends with a flush, which closes the segment
+                    injector.wait_for_completion()
+                    self.retry_until_timeout(lambda: dvr.num_segments == 1)
+                    injector.replay()
+                    injector.wait_for_completion()
+                    self.retry_until_timeout(lambda: dvr.num_segments == 2)
+                    self.assertGreater(dvr.archive_size, 0)
+                    start_time, end_time = dvr.archive_time_span
+                    self.assertEqual(len(dvr.find_segments(start_time)), 1)
+                    self.assertEqual(len(dvr.find_segments(start_time, end_time)), 2)
+                    self.assertEqual(dvr.export(start_time, info=12345), 1)
+                    self.retry_until_timeout(lambda: media_rcv.media is not None)
+                    self.assertEqual(media_rcv.media.kind, 'mp4')
+                    self.assertEqual(media_rcv.media.info, 12345)
+                    media_rcv.let_media_go()
+                self.assertEqual(len([entry for entry in os.listdir(archive_folder) if entry.endswith('.mp4')]), 2)
+            finally:
+                SETTINGS.dvr.archive_folder = None
+
+
+class TestMediaArchivePlugin(RatcamUnitTestCase):
+    def test_archives_media(self):
+        with tempfile.TemporaryDirectory() as archive_folder:
+            SETTINGS.media_archive.folder = archive_folder
+            try:
+                plugins = {
+                    MEDIA_ARCHIVE_PLUGIN_NAME: ProcessPack(main=MediaArchivePlugin),
+                    MEDIA_MANAGER_PLUGIN_NAME: ProcessPack(main=RemoteMediaManager)
+                }
+                with ProcessesHost(plugins) as host:
+                    media_mgr = host.plugin_instances[MEDIA_MANAGER_PLUGIN_NAME].main
+                    archive = host.plugin_instances[MEDIA_ARCHIVE_PLUGIN_NAME].main
+                    with tempfile.NamedTemporaryFile(delete=False) as media_file:
+                        media_file.write(b'0' * 100)
+                    media_mgr.test_deliver_media(media_file.name, 'jpeg', 12345)
+                    # The original is removed, the copy in the archive stays
+                    self.retry_until_timeout(lambda: not os.path.isfile(media_file.name))
+                    self.assertEqual(archive.num_entries, 1)
+                    self.assertEqual(archive.archive_size, 100)
+                    entry, = archive.query(kinds=['jpeg'])
+                    self.assertEqual(entry['trigger'], '12345')
+                    self.assertEqual(entry['size'], 100)
+                    self.assertIsNone(entry['duration'])
+                    self.assertTrue(os.path.isfile(entry['path']))
+                    self.assertEqual(archive.get(entry['id']), entry)
+                    self.assertEqual(archive.query(kinds=['mp4']), [])
+            finally:
+                SETTINGS.media_archive.folder = None
+
+    def test_archives_motion_score_of_each_media(self):
+        with tempfile.TemporaryDirectory() as archive_folder:
+            SETTINGS.media_archive.folder = archive_folder
+            try:
+                plugins = {
+                    MEDIA_ARCHIVE_PLUGIN_NAME: ProcessPack(main=MediaArchivePlugin),
+                    MEDIA_MANAGER_PLUGIN_NAME: ProcessPack(main=RemoteMediaManager)
+                }
+                with ProcessesHost(plugins) as host:
+                    media_mgr = host.plugin_instances[MEDIA_MANAGER_PLUGIN_NAME].main
+                    archive = host.plugin_instances[MEDIA_ARCHIVE_PLUGIN_NAME].main
+                    for kind, motion_score in [('jpeg', 0.25), ('bin', 0.5), ('bin', None)]:
+                        with tempfile.NamedTemporaryFile(delete=False) as media_file:
+                            media_file.write(b'0' * 100)
+                        media_mgr.test_deliver_media(media_file.name, kind, 12345, motion_score)
+                        self.retry_until_timeout(lambda: not os.path.isfile(media_file.name))
+                    self.assertEqual([entry['motion_score'] for entry in archive.query(kinds=['jpeg'])], [0.25])
+                    self.assertEqual({entry['motion_score'] for entry in archive.query(kinds=['bin'])}, {None, 0.5})
+            finally:
+                SETTINGS.media_archive.folder = None
+
+
+class TestFrameMonitorPlugin(RatcamUnitTestCase):
+    def test_counts_frames(self):
+        plugins = {
+            PICAMERA_ROOT_PLUGIN_NAME: ProcessPack(camera=PiCameraRootPlugin),
+            FRAME_MONITOR_PLUGIN_NAME: ProcessPack(camera=FrameMonitorPlugin),
+            'InjectDemoData': ProcessPack(camera=InjectDemoData)
+        }
+        with ProcessesHost(plugins) as host:
+            injector = host.plugin_instances['InjectDemoData'].camera
+            frame_monitor = host.plugin_instances[FRAME_MONITOR_PLUGIN_NAME].camera
+            injector.wait_for_completion()
+            frame_stats = frame_monitor.frame_stats
+            self.assertGreater(frame_stats['num_frames'], 0)
+            # The demo data was recorded without drops
+            self.assertEqual(frame_stats['num_dropped_frames'], 0)
+            self.assertGreater(frame_stats['motion_interval']['mean'], 0.)
+            # The replay ends with a flush
+            self.assertIsNone(frame_monitor.time_since_last_frame)
+            frame_monitor.reset_frame_stats()
+            self.assertEqual(frame_monitor.frame_stats['num_frames'], 0)
+
+
+class TestPreviewPlugin(RatcamUnitTestCase):
+    @staticmethod
+    def _read_jpeg(response):
+        # Each part has a boundary and its headers, followed by an empty line
+        content_length = None
+        while True:
+            line = response.readline()
+            if line.startswith(b'Content-Length:'):
+                content_length = int(line.split(b':')[1])
+            elif line == b'\r\n' and content_length is not None:
+                break
+        return response.read(content_length)
+
+    def test_stream(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            SETTINGS.camera.source = write_demo_source(temp_dir)[0]
+            SETTINGS.camera.source_speed = 4.
+            SETTINGS.preview.host = '127.0.0.1'
+            SETTINGS.preview.port = 0
+            plugins = {
+                PICAMERA_ROOT_PLUGIN_NAME: ProcessPack(camera=PiCameraRootPlugin),
+                PREVIEW_PLUGIN_NAME: ProcessPack(camera=PreviewPlugin)
+            }
+            try:
+                with ProcessesHost(plugins) as host:
+                    picamera_plugin = host.plugin_instances[PICAMERA_ROOT_PLUGIN_NAME].camera
+                    preview = host.plugin_instances[PREVIEW_PLUGIN_NAME].camera
+                    host_name, port = preview.address
+                    self.assertNotIn(PREVIEW_PLUGIN_NAME, picamera_plugin.encoder_consumers)
+                    connections = [HTTPConnection(host_name, port, timeout=5.) for _ in range(2)]
+                    responses = []
+                    for connection in connections:
+                        connection.request('GET', '/stream.mjpg')
+                        responses.append(connection.getresponse())
+                    for response in responses:
+                        self.assertEqual(response.status, 200)
+                        self.assertTrue(response.getheader('Content-Type').startswith('multipart/x-mixed-replace'))
+                        for _ in range(3):
+                            self.assertTrue(self._read_jpeg(response).startswith(b'\xff\xd8'))
+                    self.assertEqual(preview.num_clients, 2)
+                    self.assertIn(PREVIEW_PLUGIN_NAME, picamera_plugin.encoder_consumers)
+                    for response, connection in zip(responses, connections):
+                        response.close()
+                        connection.close()
+                    # The clients are noticed to be gone at the next frame
+                    self.retry_until_timeout(lambda: preview.num_clients == 0, timeout=5.)
+                    self.assertNotIn(PREVIEW_PLUGIN_NAME, picamera_plugin.encoder_consumers)
+                    self.assertGreaterEqual(preview.preview_stats['num_frames_sent'], 6)
+                    connection = HTTPConnection(host_name, port, timeout=5.)
+                    connection.request('GET', '/snapshot.jpg')
+                    response = connection.getresponse()
+                    self.assertEqual(response.status, 200)
+                    self.assertEqual(response.getheader('Content-Type'), 'image/jpeg')
+                    self.assertTrue(response.read().startswith(b'\xff\xd8'))
+                    connection.close()
+                    connection = HTTPConnection(host_name, port, timeout=5.)
+                    connection.request('GET', '/missing')
+                    self.assertEqual(connection.getresponse().status, 404)
+                    connection.close()
+            finally:
+                SETTINGS.camera.source = None
+                SETTINGS.camera.source_speed = 1.
+                SETTINGS.preview.host = '0.0.0.0'
+                SETTINGS.preview.port = None
+
+
 class TestBlinkingStatus(unittest.TestCase):
     def test_infrange(self):
         self.assertEqual(list(range(10)), list(infrange(10)))
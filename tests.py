@@ -4,6 +4,8 @@ from plugins.tests import *
 from specialized.tests import *
 from specialized.telegram_support.tests import *
 from specialized.detector_support.tests import *
+from specialized.camera_support.tests import *
+from specialized.support.tests import *
 from misc.logging import ensure_logging_setup
 import logging
 import specialized.plugin_picamera